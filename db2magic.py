@@ -7,21 +7,28 @@
 #
 
 from __future__ import print_function
-import multiprocessing
+import time
+_loadstart = time.time()
 from IPython.display import HTML as pHTML, Image as pImage, display as pdisplay, Javascript as Javascript
 from IPython.core.magic import (Magics, magics_class, line_magic,
 								cell_magic, line_cell_magic, needs_local_scope)
 import ibm_db
-import pandas
-import ibm_db_dbi
 import json
 import getpass
 import pickle
-import time
 import re
 import warnings
-import matplotlib
-import matplotlib.pyplot as plt
+import atexit
+import weakref
+import threading
+
+# Pandas, matplotlib, qgrid and multiprocessing are loaded the first time they are needed
+
+pandas = None
+plt = None
+qgrid = None
+mp = None
+pa = None
 
 warnings.filterwarnings("ignore")
 
@@ -30,6 +37,10 @@ _settings = {
 	 "maxgrid"  : 5,
 	 "display"  : "PANDAS",
 	 "threads"  : 0,
+	 "maxthreads" : 32,
+	 "connections": 8,
+	 "parallel" : "PROCESSES",
+	 "inlist"   : 1000,
 	 "database" : "",
 	 "hostname" : "localhost",
 	 "port"     : "50000",
@@ -42,7 +53,8 @@ _settings = {
 
 _environment = {
 	 "jupyter"  : True,
-	 "qgrid"    : True
+	 "qgrid"    : True,
+	 "arrow"    : True
 }
 
 _display = {
@@ -108,12 +120,29 @@ _pdtypes =  ["object",
 _connected = False
 _hdbc = None
 _hdbi = None
-_stmt = []
-_stmtID = []
-_stmtSQL = []
+_statements = {}
+_stmtText = {}
+_stmtStats = {"hits": 0, "misses": 0, "evictions": 0}
+_stmtNext = 0
+_results = {}
+_resultStats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+_resultLock = threading.Lock()
+_diskLock = threading.Lock()
+_catalog = {}
+_catalogStats = {"hits": 0, "misses": 0}
+_inlists = {}
+_connections = {}
+_current = None
+_connLock = threading.RLock()
+_keepalive = None
+_lastused = 0
+_pool = None
+_poolKey = None
+_manager = None
 _vars = {}
 _macros = {}
 _flags = []
+_flagvalues = {}
 _debug = False
 
 # Db2 Error Messages and Codes
@@ -122,17 +151,9 @@ sqlstate = "0"
 sqlerror = ""
 sqlelapsed = 0
 
-# Check to see if QGrid is installed
-
-try:
-	import qgrid
-	qgrid.set_defaults(grid_options=_display)
-except:
-	_environment['qgrid'] = False
-
-if (_environment['qgrid'] == False):
-	print("Warning: QGRID is unavailable for displaying results in scrollable windows.")
-	print("         Install QGRID if you want to enable scrolling of result sets.")
+_pandas_dtype = False
+_parallel = False
+_loadelapsed = 0
 
 # Check if we are running in iPython or Jupyter
 
@@ -145,46 +166,108 @@ try:
 except:
 	_environment['jupyter'] = False
 	_environment['qgrid'] = False
-	
-# Check if pandas supports data types in the data frame - Introduced in 1.3 of pandas
 
-_pandas_dtype = False
-try:
-	_vrm = pandas.__version__.split(".")
-	_version  = 0
-	_release  = 0
-	_modlevel = 0
-	if (len(_vrm) >= 1):
-		_version  = int(_vrm[0])
-	if (len(_vrm) >= 2):
-		_release  = int(_vrm[1])
-	if (len(_vrm) >= 3):
-		_modlevel = int(_vrm[2])
-	if (_version >= 1 and _release >= 3):
-		_pandas_dtype = True
-	else:
-		_pandas_dtype = False
-except:
+def loadPandas():
+
+	# Import pandas and check if it supports data types in the data frame - Introduced in 1.3 of pandas
+
+	global pandas, _pandas_dtype
+
+	if (pandas != None): return
+
+	import pandas
+
 	_pandas_dtype = False
+	try:
+		_vrm = pandas.__version__.split(".")
+		_version  = 0
+		_release  = 0
+		if (len(_vrm) >= 1):
+			_version  = int(_vrm[0])
+		if (len(_vrm) >= 2):
+			_release  = int(_vrm[1])
+		if (_version >= 1 and _release >= 3):
+			_pandas_dtype = True
+	except:
+		_pandas_dtype = False
 
-if (_pandas_dtype == False):
-	print("Warning: PANDAS level does not support Db2 typing which will can increase memory usage.")
-	print("         Install PANDAS version 1.3+ for more efficient dataframe creation.")
-	
-# Check if we have parallism available
+	if (_pandas_dtype == False):
+		print("Warning: PANDAS level does not support Db2 typing which will can increase memory usage.")
+		print("         Install PANDAS version 1.3+ for more efficient dataframe creation.")
 
-_parallel = False
-try:
-	import multiprocessing as mp
-	from multiprocessing.sharedctypes import Value, Array
-	_parallel = True
-except:
-	_parallel = False
-	
-if (_parallel == False):
-	print("Warning: Parallelism is unavailable and THREADS option will be ignored.")
-	print("         Install MULTIPROCESSING if you want allow multiple SQL threads to run in parallel.")  
-	_settings["threads"] = 0
+	return
+
+def loadGrid():
+
+	# Check to see if QGrid is installed. Only done the first time a GRID display is requested.
+
+	global qgrid, _environment
+
+	if (qgrid != None or _environment['qgrid'] == False): 
+		return _environment['qgrid']
+
+	try:
+		import qgrid
+		qgrid.set_defaults(grid_options=_display)
+	except:
+		qgrid = None
+		_environment['qgrid'] = False
+		print("Warning: QGRID is unavailable for displaying results in scrollable windows.")
+		print("         Install QGRID if you want to enable scrolling of result sets.")
+
+	return _environment['qgrid']
+
+def loadPlot():
+
+	# Matplotlib is only needed when one of the plotting flags is used
+
+	global plt
+
+	if (plt != None): return
+
+	import matplotlib
+	import matplotlib.pyplot as plt
+
+	return
+
+def loadArrow():
+
+	# PyArrow is optional. Parallel results are pickled back to the notebook if it is not installed.
+
+	global pa, _environment
+
+	if (pa != None or _environment['arrow'] == False): 
+		return _environment['arrow']
+
+	try:
+		import pyarrow as pa
+	except:
+		pa = None
+		_environment['arrow'] = False
+
+	return _environment['arrow']
+
+def loadParallel():
+
+	# Check if we have parallism available
+
+	global mp, _parallel, _settings
+
+	if (mp != None): return _parallel
+
+	try:
+		import multiprocessing as mp
+		_parallel = True
+	except:
+		mp = None
+		_parallel = False
+
+	if (_parallel == False):
+		print("Warning: Parallelism is unavailable and THREADS option will be ignored.")
+		print("         Install MULTIPROCESSING if you want allow multiple SQL threads to run in parallel.")  
+		_settings["threads"] = 0
+
+	return _parallel
 
 #
 # Set Options for the Db2 Magic Commands
@@ -198,20 +281,34 @@ def setOptions(inSQL):
 	cnt = 0
 	
 	if (len(cParms) == 1):
-		print("(MAXROWS) Maximum number of rows displayed: " + str(_settings.get("maxrows",10)))
-		print("(MAXGRID) Maximum grid display size: " + str(_settings.get("maxgrid",5)))
-		print("(DISPLAY) Use PANDAS or GRID display format for output: " + _settings.get("display","PANDAS"))  
-		print("(THREADS) Maximum number of threads to use when running SQL: " + str(_settings.get("threads",0)))     
+		listOptions()
 		return
 
 	while cnt < len(cParms):
 		
 		if cParms[cnt][0] == "?":
-			print("%sql OPTION MAXROWS n MAXGRID n DISPLAY n THREADS n")
+			print("%sql OPTION MAXROWS n MAXGRID n DISPLAY n THREADS n MAXTHREADS n PARALLEL n INLIST n CONNECTIONS n RECONNECT n TIMEOUT n STATEMENTS n HOLD ON|OFF FETCHSIZE n PREFETCH ON|OFF CACHE ON|OFF|DISK|CLEAR CACHETTL n CACHESIZE n CACHEDIR path DISKTTL n DISKSIZE n CATALOG ON|OFF|REFRESH")
 			print("LIST      - List the current option settings")
 			print("MAXROWS n - The maximum number of rows displayed when returning results")
 			print("MAXGRID n - Maximum size of a scrollable GRID window")
-			print("THREADS n - Maximum number of parallel threads to use when running SQL")
+			print("THREADS n - Maximum number of parallel threads to use when running SQL (AUTO = adjust to the server)")
+			print("MAXTHREADS n - The largest number of threads that THREADS can use")
+			print("CONNECTIONS n - Maximum number of named connections (CONNECT ... AS name) kept open")
+			print("RECONNECT n - Attempts made to reconnect when the connection to Db2 is lost (0 = never)")
+			print("TIMEOUT n - Db2 cancels a statement that runs longer than n seconds (0 = no limit)")
+			print("STATEMENTS n - Maximum number of prepared statements kept (the least recently used are freed)")
+			print("HOLD ON|OFF - Keep prepared statements after a COMMIT")
+			print("FETCHSIZE n - Number of rows read from a result set at a time (0 = one row per call)")
+			print("PREFETCH ON|OFF - Fetch the next block of rows from Db2 while the current block is read")
+			print("CACHE ON|OFF|DISK|CLEAR - Reuse the results of identical queries in memory or on DISK (CLEAR discards the cached results)")
+			print("CACHETTL n - Seconds a cached result is reused for")
+			print("CACHESIZE n - Megabytes of memory used for cached results")
+			print("CACHEDIR path - Directory that holds the results cached on disk")
+			print("DISKTTL n - Seconds a result cached on disk is reused for")
+			print("DISKSIZE n - Megabytes of disk used for cached results")
+			print("CATALOG ON|OFF|REFRESH - Keep procedure, table and column information from the catalog (REFRESH reads it again)")
+			print("PARALLEL n - Run parallel SQL in worker PROCESSES or in THREADS of the notebook")
+			print("INLIST n  - Lists larger than n values are sent to Db2 in a temporary table (0 = never)")
 			return
 		
 		if cParms[cnt].upper() == 'MAXROWS':
@@ -237,11 +334,12 @@ def setOptions(inSQL):
 					if (maxgrid <= 5):                      # Minimum window size is 5
 						maxgrid = 5
 					_display["maxVisibleRows"] =  int(maxgrid)
-					try:
-						qgrid.set_defaults(grid_options=_display)
-						_settings["maxgrid"] = maxgrid
-					except:
-						_environment['qgrid'] = False
+					_settings["maxgrid"] = maxgrid
+					if (qgrid != None):
+						try:
+							qgrid.set_defaults(grid_options=_display)
+						except:
+							_environment['qgrid'] = False
 						
 				except Exception as err:
 					errormsg("Invalid MAXGRID value provided.")
@@ -267,13 +365,16 @@ def setOptions(inSQL):
 		elif cParms[cnt].upper() == 'THREADS':
 			if cnt+1 < len(cParms):
 				try:
-					threads = int(cParms[cnt+1])
-					if (threads < 0):
-						threads = 0
-					elif (threads > 12):
-						threads = 12
+					if (cParms[cnt+1].upper() == 'AUTO'):
+						threads = 'AUTO'
 					else:
-						pass
+						threads = int(cParms[cnt+1])
+						if (threads < 0):
+							threads = 0
+						elif (threads > _settings.get("maxthreads",32)):
+							threads = _settings.get("maxthreads",32)
+						else:
+							pass
 					_settings["threads"] = threads
 				except Exception as err:
 					errormsg("Invalid THREADS value provided.")
@@ -282,24 +383,289 @@ def setOptions(inSQL):
 			else:
 				errormsg("No thread count specified for the THREADS option.")
 				return
+
+		elif cParms[cnt].upper() == 'MAXTHREADS':
+			if cnt+1 < len(cParms):
+				try:
+					maxthreads = int(cParms[cnt+1])
+					if (maxthreads < 2):
+						maxthreads = 2
+					_settings["maxthreads"] = maxthreads
+					if (isinstance(_settings.get("threads",0),int) and _settings.get("threads",0) > maxthreads):
+						_settings["threads"] = maxthreads
+				except Exception as err:
+					errormsg("Invalid MAXTHREADS value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No thread count specified for the MAXTHREADS option.")
+				return
+			
+		elif cParms[cnt].upper() == 'PARALLEL':
+			if cnt+1 < len(cParms):
+				if (cParms[cnt+1].upper() in ('THREADS','THREAD')):
+					_settings["parallel"] = 'THREADS'
+				elif (cParms[cnt+1].upper() in ('PROCESSES','PROCESS')):
+					_settings["parallel"] = 'PROCESSES'
+				else:
+					errormsg("Invalid PARALLEL value provided (THREADS or PROCESSES).")
+				cnt = cnt + 2                               # Skip the value since THREADS is also an option name
+			else:
+				errormsg("No value provided for the PARALLEL option.")
+				return  
+			
+		elif cParms[cnt].upper() == 'CONNECTIONS':
+			if cnt+1 < len(cParms):
+				try:
+					connections = int(cParms[cnt+1])
+					if (connections < 1):
+						connections = 1
+					_settings["connections"] = connections
+					trimConnections()
+				except Exception as err:
+					errormsg("Invalid CONNECTIONS value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No connection count specified for the CONNECTIONS option.")
+				return
+			
+		elif cParms[cnt].upper() == 'RECONNECT':
+			if cnt+1 < len(cParms):
+				try:
+					attempts = int(cParms[cnt+1])
+					if (attempts < 0):
+						attempts = 0
+					_settings["reconnect"] = attempts
+				except Exception as err:
+					errormsg("Invalid RECONNECT value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No number of attempts specified for the RECONNECT option.")
+				return
+			
+		elif cParms[cnt].upper() == 'TIMEOUT':
+			if cnt+1 < len(cParms):
+				try:
+					timeout = int(cParms[cnt+1])
+					if (timeout < 0):
+						timeout = 0
+					_settings["timeout"] = timeout
+				except Exception as err:
+					errormsg("Invalid TIMEOUT value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No number of seconds specified for the TIMEOUT option.")
+				return
+			
+		elif cParms[cnt].upper() == 'STATEMENTS':
+			if cnt+1 < len(cParms):
+				try:
+					statements = int(cParms[cnt+1])
+					if (statements < 1):
+						statements = 1
+					_settings["statements"] = statements
+					trimStatements()
+				except Exception as err:
+					errormsg("Invalid STATEMENTS value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No statement count specified for the STATEMENTS option.")
+				return
+			
+		elif cParms[cnt].upper() == 'HOLD':
+			if cnt+1 < len(cParms):
+				if (cParms[cnt+1].upper() in ('ON','OFF')):
+					_settings["hold"] = cParms[cnt+1].upper()
+				else:
+					errormsg("HOLD must be ON or OFF.")
+				cnt = cnt + 1
+			else:
+				errormsg("No value (ON or OFF) specified for the HOLD option.")
+				return
+			
+		elif cParms[cnt].upper() == 'FETCHSIZE':
+			if cnt+1 < len(cParms):
+				try:
+					fetchsize = int(cParms[cnt+1])
+					if (fetchsize < 0):
+						fetchsize = 0
+					_settings["fetchsize"] = fetchsize
+				except Exception as err:
+					errormsg("Invalid FETCHSIZE value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No number of rows specified for the FETCHSIZE option.")
+				return
+			
+		elif cParms[cnt].upper() == 'PREFETCH':
+			if cnt+1 < len(cParms):
+				if (cParms[cnt+1].upper() in ('ON','OFF')):
+					_settings["prefetch"] = cParms[cnt+1].upper()
+				else:
+					errormsg("PREFETCH must be ON or OFF.")
+				cnt = cnt + 1
+			else:
+				errormsg("No value (ON or OFF) specified for the PREFETCH option.")
+				return
+			
+		elif cParms[cnt].upper() == 'CACHE':
+			if cnt+1 < len(cParms):
+				if (cParms[cnt+1].upper() in ('ON','OFF','DISK')):
+					_settings["cache"] = cParms[cnt+1].upper()
+					if (_settings["cache"] == "OFF"):
+						clearResults()
+				elif (cParms[cnt+1].upper() == 'CLEAR'):
+					clearResults(disk=True)
+				else:
+					errormsg("CACHE must be ON, OFF, DISK or CLEAR.")
+				cnt = cnt + 1
+			else:
+				errormsg("No value (ON, OFF, DISK or CLEAR) specified for the CACHE option.")
+				return
+			
+		elif cParms[cnt].upper() == 'CACHETTL':
+			if cnt+1 < len(cParms):
+				try:
+					cachettl = int(cParms[cnt+1])
+					if (cachettl < 0):
+						cachettl = 0
+					_settings["cachettl"] = cachettl
+				except Exception as err:
+					errormsg("Invalid CACHETTL value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No number of seconds specified for the CACHETTL option.")
+				return
+			
+		elif cParms[cnt].upper() == 'CACHESIZE':
+			if cnt+1 < len(cParms):
+				try:
+					cachesize = int(cParms[cnt+1])
+					if (cachesize < 0):
+						cachesize = 0
+					_settings["cachesize"] = cachesize
+					trimResults()
+				except Exception as err:
+					errormsg("Invalid CACHESIZE value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No number of megabytes specified for the CACHESIZE option.")
+				return
+			
+		elif cParms[cnt].upper() == 'CACHEDIR':
+			if cnt+1 < len(cParms):
+				_settings["cachedir"] = cParms[cnt+1]
+				cnt = cnt + 1
+			else:
+				errormsg("No directory specified for the CACHEDIR option.")
+				return
+			
+		elif cParms[cnt].upper() == 'DISKTTL':
+			if cnt+1 < len(cParms):
+				try:
+					diskttl = int(cParms[cnt+1])
+					if (diskttl < 0):
+						diskttl = 0
+					_settings["diskttl"] = diskttl
+				except Exception as err:
+					errormsg("Invalid DISKTTL value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No number of seconds specified for the DISKTTL option.")
+				return
+			
+		elif cParms[cnt].upper() == 'DISKSIZE':
+			if cnt+1 < len(cParms):
+				try:
+					disksize = int(cParms[cnt+1])
+					if (disksize < 0):
+						disksize = 0
+					_settings["disksize"] = disksize
+					trimDisk()
+				except Exception as err:
+					errormsg("Invalid DISKSIZE value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No number of megabytes specified for the DISKSIZE option.")
+				return
+			
+		elif cParms[cnt].upper() == 'CATALOG':
+			if cnt+1 < len(cParms):
+				if (cParms[cnt+1].upper() in ('ON','OFF')):
+					_settings["catalog"] = cParms[cnt+1].upper()
+					clearCatalog(everything=True)
+				elif (cParms[cnt+1].upper() == 'REFRESH'):
+					clearCatalog(everything=True)
+				else:
+					errormsg("CATALOG must be ON, OFF or REFRESH.")
+				cnt = cnt + 1
+			else:
+				errormsg("No value (ON, OFF or REFRESH) specified for the CATALOG option.")
+				return
+			
+		elif cParms[cnt].upper() == 'INLIST':
+			if cnt+1 < len(cParms):
+				try:
+					inlist = int(cParms[cnt+1])
+					if (inlist < 0):
+						inlist = 0
+					_settings["inlist"] = inlist
+				except Exception as err:
+					errormsg("Invalid INLIST value provided.")
+					pass
+				cnt = cnt + 1
+			else:
+				errormsg("No list size specified for the INLIST option.")
+				return
 			
 		elif (cParms[cnt].upper() == 'LIST'):
-			print("(MAXROWS) Maximum number of rows displayed: " + str(_settings.get("maxrows",10)))
-			print("(MAXGRID) Maximum grid display size: " + str(_settings.get("maxgrid",5)))
-			print("(DISPLAY) Use PANDAS or GRID display format for output: " + _settings.get("display","PANDAS"))
-			print("(THREADS) Maximum number of threads to use when running SQL: " + str(_settings.get("threads",0)))
+			listOptions()
 			return
 		else:
 			cnt = cnt + 1
 			
 	save_settings()
 
+	listOptions()
+	
+	return	
+
+def listOptions():
+
+	global _settings
+
 	print("(MAXROWS) Maximum number of rows displayed: " + str(_settings.get("maxrows",10)))
 	print("(MAXGRID) Maximum grid display size: " + str(_settings.get("maxgrid",5)))
 	print("(DISPLAY) Use PANDAS or GRID display format for output: " + _settings.get("display","PANDAS"))
 	print("(THREADS) Maximum number of threads to use when running SQL: " + str(_settings.get("threads",0)))
-	
-	return	
+	print("(MAXTHREADS) Upper limit for THREADS and THREADS AUTO: " + str(_settings.get("maxthreads",32)))
+	print("(PARALLEL) Run parallel SQL using PROCESSES or THREADS: " + _settings.get("parallel","PROCESSES"))
+	print("(INLIST) Maximum IN list size before values are loaded into a temporary table: " + str(_settings.get("inlist",1000)))
+	print("(CONNECTIONS) Maximum number of named connections kept open: " + str(_settings.get("connections",8)))
+	print("(RECONNECT) Attempts made to reconnect a lost connection: " + str(_settings.get("reconnect",5)))
+	print("(TIMEOUT) Seconds a statement can run before Db2 cancels it (0 = no limit): " + str(_settings.get("timeout",0)))
+	print("(STATEMENTS) Maximum number of prepared statements kept: " + str(_settings.get("statements",64)) + " (" + statementStats() + ")")
+	print("(HOLD) Keep prepared statements after a COMMIT: " + _settings.get("hold","OFF"))
+	print("(FETCHSIZE) Rows read from a result set at a time: " + str(_settings.get("fetchsize",0)))
+	print("(PREFETCH) Fetch the next block of rows while the current one is read: " + _settings.get("prefetch","OFF"))
+	print("(CACHE) Reuse the results of identical queries: " + _settings.get("cache","OFF") + " (" + resultStats() + ")")
+	print("(CACHETTL) Seconds a cached result is reused for: " + str(_settings.get("cachettl",300)))
+	print("(CACHESIZE) Megabytes of memory used for cached results: " + str(_settings.get("cachesize",256)))
+	print("(CACHEDIR) Directory of the results cached on disk: " + _settings.get("cachedir","db2cache") + " (" + diskStats() + ")")
+	print("(DISKTTL) Seconds a result cached on disk is reused for: " + str(_settings.get("diskttl",86400)))
+	print("(DISKSIZE) Megabytes of disk used for cached results: " + str(_settings.get("disksize",10240)))
+	print("(CATALOG) Keep procedure, table and column information from the catalog: " + _settings.get("catalog","ON") + " (" + catalogStats() + ")")
+
+	return
 
 #
 # Display help (link to documentation)
@@ -333,14 +699,19 @@ def split_string(in_port,splitter=":"):
 
 def parseConnect(inSQL,local_ns):
 	
-	global _settings, _connected
+	global _settings, _connected, _current
 
-	_connected = False
-	
 	cParms = inSQL.split()
 	cnt = 0
+
+	if (len(cParms) > 1 and cParms[1].upper() == 'LIST'):
+		listConnections()
+		return
+
+	_connected = False
 	
 	_settings["ssl"] = ""
+	name = None
 	
 	while cnt < len(cParms):
 		if cParms[cnt].upper() == 'TO':
@@ -442,6 +813,13 @@ def parseConnect(inSQL,local_ns):
 			else:
 				errormsg("No port specified in the CONNECT statement")
 				return
+		elif cParms[cnt].upper() == 'AS':                           
+			if cnt+1 < len(cParms):
+				name = cParms[cnt+1].upper()
+				cnt = cnt + 1
+			else:
+				errormsg("No connection name specified after AS in the CONNECT statement")
+				return				
 		elif cParms[cnt].upper() == 'PASSTHRU':                           
 			if cnt+1 < len(cParms):
 				_settings["passthru"] = cParms[cnt+1]
@@ -450,2151 +828,5380 @@ def parseConnect(inSQL,local_ns):
 				errormsg("No passthru parameters specified in the CONNECT statement")
 				return				
 		elif cParms[cnt].upper() in ('CLOSE','RESET') :
+			closePool()
+			closeAsync()
+			if (_hdbc != None): clearStatements(_hdbc)      # None would free the statements of every connection
 			try:
 				result = ibm_db.close(_hdbc)
 				_hdbi.close()
 			except:
 				pass
+			with _connLock:
+				_connections.pop(_current,None)
+				_current = None
 			success("Connection closed.")          
 			if cParms[cnt].upper() == 'RESET': 
 				_settings["database"] = ''
 			return
 		else:
 			cnt = cnt + 1
+
+	if (name == None):
+		name = _settings.get("database","").upper()
+
+	with _connLock:                                    # Reconnecting with the same name replaces the connection
+		if (_current in _connections):
+			_connections[_current].update(hdbc=_hdbc, hdbi=_hdbi, inlists=_inlists, lastused=time.time())
+		if (name in _connections and name != _current):
+			closeConnection(_connections.pop(name))
+		elif (name == _current):
+			_connections.pop(name,None)
+			_current = None
+			if (_hdbc != None): clearStatements(_hdbc)      # None would free the statements of every connection
+			try:
+				ibm_db.close(_hdbc)
+			except:
+				pass
 					 
-	_ = db2_doConnect()
+	if (db2_doConnect() == True):
+		saveConnection(name)
 
-def db2_doConnect():
-	
-	global _hdbc, _hdbi, _connected
-	global _settings  
+#
+# Named connections. Every successful CONNECT is kept in _connections under its AS name (or the database name)
+# so that a statement can be routed to it with -c name. The notebook connection (_hdbc, _hdbi) is always the
+# current named connection. Idle connections are pinged by a timer so they are not dropped by the server, 
+# and are checked before they are used again.
+#
 
-	if _connected == False: 
-		
-		if len(_settings.get("database","")) == 0:
+_connkeys = ["database","hostname","port","protocol","uid","pwd","ssl","passthru"]
+
+def saveConnection(name):
+
+	# Add the notebook connection to the named connections and make it the current one
+
+	global _current
+
+	with _connLock:
+		_connections[name] = {
+			"settings" : {key: _settings.get(key,"") for key in _connkeys},
+			"hdbc"     : _hdbc,
+			"hdbi"     : _hdbi,
+			"inlists"  : _inlists,
+			"lastused" : time.time()
+		}
+		_current = name
+		trimConnections()
+
+	startKeepalive()
+
+	return
+
+def switchConnection(name):
+
+	# Make a named connection the notebook connection. Returns the name of the previous connection.
+
+	global _hdbc, _hdbi, _inlists, _connected, _current
+
+	with _connLock:
+
+		if (name not in _connections):
+			errormsg(f"There is no connection named {name}. Use CONNECT ... AS {name} to create it.")
 			return False
 
-	dsn = (
-		   "DRIVER={{IBM DB2 ODBC DRIVER}};"
-		   "DATABASE={0};"
-		   "HOSTNAME={1};"
-		   "PORT={2};"
-		   "PROTOCOL=TCPIP;ConnectTimeout=15;"
-		   "UID={3};"
-		   "PWD={4};{5};{6}").format(_settings.get("database",""), 
-								 _settings.get("hostname",""), 
-								 _settings.get("port","50000"), 
-								 _settings.get("uid",""), 
-								 _settings.get("pwd",""),
-								 _settings.get("ssl",""),
-								 _settings.get("passthru",""))
+		if (_current in _connections):
+			_connections[_current].update(hdbc=_hdbc, hdbi=_hdbi, inlists=_inlists, lastused=time.time())
 
-	# Get a database handle (hdbc) and a statement handle (hstmt) for subsequent access to DB2
+		entry = _connections[name]
+		if (checkConnection(entry) == False):
+			errormsg(f"The connection {name} is no longer available.")
+			return False
+
+		previous = _current
+
+		_hdbc = entry["hdbc"]
+		_hdbi = entry["hdbi"]
+		_inlists = entry["inlists"]
+		for key in _connkeys:
+			_settings[key] = entry["settings"][key]
+		entry["lastused"] = time.time()
+		_connected = True
+		_current = name
+
+	return previous
+
+def checkConnection(entry,idle=60,attempts=None):
+
+	#
+	# Make sure a named connection still works before it is used. A connection that has been idle for more
+	# than idle seconds is pinged with a trivial statement. A dead connection is opened again.
+	#
 
 	try:
-		_hdbc  = ibm_db.connect(dsn, "", "")
-	except Exception as err:
-		db2_error(False,True) # errormsg(str(err))
-		_connected = False
-		_settings["database"] = ''
+		alive = ibm_db.active(entry["hdbc"])
+		if (alive == True and time.time() - entry["lastused"] > idle):
+			stmt = ibm_db.exec_immediate(entry["hdbc"],"VALUES 1")
+			ibm_db.free_stmt(stmt)
+	except:
+		alive = False
+
+	if (alive == True):
+		return True
+
+	handles = openConnection(entry["settings"],attempts)
+	if (handles == None):
 		return False
-	
-	try:
-		_hdbi = ibm_db_dbi.Connection(_hdbc)
-	except Exception as err:
-		db2_error(False,True) # errormsg(str(err))
-		_connected = False
-		_settings["database"] = ''
-		return False  
-	
-	_connected = True
-	
-	# Save the values for future use
-	
-	save_settings()
-	
-	success("Connection successful.")
+
+	entry["hdbc"], entry["hdbi"] = handles
+	entry["inlists"] = {}
+	entry["lastused"] = time.time()
+
 	return True
-	
 
-def load_settings():
+def closeConnection(entry):
 
-	# This routine will load the settings from the previous session if they exist
-	
-	global _settings
-	
-	fname = "db2connect.pickle"
+	clearStatements(entry["hdbc"])
 
 	try:
-		with open(fname,'rb') as f: 
-			_settings = pickle.load(f) 
-				
-		_settings["maxgrid"] = 5
-		
-	except: 
+		ibm_db.close(entry["hdbc"])
+	except:
 		pass
-	
+
 	return
 
-def save_settings():
+def trimConnections():
 
-	# This routine will save the current settings if they exist
-	
-	global _settings
-	
-	fname = "db2connect.pickle"
-	
+	# Close the least recently used connections (never the current one) when there are more than CONNECTIONS
+
+	with _connLock:
+		while (len(_connections) > max(1,_settings.get("connections",8))):
+			idle = [name for name in _connections if name != _current]
+			if (len(idle) == 0): break
+			name = min(idle, key=lambda x: _connections[x]["lastused"])
+			closeConnection(_connections.pop(name))
+
+	return
+
+def listConnections():
+
+	with _connLock:
+		if (len(_connections) == 0):
+			print("No connections.")
+		for name, entry in _connections.items():
+			current = "*" if name == _current else " "
+			print(f"{current} {name}: {entry['settings']['database']} on {entry['settings']['hostname']}:{entry['settings']['port']} as {entry['settings']['uid']} (idle {int(time.time()-entry['lastused'])} seconds)")
+
+	return
+
+def startKeepalive(interval=60):
+
+	# Start the timer that keeps the idle named connections alive (if it isn't already running)
+
+	global _keepalive
+
+	if (_keepalive != None and _keepalive.is_alive()): return
+
+	_keepalive = threading.Timer(interval,keepalive,args=(interval,))
+	_keepalive.daemon = True
+	_keepalive.start()
+
+	return
+
+def keepalive(interval,idle=240):
+
+	#
+	# Ping the named connections that are not current and have been idle for longer than idle seconds, so
+	# that firewalls and the server don't drop them. Skipped if a connection is being switched right now.
+	#
+
+	global _keepalive
+
+	if (_connLock.acquire(blocking=False) == True):
+		try:
+			for name, entry in list(_connections.items()):
+				if (name != _current and time.time() - entry["lastused"] > idle):
+					if (checkConnection(entry,0,1) == True):
+						entry["lastused"] = time.time()
+		finally:
+			_connLock.release()
+
+	_keepalive = None
+	if (len(_connections) > 1):
+		startKeepalive(interval)
+
+	return
+
+#
+# Automatic reconnect. When the server or a firewall drops the notebook connection, the next statement
+# would fail with a communication error. The connection is checked before a statement is run if it has
+# been idle, and is opened again (with an exponential backoff between attempts) when a communication
+# error is found. Read-only statements (SELECT, WITH, VALUES) are retried once on the new connection;
+# anything else is reported, since it may or may not have run before the connection was lost.
+#
+
+_commerrors = ["SQL30081N","SQL30108N","SQL1224N","SQL0900N","SQL1776N","SQL30080N",
+			   "SQLSTATE=08001","SQLSTATE=08003","SQLSTATE=08S01","SQLSTATE=40003"]
+
+def connectionLost(err=None):
+
+	# Check the error (and the last Db2 error messages) for a communication failure
+
+	text = str(err) if err != None else ""
 	try:
-		with open(fname,'wb') as f:
-			pickle.dump(_settings,f)
-			
+		text = text + " " + ibm_db.stmt_errormsg() + " " + ibm_db.conn_errormsg()
 	except:
-		errormsg("Failed trying to write Db2 Configuration Information.")
- 
-	return  
+		pass
+
+	for code in _commerrors:
+		if (code in text):
+			return True
 
-def db2_error(quiet,connect=False):
-	
-	global sqlerror, sqlcode, sqlstate, _environment
-	
 	try:
-		if (connect == False):
-			errmsg = ibm_db.stmt_errormsg().replace('\r',' ')
-			errmsg = errmsg[errmsg.rfind("]")+1:].strip()
-		else:
-			errmsg = ibm_db.conn_errormsg().replace('\r',' ')
-			errmsg = errmsg[errmsg.rfind("]")+1:].strip()
-			
-		sqlerror = errmsg
- 
-		msg_start = errmsg.find("SQLSTATE=")
-		if (msg_start != -1):
-			msg_end = errmsg.find(" ",msg_start)
-			if (msg_end == -1):
-				msg_end = len(errmsg)
-			sqlstate = errmsg[msg_start+9:msg_end]
-		else:
-			sqlstate = "0"
-	
-		msg_start = errmsg.find("SQLCODE=")
-		if (msg_start != -1):
-			msg_end = errmsg.find(" ",msg_start)
-			if (msg_end == -1):
-				msg_end = len(errmsg)
-			sqlcode = errmsg[msg_start+8:msg_end]
+		return ibm_db.active(_hdbc) == False
+	except:
+		return True
+
+def openConnection(settings,attempts=None):
+
+	# Open a connection, waiting 0.5, 1, 2, 4 ... seconds between attempts. Returns (hdbc, hdbi) or None.
+
+	import ibm_db_dbi
+
+	if (attempts == None):
+		attempts = _settings.get("reconnect",5)
+
+	delay = 0.5
+	for attempt in range(max(1,attempts)):
+		if (attempt > 0):
+			time.sleep(delay)
+			delay = min(delay * 2, 30)
+		try:
+			hdbc = ibm_db.connect(buildDSN(settings), "", "")
+			return (hdbc, ibm_db_dbi.Connection(hdbc))
+		except:
+			pass
+
+	return None
+
+def reconnect():
+
+	# Replace the lost notebook connection with a new one. Prepared statements and temporary tables are gone,
+	# so the IN list tables are loaded again (a statement that is retried still refers to them by name). The
+	# autocommit mode and the attributes set on the old connection are set on the new one.
+
+	global _hdbc, _hdbi, _connected, _lastused
+
+	if (_settings.get("reconnect",5) == 0 or len(_settings.get("database","")) == 0):
+		return False
+
+	print("The connection to Db2 was lost. Reconnecting...")
+
+	with _connLock:
+		handles = openConnection(_settings)
+		if (handles == None):
+			errormsg("Unable to reconnect to Db2. Issue a CONNECT statement to connect again.")
+			_connected = False
+			return False
+
+		try:                                                # Read on the client, so the lost connection still has them
+			autocommit = ibm_db.autocommit(_hdbc)
+		except:
+			autocommit = 1
+		attributes = {}
+		for option in (ibm_db.SQL_ATTR_QUERY_TIMEOUT, ibm_db.SQL_ATTR_QUERY_PREFETCH, ibm_db.SQL_ATTR_INFO_APPLNAME):
 			try:
-				sqlcode = int(sqlcode)
+				attributes[option] = ibm_db.get_option(_hdbc,option,1)
 			except:
 				pass
-		else:        
-			sqlcode = 0
-			
-	except:
-		errmsg = "Unknown error."
-		sqlcode = -99999
-		sqlstate = "-99999"
-		sqlerror = errmsg
-		return
-		
-	
-	msg_start = errmsg.find("SQLSTATE=")
-	if (msg_start != -1):
-		msg_end = errmsg.find(" ",msg_start)
-		if (msg_end == -1):
-			msg_end = len(errmsg)
-		sqlstate = errmsg[msg_start+9:msg_end]
-	else:
-		sqlstate = "0"
-		
-	
-	msg_start = errmsg.find("SQLCODE=")
-	if (msg_start != -1):
-		msg_end = errmsg.find(" ",msg_start)
-		if (msg_end == -1):
-			msg_end = len(errmsg)
-		sqlcode = errmsg[msg_start+8:msg_end]
+
 		try:
-			sqlcode = int(sqlcode)
+			ibm_db.close(_hdbc)
 		except:
 			pass
-	else:
-		sqlcode = 0
-	
-	if quiet == True: return
-	
-	if (errmsg == ""): return
 
-	html = '<p><p style="border:2px; border-style:solid; border-color:#FF0000; background-color:#ffe6e6; padding: 1em;">'
-	
-	if (_environment["jupyter"] == True):
-		pdisplay(pHTML(html+errmsg+"</p>"))
-	else:
-		print(errmsg)
-	
-# Print out an error message
+		clearStatements(_hdbc)
+		_hdbc, _hdbi = handles
+		_connected = True
+		_lastused = time.time()
 
-def errormsg(message):
-	
-	global _environment
-	
-	if (message != ""):
-		html = '<p><p style="border:2px; border-style:solid; border-color:#FF0000; background-color:#ffe6e6; padding: 1em;">'
-		if (_environment["jupyter"] == True):
-			pdisplay(pHTML(html + message + "</p>"))     
-		else:
-			print(message)
-	
-def success(message):
-	
-	if (message not in (None,"")):
-		print(message)
-	return   
+		try:
+			ibm_db.autocommit(_hdbc,autocommit == 1)
+		except:
+			pass
+		for option, value in attributes.items():
+			try:
+				ibm_db.set_option(_hdbc,{option: value},1)
+			except:
+				pass
 
-def debug(message,error=False):
-	
-	global _environment
-	
-	if (message in (None,"")):
-		return
-	
-	if (_environment["jupyter"] == True):
-		spacer = "<br>" + "&nbsp;"
-	else:
-		spacer = "\n "
-	
-	lines = message.split('\n')
-	msg = ""
-	indent = 0
-	for line in lines:
-		delta = line.count("(") - line.count(")")
-		if (msg == ""):
-			msg = line
-			indent = indent + delta
-		else:
-			if (delta < 0): indent = indent + delta
-			msg = msg + spacer * (indent*2) + line
-			if (delta > 0): indent = indent + delta    
+		lists = list(_inlists.items())
+		_inlists.clear()
+		for key, table in lists:
+			if (loadList(table,key) == True): _inlists[key] = table
 
-		if (indent < 0): indent = 0
-	if (error == True):        
-		html = '<p><pre style="font-family: monospace; border:2px; border-style:solid; border-color:#FF0000; background-color:#ffe6e6; padding: 1em;">'                  
-	else:
-		html = '<p><pre style="font-family: monospace; border:2px; border-style:solid; border-color:#008000; background-color:#e6ffe6; padding: 1em;">'
+		if (_current in _connections):
+			_connections[_current].update(hdbc=_hdbc, hdbi=_hdbi, inlists=_inlists, lastused=_lastused)
 
-	if (_environment["jupyter"] == True):
-		pdisplay(pHTML(html + msg + "</pre></p>"))
-	else:
-		print(msg)
-		
-	return 
+	success(f"Reconnected with AUTOCOMMIT {'ON' if autocommit == 1 else 'OFF'} restored. Any uncommitted work was rolled back.")
+	return True
 
-def setMacro(inSQL,parms):
-	  
-	global _macros
-	
-	names = parms.split()
-	if (len(names) < 2):
-		errormsg("No command name supplied.")
-		return None
-	
-	macroName = names[1].upper()
-	_macros[macroName] = inSQL # inSQL.replace("\t"," ")
+def checkCurrent(idle=60):
 
-	return
+	# Ping the notebook connection if it has been idle for more than idle seconds and reconnect if it is gone
 
-def checkMacro(in_sql):
-	   
-	global _macros
-	
-	if (len(in_sql) == 0): return(in_sql)          # Nothing to do 
-	
-	tokens = parseArgs(in_sql,None)                # Take the string and reduce into tokens
-	
-	macro_name = tokens[0].upper()                 # Uppercase the name of the token
- 
-	if (macro_name not in _macros): 
-		return(in_sql) # No macro by this name so just return the string
+	global _lastused
 
-	result = runMacro(_macros[macro_name],in_sql,tokens)  # Execute the macro using the tokens we found
+	if (time.time() - _lastused > idle):
+		try:
+			alive = ibm_db.active(_hdbc)
+			if (alive == True):
+				stmt = ibm_db.exec_immediate(_hdbc,"VALUES 1")
+				ibm_db.free_stmt(stmt)
+		except:
+			alive = False
 
-	return(result)                                 # Runmacro will either return the original SQL or the new one
+		if (alive == False):
+			return reconnect()
 
-def splitassign(arg):
-	
-	var_name = "null"
-	var_value = "null"
-	
-	arg = arg.strip()
-	eq = arg.find("=")
-	if (eq != -1):
-		var_name = arg[:eq].strip()
-		temp_value = arg[eq+1:].strip()
-		if (temp_value != ""):
-			ch = temp_value[0]
-			if (ch in ["'",'"']):
-				if (temp_value[-1:] == ch):
-					var_value = temp_value[1:-1]
-				else:
-					var_value = temp_value
-			else:
-				var_value = temp_value
-	else:
-		var_value = arg
+	_lastused = time.time()
 
-	return var_name, var_value
+	return True
 
-def parseArgs(argin,_vars):
+def sqlKeyword(sql):
 
-	quoteChar = ""
-	blockChar = ""
-	inQuote = False
-	inBlock = False
-	inArg = True
-	args = []
-	arg = ''
+	# The first word of a statement (upper case), skipping blanks, line breaks and opening parentheses
 
-	for ch in argin.lstrip():
-		if (inBlock == True):
-			if (ch == ")"):
-				inBlock = False
-				arg = arg + ch
-			else:
-				arg = arg + ch
-		elif (inQuote == True):
-			if (ch == quoteChar):
-				inQuote = False   
-				arg = arg + ch #z
-			else:
-				arg = arg + ch
-		elif (ch == "("): # Do we have a block
-			arg = arg + ch
-			inBlock = True
-		elif (ch == "\"" or ch == "\'"): # Do we have a quote
-			quoteChar = ch
-			arg = arg + ch #z
-			inQuote = True
-		elif (ch == " "):
-			if (arg != ""):
-				arg = subvars(arg,_vars)
-				args.append(arg)
-			else:
-				args.append("null")
-			arg = ""
-		else:
-			arg = arg + ch
+	match = re.match(r'[\s(]*(\w+)',sql)
+	return match.group(1).upper() if match != None else ""
 
-	if (arg != ""):
-		arg = subvars(arg,_vars)
-		args.append(arg)   
+def isReadOnly(sql):
 
-	return(args)
+	# SELECT, WITH and VALUES can be run again safely unless they wrap an INSERT, UPDATE or DELETE
 
-def runMacro(script,in_sql,tokens):
+	keyword = sqlKeyword(sql)
+	if (keyword not in ("SELECT","WITH","VALUES")):
+		return False
 
-	result = ""
-	runIT = True 
-	code = script.split("\n")
-	level = 0
-	runlevel = [True,False,False,False,False,False,False,False,False,False]
-	ifcount = 0
-	flags = ""
-	_vars = {}
+	return re.search(r"\b(FINAL|NEW|OLD)\s+TABLE\b",sql,flags=re.I) == None
 
-	for i in range(0,len(tokens)):
-		vstr = str(i)
-		_vars[vstr] = tokens[i]
+def prepareStatement(sql,cache=True):
 
-	if (len(tokens) == 0):
-		_vars["argc"] = "0"
+	#
+	# Return the prepared statement for the SQL. Statements run by %sql are kept in the statement cache so 
+	# running the same text again (in a loop for instance) executes the cached handle without preparing it.
+	# The statement is prepared again once if the connection was lost.
+	#
+
+	stmtID = lookupStatement(_hdbc,sql,True) if cache == True else None
+	if (stmtID != None):
+		stmt = findStatement(stmtID)
+		try:
+			ibm_db.free_result(stmt)                            # Close the cursor of the previous run
+		except:
+			pass
+		return stmt
+
+	read = isReadOnly(sql)
+
+	try:
+		stmt = prepareRead(_hdbc,sql) if read else ibm_db.prepare(_hdbc,sql)
+	except Exception as err:
+		if (connectionLost(err) == False or reconnect() == False):
+			raise
+		stmt = prepareRead(_hdbc,sql) if read else ibm_db.prepare(_hdbc,sql)
+
+	if (cache == True and stmt != False):
+		cacheStatement(_hdbc,sql,stmt,True)
+
+	return stmt
+
+def executeStatement(stmt,sql):
+
+	# Execute a prepared statement. A read-only statement is prepared and run again if the connection was lost.
+
+	try:
+		result = interruptible(ibm_db.execute,stmt,handle=stmt)
+	except Exception as err:
+		result = False
+		lost = connectionLost(err)
 	else:
-		_vars["argc"] = str(len(tokens)-1)
+		lost = (result == False and connectionLost())
 
-	for line in code:
-		line = line.strip()
-		if (line == "" or line == "\n"): continue
-		if (line[0] == "#"): continue    # A comment line starts with a # in the first position of the line
-		args = parseArgs(line,_vars)     # Get all of the arguments
-		if (args[0] == "if"):
-			ifcount = ifcount + 1
-			if (runlevel[level] == False): # You can't execute this statement
-				continue
-			level = level + 1    
-			if (len(args) < 4):
-				print("Macro: Incorrect number of arguments for the if clause.")
-				return in_sql
-			arg1 = args[1]
-			arg2 = args[3]
-			if (len(arg2) > 2):
-				ch1 = arg2[0]
-				ch2 = arg2[-1:]
-				if (ch1 in ['"',"'"] and ch1 == ch2):
-					arg2 = arg2[1:-1].strip()
+	if (lost == True):
+		if (reconnect() == True and isReadOnly(sql) == True):
+			stmt = prepareStatement(sql)
+			result = interruptible(ibm_db.execute,stmt,handle=stmt)
+	elif (result == False and staleStatement(stmt) == True):
+		stmt = prepareStatement(sql)                           # A cached statement Db2 no longer accepts
+		result = interruptible(ibm_db.execute,stmt,handle=stmt)
 
-			op   = args[2]
-			if (op in ["=","=="]):
-				if (arg1 == arg2):
-					runlevel[level] = True
-				else:
-					runlevel[level] = False                
-			elif (op in ["<=","=<"]):
-				if (arg1 <= arg2):
-					runlevel[level] = True
-				else:
-					runlevel[level] = False                
-			elif (op in [">=","=>"]):                    
-				if (arg1 >= arg2):
-					runlevel[level] = True
-				else:
-					runlevel[level] = False                                       
-			elif (op in ["<>","!="]):                    
-				if (arg1 != arg2):
-					runlevel[level] = True
-				else:
-					runlevel[level] = False  
-			elif (op in ["<"]):
-				if (arg1 < arg2):
-					runlevel[level] = True
-				else:
-					runlevel[level] = False                
-			elif (op in [">"]):
-				if (arg1 > arg2):
-					runlevel[level] = True
-				else:
-					runlevel[level] = False                
-			else:
-				print("Macro: Unknown comparison operator in the if statement:" + op)
+	return stmt, result
 
-				continue
+def staleStatement(stmt):
 
-		elif (args[0] in ["exit","echo"] and runlevel[level] == True):
-			msg = ""
-			for msgline in args[1:]:
-				if (msg == ""):
-					msg = subvars(msgline,_vars)
-				else:
-					msg = msg + " " + subvars(msgline,_vars)
-			if (msg != ""): 
-				if (args[0] == "echo"):
-					debug(msg,error=False)
-				else:
-					debug(msg,error=True)
-			if (args[0] == "exit"): return ''
+	# Remove a cached statement that has to be prepared again (SQL0514N, SQL0518N) from the cache
 
-		elif (args[0] == "pass" and runlevel[level] == True):
-			pass
+	try:
+		errmsg = ibm_db.stmt_errormsg()
+	except:
+		return False
 
-		elif (args[0] == "flags" and runlevel[level] == True):
-			if (len(args) > 1):
-				for i in range(1,len(args)):
-					flags = flags + " " + args[i]
-				flags = flags.strip()
+	if ("SQL0514N" not in errmsg and "SQL0518N" not in errmsg):
+		return False
 
-		elif (args[0] == "var" and runlevel[level] == True):
-			value = ""
-			for val in args[2:]:
-				if (value == ""):
-					value = subvars(val,_vars)
-				else:
-					value = value + " " + subvars(val,_vars)
-			value.strip()
-			_vars[args[1]] = value 
+	for stmtID, entry in list(_statements.items()):
+		if (entry["stmt"] is stmt):
+			dropStatement(stmtID)
+			return True
 
-		elif (args[0] == 'else'):
+	return False
 
-			if (ifcount == level):
-				runlevel[level] = not runlevel[level]
+def pandasTypes(stmt):
 
-		elif (args[0] == 'return' and runlevel[level] == True):
-			return(f"{flags} {result}")
+	# The pandas datatypes that mimic the Db2 column types of a statement (None before pandas 1.3)
 
-		elif (args[0] == "endif"):
-			ifcount = ifcount - 1
-			if (ifcount < level):
-				level = level - 1
-				if (level < 0):
-					print("Macro: Unmatched if/endif pairs.")
-					return ''
+	if (_pandas_dtype == False):
+		return None
 
-		else:
-			if (runlevel[level] == True):
-				if (result == ""):
-					result = subvars(line,_vars)
-				else:
-					result = result + "\n" + subvars(line,_vars)
+	columns, types = getColumns(stmt)
+	pd_dtypes={}
+	for idx, col in enumerate(columns):
+		try:
+			_dindex = _db2types.index(types[idx])
+		except:
+			_dindex = 0
 
-	return(f"{flags} {result}")      
+		pd_dtypes[col] = _pdtypes[_dindex]
 
-def subvars(script,_vars):
-	
-	if (_vars == None): return script
-	
-	remainder = script
-	result = ""
-	done = False
-	
-	while done == False:
-		bv = remainder.find("{")
-		if (bv == -1):
-			done = True
-			continue
-		ev = remainder.find("}")
-		if (ev == -1):
-			done = True
-			continue
-		result = result + remainder[:bv]
-		vvar = remainder[bv+1:ev].strip()
-		remainder = remainder[ev+1:]
-		
-		modifier = ""
-		
-		if (len(vvar) == 0):
-			errormsg(f"No variable name supplied in the braces {{}}")
-			return script
-		
-		upper = False
-		allvars = False
-		concat = " "
-		
-		if (len(vvar) > 1):
-			modifier = vvar[0]
-			if (modifier == "^"):
-				upper = True
-				vvar = vvar[1:]
-			elif (modifier == "*"):
-				vvar = vvar[1:]
-				allvars = True
-				concat = " "
-			elif (vvar[0] == ","):
-				vvar = vvar[1:]
-				allvars = True
-				concat = ","
-			else:
-				pass
-		
-		if (vvar in _vars):
-			if (upper == True):
-				items = _vars[vvar].upper()
-			elif (allvars == True):
+	if len(pd_dtypes.keys()) == 0:
+		pd_dtypes = None
+
+	return pd_dtypes
+
+def readSQL(stmt,sql,pd_dtypes=None):
+
+	# Run a prepared query into a DataFrame. A read-only query is run again if the connection was lost.
+
+	for attempt in (1,2):
+		setPrefetch(stmt,prefetchOn())
+		stmt, result = executeStatement(stmt,sql)
+		if (result == False):
+			raise Exception("Execute failed")
+		try:
+			return interruptible(fetchFrame,stmt,pd_dtypes,fetchSize(),handle=stmt)
+		except Exception as err:
+			if (attempt == 2 or connectionLost(err) == False or reconnect() == False or isReadOnly(sql) == False):
+				raise
+		stmt = prepareStatement(sql)
+
+def fetchFrame(stmt,pd_dtypes=None,fetchsize=0):
+
+	# Fetch the rows of an executed statement into a DataFrame (the same way that read_sql_query builds it)
+
+	columns, types = getColumns(stmt)
+
+	rows = convertRows(fetchRows(stmt,fetchsize),columnConverters(types))
+
+	df = pandas.DataFrame.from_records(rows,columns=columns,coerce_float=True)
+	if (pd_dtypes != None):
+		df = df.astype(pd_dtypes)
+
+	return df
+
+def columnConverters(types):
+
+	#
+	# The conversions ibm_db_dbi applies to the values ibm_db returns (_fix_return_data_type): DECIMAL and 
+	# DECFLOAT values come back as strings and become Decimals (which coerce_float then turns into floats, as
+	# read_sql_query did), and BLOBs become memoryviews. Returns (column index, function) pairs.
+	#
+
+	import decimal
+
+	converters = []
+	for idx, coltype in enumerate(types or []):
+		if (coltype in ("decimal","decfloat16","decfloat34")):
+			converters.append((idx,lambda v: decimal.Decimal(str(v).replace(",","."))))
+		elif (coltype == "blob"):
+			converters.append((idx,memoryview))
+
+	return converters
+
+def convertRows(rows,converters):
+
+	# Apply the column conversions to each row (a list of tuples is returned)
+
+	if (len(converters) == 0):
+		return list(rows)
+
+	converted = []
+	for row in rows:
+		row = list(row)
+		for idx, convert in converters:
+			if (row[idx] is not None):
+				row[idx] = convert(row[idx])
+		converted.append(tuple(row))
+
+	return converted
+
+#
+# Fetch tuning. Queries are prepared with forward-only, read-only cursors, so Db2 can send the rows in 
+# blocks rather than one at a time. OPTION PREFETCH ON (or -prefetch) has the client ask for the next block
+# while the current one is being read, and OPTION FETCHSIZE n (or -fetchsize n) reads the rows n at a time
+# with ibm_db.fetchmany instead of making one call per row. The cursor attributes have to be set before the
+# statement is prepared. Prefetch is set on the statement (or the connection for CALL) before it is run.
+#
+
+_SQL_ATTR_CONCURRENCY = 7                       # ODBC values that ibm_db doesn't export
+_SQL_CONCUR_READ_ONLY = 1
+
+def fetchOptions():
+
+	return {ibm_db.SQL_ATTR_CURSOR_TYPE: ibm_db.SQL_CURSOR_FORWARD_ONLY, _SQL_ATTR_CONCURRENCY: _SQL_CONCUR_READ_ONLY}
+
+def prepareRead(hdbc,sql):
+
+	# Prepare a query with the fetch options, or without them if the driver doesn't accept them
+
+	try:
+		return ibm_db.prepare(hdbc,sql,fetchOptions())
+	except:
+		return ibm_db.prepare(hdbc,sql)
+
+def prefetchOn():
+
+	return flag("-prefetch") or _settings.get("prefetch","OFF") == "ON"
+
+def setPrefetch(handle,prefetch,connection=False):
+
+	try:
+		ibm_db.set_option(handle,{ibm_db.SQL_ATTR_QUERY_PREFETCH: 1 if prefetch else 0},1 if connection else 0)
+	except:
+		pass
+
+	return
+
+def fetchSize():
+
+	# Rows read per call (0 or 1 = one row at a time)
+
+	try:
+		return max(0,int(flagValue("-fetchsize",_settings.get("fetchsize",0))))
+	except:
+		return 0
+
+def fetchRows(stmt,fetchsize=0):
+
+	# Generator that returns the rows of a result set as tuples
+
+	if (fetchsize > 1 and hasattr(ibm_db,"fetchmany")):
+		while True:
+			rows = ibm_db.fetchmany(stmt,fetchsize)
+			if (rows in (None,False) or len(rows) == 0): return
+			for row in rows:
+				yield tuple(row)
+	else:
+		row = ibm_db.fetch_tuple(stmt)
+		while (row):
+			yield row
+			row = ibm_db.fetch_tuple(stmt)
+
+#
+# Statement timeouts and interrupts. The Db2 query timeout (OPTION TIMEOUT or -querytimeout) is set on the 
+# notebook connection so it applies to every statement the cell runs, and the connection's previous value is
+# put back when the command is done (-timeout is the separate wall-clock limit of a parallel query). A 
+# Jupyter interrupt (SIGINT) is only seen by Python once ibm_db returns, so execute and fetch are run in a
+# helper thread while the notebook waits. An interrupt then cancels the statement on the server 
+# (WLM_CANCEL_ACTIVITY from a second connection, found by the application name of the notebook connection)
+# and the statement handle is freed when Db2 returns. A second interrupt stops waiting.
+#
+
+_interruptPool = None
+_timeoutRestore = []                           # (connection, query timeout) to put back after the command
+_applnameSet = None                            # The notebook connection that was given its application name
+
+def statementTimeout():
+
+	# The query timeout in seconds for the statements of this cell (0 = no limit)
+
+	try:
+		return max(0,int(float(flagValue("-querytimeout",_settings.get("timeout",0)))))
+	except:
+		return 0
+
+def setTimeout(hdbc,timeout=None):
+
+	global _applnameSet
+
+	if (timeout == None):
+		timeout = statementTimeout()
+
+	if (hdbc != None and any(saved is hdbc for saved, _ in _timeoutRestore) == False):
+		try:
+			previous = int(ibm_db.get_option(hdbc,ibm_db.SQL_ATTR_QUERY_TIMEOUT,1))
+		except:
+			previous = _settings.get("timeout",0)
+		_timeoutRestore.append((hdbc,previous))
+
+	if (hdbc != None and hdbc is not _applnameSet):         # Once per connection, so cancelStatement can find it
+		try:
+			ibm_db.set_option(hdbc,{ibm_db.SQL_ATTR_INFO_APPLNAME: workerTag()+"nb"},1)
+			_applnameSet = hdbc
+		except:
+			pass
+
+	try:
+		ibm_db.set_option(hdbc,{ibm_db.SQL_ATTR_QUERY_TIMEOUT: timeout},1)
+	except:
+		pass
+
+	return
+
+def restoreTimeout():
+
+	# Put back the query timeout the connections had before the command set its own
+
+	while (len(_timeoutRestore) > 0):
+		hdbc, previous = _timeoutRestore.pop()
+		try:
+			ibm_db.set_option(hdbc,{ibm_db.SQL_ATTR_QUERY_TIMEOUT: previous},1)
+		except:
+			pass
+
+	return
+
+def interruptible(function,*args,handle=None,**kwargs):
+
+	# Run function(*args, **kwargs) on the notebook connection so that an interrupt cancels it in Db2
+
+	global _interruptPool
+
+	import concurrent.futures
+
+	if (_interruptPool == None):
+		_interruptPool = concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix="db2interrupt")
+
+	setTimeout(_hdbc)
+
+	future = _interruptPool.submit(function,*args,**kwargs)
+
+	try:
+		return waitFor(future)
+	except KeyboardInterrupt:
+		pass
+
+	print("Interrupted. Cancelling the statement in Db2...")
+	cancelled = cancelStatement(workerTag()+"nb")
+	if (cancelled == 0 and future.done() == False):
+		errormsg("The statement could not be cancelled in Db2 (this requires the WLMADM or DBADM authority).")
+
+	# The handle of a cancelled statement is freed, but not one that completed (the caller reads its results)
+	# or one that the db2interrupt thread is still using
+
+	try:
+		return waitFor(future)
+	except KeyboardInterrupt:
+		_interruptPool = None                           # The thread is left behind waiting for Db2
+		errormsg("Stopped waiting for the statement. Use CONNECT RESET and CONNECT to get a new connection if the next statement doesn't run.")
+		if (handle != None and future.done() == True):
+			releaseStatement(handle)
+		raise
+	except Exception:
+		if (handle != None):
+			releaseStatement(handle)
+		raise
+
+def waitFor(future):
+
+	# Short waits so the interrupt is seen right away
+
+	import concurrent.futures
+
+	while True:
+		try:
+			return future.result(timeout=0.25)
+		except concurrent.futures.TimeoutError:
+			continue
+
+def cancelStatement(applname):
+
+	# Cancel what the notebook connection is running from a second, short lived connection
+
+	handles = openConnection(_settings,1)
+	if (handles == None):
+		return 0
+
+	try:
+		return cancelActivities(handles[0],applname)
+	finally:
+		try:
+			ibm_db.close(handles[0])
+		except:
+			pass
+
+def db2_doConnect():
+	
+	global _hdbc, _hdbi, _connected, _inlists, _lastused
+	global _settings  
+
+	if _connected == False: 
+		
+		if len(_settings.get("database","")) == 0:
+			return False
+
+	dsn = buildDSN(_settings)
+
+	# Get a database handle (hdbc) and a statement handle (hstmt) for subsequent access to DB2
+
+	try:
+		_hdbc  = ibm_db.connect(dsn, "", "")
+	except Exception as err:
+		db2_error(False,True) # errormsg(str(err))
+		_connected = False
+		_settings["database"] = ''
+		return False
+	
+	try:
+		import ibm_db_dbi
+		_hdbi = ibm_db_dbi.Connection(_hdbc)
+	except Exception as err:
+		db2_error(False,True) # errormsg(str(err))
+		_connected = False
+		_settings["database"] = ''
+		return False  
+	
+	_connected = True
+	_lastused = time.time()
+	_inlists = {}                               # Temporary tables belong to the previous connection
+	
+	# Save the values for future use
+	
+	save_settings()
+	
+	success("Connection successful.")
+	return True
+	
+
+def buildDSN(settings):
+
+	# Create the connection string used by the notebook connection and the parallel workers
+
+	dsn = (
+		   "DRIVER={{IBM DB2 ODBC DRIVER}};"
+		   "DATABASE={0};"
+		   "HOSTNAME={1};"
+		   "PORT={2};"
+		   "PROTOCOL=TCPIP;ConnectTimeout=15;"
+		   "UID={3};"
+		   "PWD={4};{5};{6}").format(settings.get("database",""), 
+								 settings.get("hostname",""), 
+								 settings.get("port","50000"), 
+								 settings.get("uid",""), 
+								 settings.get("pwd",""),
+								 settings.get("ssl",""),
+								 settings.get("passthru",""))
+
+	return dsn
+
+#
+# Settings store. The options and the connection profiles (one per connection name) are kept in 
+# db2connect.json, and the user ids and passwords in db2credentials.json so they are only rewritten when 
+# they change. save_settings only marks the settings as changed and they are written a second later, so a
+# burst of changes is a single write, and when the kernel shuts down. Files are written to a temporary file
+# that is renamed over the old one, so another kernel never reads a partly written file. Nothing is read 
+# until the first %sql command.
+#
+
+_settingsFile = "db2connect.json"
+_credentialsFile = "db2credentials.json"
+_credentialkeys = ["uid","pwd"]
+_settingsLoaded = False
+_settingsTimer = None
+_settingsChanged = False
+_settingsLock = threading.Lock()
+
+def load_settings():
+
+	# This routine will load the settings from the previous session if they exist
+	
+	global _settings, _settingsLoaded
+
+	_settingsLoaded = True
+
+	stored = readJSON(_settingsFile)
+	if (stored == None): return
+
+	name = stored.get("current","")
+	credentials = readJSON(_credentialsFile) or {}
+
+	_settings.update(stored.get("options",{}))
+	_settings.update(stored.get("profiles",{}).get(name,{}))
+	_settings.update(credentials.get(name,{}))
+	_settings["maxgrid"] = 5
+	
+	return
+
+def save_settings(delay=1.0):
+
+	# Write the settings after delay seconds (unless a write is already waiting)
+	
+	global _settingsTimer, _settingsChanged
+
+	with _settingsLock:
+		_settingsChanged = True
+		if (_settingsTimer != None): return
+		_settingsTimer = threading.Timer(delay,flush_settings)
+		_settingsTimer.daemon = True
+		_settingsTimer.start()
+ 
+	return  
+
+def flush_settings():
+
+	# Write the settings now. Profiles saved by other notebooks in this directory are kept.
+
+	global _settingsTimer, _settingsChanged
+
+	with _settingsLock:
+		if (_settingsTimer != None):
+			_settingsTimer.cancel()
+			_settingsTimer = None
+		if (_settingsChanged == False): return
+		_settingsChanged = False
+		settings = dict(_settings)                  # The timer thread works on a copy while the notebook goes on
+
+	profiles = {}
+	with _connLock:
+		for name, entry in _connections.items():
+			profiles[name] = dict(entry["settings"])
+	current = _current if _current != None else settings.get("database","")
+	if (current != ""):
+		profiles[current] = {key: settings.get(key,"") for key in _connkeys}
+
+	stored = readJSON(_settingsFile) or {}
+	credentials = readJSON(_credentialsFile) or {}
+
+	saved = dict(credentials)
+	for name, profile in profiles.items():
+		credentials[name] = {key: profile.get(key,"") for key in _credentialkeys}
+		profiles[name] = {key: value for key, value in profile.items() if key not in _credentialkeys}
+
+	stored["options"] = {key: value for key, value in settings.items() if key not in _connkeys}
+	stored["profiles"] = {**stored.get("profiles",{}), **profiles}
+	stored["current"] = current
+
+	try:
+		writeJSON(_settingsFile,stored)
+		if (credentials != saved):
+			writeJSON(_credentialsFile,credentials)
+	except:
+		errormsg("Failed trying to write Db2 Configuration Information.")
+
+	return
+
+def readJSON(fname):
+
+	try:
+		with open(fname,'r') as f:
+			return json.load(f)
+	except:
+		return None
+
+def writeJSON(fname,data):
+
+	# Write to a temporary file (only readable by the owner) in the same directory and rename it
+
+	import os
+	import tempfile
+
+	folder = os.path.dirname(os.path.abspath(fname))
+	fd, tempname = tempfile.mkstemp(dir=folder,prefix=".db2magic",suffix=".tmp")
+	try:
+		with os.fdopen(fd,'w') as f:
+			json.dump(data,f,indent=2)
+		os.replace(tempname,fname)
+	except:
+		try:
+			os.remove(tempname)
+		except:
+			pass
+		raise
+
+	return
+
+def db2_error(quiet,connect=False):
+	
+	global sqlerror, sqlcode, sqlstate, _environment
+	
+	try:
+		if (connect == False):
+			errmsg = ibm_db.stmt_errormsg().replace('\r',' ')
+			errmsg = errmsg[errmsg.rfind("]")+1:].strip()
+		else:
+			errmsg = ibm_db.conn_errormsg().replace('\r',' ')
+			errmsg = errmsg[errmsg.rfind("]")+1:].strip()
+			
+		sqlerror = errmsg
+ 
+		msg_start = errmsg.find("SQLSTATE=")
+		if (msg_start != -1):
+			msg_end = errmsg.find(" ",msg_start)
+			if (msg_end == -1):
+				msg_end = len(errmsg)
+			sqlstate = errmsg[msg_start+9:msg_end]
+		else:
+			sqlstate = "0"
+	
+		msg_start = errmsg.find("SQLCODE=")
+		if (msg_start != -1):
+			msg_end = errmsg.find(" ",msg_start)
+			if (msg_end == -1):
+				msg_end = len(errmsg)
+			sqlcode = errmsg[msg_start+8:msg_end]
+			try:
+				sqlcode = int(sqlcode)
+			except:
+				pass
+		else:        
+			sqlcode = 0
+			
+	except:
+		errmsg = "Unknown error."
+		sqlcode = -99999
+		sqlstate = "-99999"
+		sqlerror = errmsg
+		return
+		
+	
+	msg_start = errmsg.find("SQLSTATE=")
+	if (msg_start != -1):
+		msg_end = errmsg.find(" ",msg_start)
+		if (msg_end == -1):
+			msg_end = len(errmsg)
+		sqlstate = errmsg[msg_start+9:msg_end]
+	else:
+		sqlstate = "0"
+		
+	
+	msg_start = errmsg.find("SQLCODE=")
+	if (msg_start != -1):
+		msg_end = errmsg.find(" ",msg_start)
+		if (msg_end == -1):
+			msg_end = len(errmsg)
+		sqlcode = errmsg[msg_start+8:msg_end]
+		try:
+			sqlcode = int(sqlcode)
+		except:
+			pass
+	else:
+		sqlcode = 0
+	
+	if quiet == True: return
+	
+	if (errmsg == ""): return
+
+	html = '<p><p style="border:2px; border-style:solid; border-color:#FF0000; background-color:#ffe6e6; padding: 1em;">'
+	
+	if (_environment["jupyter"] == True):
+		pdisplay(pHTML(html+errmsg+"</p>"))
+	else:
+		print(errmsg)
+	
+# Print out an error message
+
+def errormsg(message):
+	
+	global _environment
+	
+	if (message != ""):
+		html = '<p><p style="border:2px; border-style:solid; border-color:#FF0000; background-color:#ffe6e6; padding: 1em;">'
+		if (_environment["jupyter"] == True):
+			pdisplay(pHTML(html + message + "</p>"))     
+		else:
+			print(message)
+	
+def success(message):
+	
+	if (message not in (None,"")):
+		print(message)
+	return   
+
+def debug(message,error=False):
+	
+	global _environment
+	
+	if (message in (None,"")):
+		return
+	
+	if (_environment["jupyter"] == True):
+		spacer = "<br>" + "&nbsp;"
+	else:
+		spacer = "\n "
+	
+	lines = message.split('\n')
+	msg = ""
+	indent = 0
+	for line in lines:
+		delta = line.count("(") - line.count(")")
+		if (msg == ""):
+			msg = line
+			indent = indent + delta
+		else:
+			if (delta < 0): indent = indent + delta
+			msg = msg + spacer * (indent*2) + line
+			if (delta > 0): indent = indent + delta    
+
+		if (indent < 0): indent = 0
+	if (error == True):        
+		html = '<p><pre style="font-family: monospace; border:2px; border-style:solid; border-color:#FF0000; background-color:#ffe6e6; padding: 1em;">'                  
+	else:
+		html = '<p><pre style="font-family: monospace; border:2px; border-style:solid; border-color:#008000; background-color:#e6ffe6; padding: 1em;">'
+
+	if (_environment["jupyter"] == True):
+		pdisplay(pHTML(html + msg + "</pre></p>"))
+	else:
+		print(msg)
+		
+	return 
+
+def setMacro(inSQL,parms):
+	  
+	global _macros
+	
+	names = parms.split()
+	if (len(names) < 2):
+		errormsg("No command name supplied.")
+		return None
+	
+	macroName = names[1].upper()
+	_macros[macroName] = inSQL # inSQL.replace("\t"," ")
+
+	return
+
+def checkMacro(in_sql):
+	   
+	global _macros
+	
+	if (len(in_sql) == 0): return(in_sql)          # Nothing to do 
+	
+	tokens = parseArgs(in_sql,None)                # Take the string and reduce into tokens
+	
+	macro_name = tokens[0].upper()                 # Uppercase the name of the token
+ 
+	if (macro_name not in _macros): 
+		return(in_sql) # No macro by this name so just return the string
+
+	result = runMacro(_macros[macro_name],in_sql,tokens)  # Execute the macro using the tokens we found
+
+	return(result)                                 # Runmacro will either return the original SQL or the new one
+
+def splitassign(arg):
+	
+	var_name = "null"
+	var_value = "null"
+	
+	arg = arg.strip()
+	eq = arg.find("=")
+	if (eq != -1):
+		var_name = arg[:eq].strip()
+		temp_value = arg[eq+1:].strip()
+		if (temp_value != ""):
+			ch = temp_value[0]
+			if (ch in ["'",'"']):
+				if (temp_value[-1:] == ch):
+					var_value = temp_value[1:-1]
+				else:
+					var_value = temp_value
+			else:
+				var_value = temp_value
+	else:
+		var_value = arg
+
+	return var_name, var_value
+
+def parseArgs(argin,_vars):
+
+	quoteChar = ""
+	blockChar = ""
+	inQuote = False
+	inBlock = False
+	inArg = True
+	args = []
+	arg = ''
+
+	for ch in argin.lstrip():
+		if (inBlock == True):
+			if (ch == ")"):
+				inBlock = False
+				arg = arg + ch
+			else:
+				arg = arg + ch
+		elif (inQuote == True):
+			if (ch == quoteChar):
+				inQuote = False   
+				arg = arg + ch #z
+			else:
+				arg = arg + ch
+		elif (ch == "("): # Do we have a block
+			arg = arg + ch
+			inBlock = True
+		elif (ch == "\"" or ch == "\'"): # Do we have a quote
+			quoteChar = ch
+			arg = arg + ch #z
+			inQuote = True
+		elif (ch == " "):
+			if (arg != ""):
+				arg = subvars(arg,_vars)
+				args.append(arg)
+			else:
+				args.append("null")
+			arg = ""
+		else:
+			arg = arg + ch
+
+	if (arg != ""):
+		arg = subvars(arg,_vars)
+		args.append(arg)   
+
+	return(args)
+
+def runMacro(script,in_sql,tokens):
+
+	result = ""
+	runIT = True 
+	code = script.split("\n")
+	level = 0
+	runlevel = [True,False,False,False,False,False,False,False,False,False]
+	ifcount = 0
+	flags = ""
+	_vars = {}
+
+	for i in range(0,len(tokens)):
+		vstr = str(i)
+		_vars[vstr] = tokens[i]
+
+	if (len(tokens) == 0):
+		_vars["argc"] = "0"
+	else:
+		_vars["argc"] = str(len(tokens)-1)
+
+	for line in code:
+		line = line.strip()
+		if (line == "" or line == "\n"): continue
+		if (line[0] == "#"): continue    # A comment line starts with a # in the first position of the line
+		args = parseArgs(line,_vars)     # Get all of the arguments
+		if (args[0] == "if"):
+			ifcount = ifcount + 1
+			if (runlevel[level] == False): # You can't execute this statement
+				continue
+			level = level + 1    
+			if (len(args) < 4):
+				print("Macro: Incorrect number of arguments for the if clause.")
+				return in_sql
+			arg1 = args[1]
+			arg2 = args[3]
+			if (len(arg2) > 2):
+				ch1 = arg2[0]
+				ch2 = arg2[-1:]
+				if (ch1 in ['"',"'"] and ch1 == ch2):
+					arg2 = arg2[1:-1].strip()
+
+			op   = args[2]
+			if (op in ["=","=="]):
+				if (arg1 == arg2):
+					runlevel[level] = True
+				else:
+					runlevel[level] = False                
+			elif (op in ["<=","=<"]):
+				if (arg1 <= arg2):
+					runlevel[level] = True
+				else:
+					runlevel[level] = False                
+			elif (op in [">=","=>"]):                    
+				if (arg1 >= arg2):
+					runlevel[level] = True
+				else:
+					runlevel[level] = False                                       
+			elif (op in ["<>","!="]):                    
+				if (arg1 != arg2):
+					runlevel[level] = True
+				else:
+					runlevel[level] = False  
+			elif (op in ["<"]):
+				if (arg1 < arg2):
+					runlevel[level] = True
+				else:
+					runlevel[level] = False                
+			elif (op in [">"]):
+				if (arg1 > arg2):
+					runlevel[level] = True
+				else:
+					runlevel[level] = False                
+			else:
+				print("Macro: Unknown comparison operator in the if statement:" + op)
+
+				continue
+
+		elif (args[0] in ["exit","echo"] and runlevel[level] == True):
+			msg = ""
+			for msgline in args[1:]:
+				if (msg == ""):
+					msg = subvars(msgline,_vars)
+				else:
+					msg = msg + " " + subvars(msgline,_vars)
+			if (msg != ""): 
+				if (args[0] == "echo"):
+					debug(msg,error=False)
+				else:
+					debug(msg,error=True)
+			if (args[0] == "exit"): return ''
+
+		elif (args[0] == "pass" and runlevel[level] == True):
+			pass
+
+		elif (args[0] == "flags" and runlevel[level] == True):
+			if (len(args) > 1):
+				for i in range(1,len(args)):
+					flags = flags + " " + args[i]
+				flags = flags.strip()
+
+		elif (args[0] == "var" and runlevel[level] == True):
+			value = ""
+			for val in args[2:]:
+				if (value == ""):
+					value = subvars(val,_vars)
+				else:
+					value = value + " " + subvars(val,_vars)
+			value.strip()
+			_vars[args[1]] = value 
+
+		elif (args[0] == 'else'):
+
+			if (ifcount == level):
+				runlevel[level] = not runlevel[level]
+
+		elif (args[0] == 'return' and runlevel[level] == True):
+			return(f"{flags} {result}")
+
+		elif (args[0] == "endif"):
+			ifcount = ifcount - 1
+			if (ifcount < level):
+				level = level - 1
+				if (level < 0):
+					print("Macro: Unmatched if/endif pairs.")
+					return ''
+
+		else:
+			if (runlevel[level] == True):
+				if (result == ""):
+					result = subvars(line,_vars)
+				else:
+					result = result + "\n" + subvars(line,_vars)
+
+	return(f"{flags} {result}")      
+
+def subvars(script,_vars):
+	
+	if (_vars == None): return script
+	
+	remainder = script
+	result = ""
+	done = False
+	
+	while done == False:
+		bv = remainder.find("{")
+		if (bv == -1):
+			done = True
+			continue
+		ev = remainder.find("}")
+		if (ev == -1):
+			done = True
+			continue
+		result = result + remainder[:bv]
+		vvar = remainder[bv+1:ev].strip()
+		remainder = remainder[ev+1:]
+		
+		modifier = ""
+		
+		if (len(vvar) == 0):
+			errormsg(f"No variable name supplied in the braces {{}}")
+			return script
+		
+		upper = False
+		allvars = False
+		concat = " "
+		
+		if (len(vvar) > 1):
+			modifier = vvar[0]
+			if (modifier == "^"):
+				upper = True
+				vvar = vvar[1:]
+			elif (modifier == "*"):
+				vvar = vvar[1:]
+				allvars = True
+				concat = " "
+			elif (vvar[0] == ","):
+				vvar = vvar[1:]
+				allvars = True
+				concat = ","
+			else:
+				pass
+		
+		if (vvar in _vars):
+			if (upper == True):
+				items = _vars[vvar].upper()
+			elif (allvars == True):
+				try:
+					iVar = int(vvar)
+				except:
+					return(script)
+				items = ""
+				sVar = str(iVar)
+				while sVar in _vars:
+					if (items == ""):
+						items = _vars[sVar]
+					else:
+						items = items + concat + _vars[sVar]
+					iVar = iVar + 1
+					sVar = str(iVar)
+			else:
+				items = _vars[vvar]
+		else:
+			if (allvars == True):
+				items = ""
+			else:
+				items = "null"                
+				 
+		result = result + items
+				
+	if (remainder != ""):
+		result = result + remainder
+		
+	return(result)
+
+def splitargs(arguments):
+	
+	import types
+	
+	# String the string and remove the ( and ) characters if they at the beginning and end of the string
+	
+	results = []
+	
+	step1 = arguments.strip()
+	if (len(step1) == 0): return(results)       # Not much to do here - no args found
+	
+	if (step1[0] == '('):
+		if (step1[-1:] == ')'):
+			step2 = step1[1:-1]
+			step2 = step2.strip()
+		else:
+			step2 = step1
+	else:
+		step2 = step1
+			
+	# Now we have a string without brackets. Start scanning for commas
+			
+	quoteCH = ""
+	pos = 0
+	arg = ""
+	args = []
+			
+	while pos < len(step2):
+		ch = step2[pos]
+		if (quoteCH == ""):                     # Are we in a quote?
+			if (ch in ('"',"'")):               # Check to see if we are starting a quote
+				quoteCH = ch
+				arg = arg + ch
+				pos += 1
+			elif (ch == ","):                   # Are we at the end of a parameter?
+				arg = arg.strip()
+				args.append(arg)
+				arg = ""
+				inarg = False 
+				pos += 1
+			else:                               # Continue collecting the string
+				arg = arg + ch
+				pos += 1
+		else:
+			if (ch == quoteCH):                 # Are we at the end of a quote?
+				arg = arg + ch                  # Add the quote to the string
+				pos += 1                        # Increment past the quote
+				quoteCH = ""                    # Stop quote checking (maybe!)
+			else:
+				pos += 1
+				arg = arg + ch
+
+	if (quoteCH != ""):                         # So we didn't end our string
+		arg = arg.strip()
+		args.append(arg)
+	elif (arg != ""):                           # Something left over as an argument
+		arg = arg.strip()
+		args.append(arg)
+	else:
+		pass
+	
+	results = []
+	
+	for arg in args:
+		result = []
+		if (len(arg) > 0):
+			if (arg[0] in ('"',"'")):
+				value = arg[1:-1]
+				isString = True
+				isNumber = False
+			else:
+				isString = False 
+				isNumber = False 
+				try:
+					value = eval(arg)
+					if (type(value) == int):
+						isNumber = True
+					elif (isinstance(value,float) == True):
+						isNumber = True
+					else:
+						value = arg
+				except:
+					value = arg
+
+		else:
+			value = ""
+			isString = False
+			isNumber = False
+			
+		result = [value,isString,isNumber]
+		results.append(result)
+		
+	return results
+
+def createDF(hdbc,hdbi,sqlin,local_ns):
+	
+	import datetime
+	import ibm_db    
+	
+	global sqlcode, _settings
+	
+	NoDF  = False
+	YesDF = True
+	
+	if (hdbc == None or hdbi == None):
+		errormsg("You need to connect to a database before issuing this command.")
+		return NoDF, None
+	
+	# Strip apart the command into tokens based on spaces
+	tokens = sqlin.split()
+	
+	token_count = len(tokens)
+	
+	if (token_count < 5): # Not enough parameters
+		errormsg("Insufficient arguments for USING command")
+		return NoDF, None
+		
+	keyword_command = tokens[0].upper()
+	dfName          = tokens[1]
+	keyword_create  = tokens[2].upper()
+	keyword_table   = tokens[3].upper()
+	table           = tokens[4]           
+	
+	if (dfName not in local_ns):
+		errormsg("The variable ({dfName}) does not exist in the local variable list.")
+		return NoDF, None    
+
+	try:
+		dfValue = eval(dfName,None,local_ns) # globals()[varName] # eval(varName)
+	except:
+		errormsg("The variable ({dfName}) does not contain a value.")
+		return NoDF, None     
+   
+	if (keyword_create in ("SELECT","WITH")):
+		
+		if (loadParallel() == False):
+			errormsg("Parallelism is not availble on this system.")
+			return NoDF, None
+ 
+		thread_count = threadCount()
+		if (thread_count in (0,1)):
+			errormsg("The THREADS option is currently set to 0 or 1 which disables parallelism.")
+			return NoDF, None      
+		
+		ok, df = dfSQL(hdbc,hdbi,sqlin,dfName,dfValue,thread_count)
+		
+		if (ok == False):
+			return NoDF, None
+		else:
+			return YesDF, df
+				
+	if (isinstance(dfValue,pandas.DataFrame) == False): # Not a Pandas dataframe
+		errormsg("The variable ({dfName}) is not a Pandas dataframe.")
+		return NoDF, None
+	
+	if (keyword_create not in ("CREATE","REPLACE","APPEND") or keyword_table != "TABLE"):
+		errormsg("Incorrect syntax: %sql using <df> create table <name> [options]")
+		return NoDF, None
+	
+	if (token_count % 2 != 1):
+		errormsg("Insufficient arguments for USING command.")
+		return NoDF, None
+		
+	flag_withdata = False
+	flag_asis     = False
+	flag_float    = False
+	flag_integer  = False
+	limit         = -1
+		
+	for token_idx in range(5,token_count,2):
+
+		option_key = tokens[token_idx].upper()
+		option_val = tokens[token_idx+1].upper()
+		if (option_key == "WITH" and option_val == "DATA"):
+			flag_withdata = True
+		elif (option_key == "COLUMNS" and option_val == "ASIS"):
+			flag_asis = True
+		elif (option_key == "KEEP" and option_val == "FLOAT64"):
+			flag_float = True
+		elif (option_key == "KEEP" and option_val == "INT64"):
+			flag_integer = True
+		elif (option_key == "LIMIT"):
+			if (option_val.isnumeric() == False):
+				errormsg("The LIMIT must be a valid number from -1 (unlimited) to the maximun number of rows to insert")
+				return NoDF, None
+			limit = int(option_val)
+		else:
+			errormsg("Invalid options. Must be either WITH DATA | COLUMNS ASIS | KEEP FLOAT64 | KEEP FLOAT INT64")
+			return NoDF, None   
+
+	if (keyword_create == "APPEND"):
+		if (checkAppend(hdbc,table,dfValue) == False):
+			return NoDF, None
+
+	if (keyword_create == "REPLACE"):
+		sql = f"DROP TABLE {table}"
+		ok = execSQL(hdbc,sql,quiet=True)   
+
+	sql = [] 
+	columns = dict(dfValue.dtypes)
+	sql.append(f'CREATE TABLE {table} (')
+	datatypes = []
+	comma = ""
+	for column in columns:
+		datatype = str(columns[column])
+		datatype = datatype.upper()
+
+		if (datatype == "OBJECT"):
+			datapoint = dfValue[column][0]
+			if (isinstance(datapoint,datetime.datetime)):
+				type = "TIMESTAMP"
+			elif (isinstance(datapoint,datetime.time)):
+				type = "TIME"
+			elif (isinstance(datapoint,datetime.date)):
+				type = "DATE"
+			elif (isinstance(datapoint,float)):
+				if (flag_float == True):
+					type = "FLOAT"
+				else:
+					type = "DECFLOAT"
+			elif (isinstance(datapoint,int)):
+				if (flag_integer == True):
+					type = "BIGINT"
+				else:
+					type = "INTEGER"
+			elif (isinstance(datapoint,str)):
+				maxlength = dfValue[column].apply(str).apply(len).max()
+				type = f"VARCHAR({maxlength})"
+			else:
+				type = "CLOB"
+		elif (datatype == "INT64"):
+			type = "BIGINT"
+		elif (datatype == "INT32"):
+			type = "INT"
+		elif (datatype == "INT16"):
+			type = "SMALLINT"
+		elif (datatype == "FLOAT64"):
+			if (flag_float == True):
+				type = "FLOAT"
+			else:
+				type = "DECFLOAT"
+		elif (datatype == "FLOAT32"):
+			if (flag_float == True):
+				type = "REAL"
+			else:
+				type = "DECFLOAT"
+		elif ("DATETIME64" in datatype):
+			type = "TIMESTAMP"
+		elif (datatype == "BOOLEAN"):
+			type = "BINARY"
+		elif (datatype == "STRING"):
+			maxlength = dfValue[column].apply(str).apply(len).max()
+			type = f"VARCHAR({maxlength})"
+		else:
+			type = "CLOB"
+			
+		datatypes.append(type)    
+
+		if (flag_asis == False):
+			if (isinstance(column,str) == False):
+				column = str(column)
+			identifier = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
+			column_name = column.strip().upper()
+			new_name = ""
+			for ch in column_name:
+				if (ch not in identifier):
+					new_name = new_name + "_"
+				else:
+					new_name = new_name + ch
+					
+			new_name = new_name.lstrip('_').rstrip('_')
+			
+			if (new_name == "" or new_name[0] not in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"):
+				new_name = f'"{column}"'
+		else:
+			new_name = f'"{column}"'
+		
+		sql.append(f"    {new_name} {type}")
+	sql.append(")")
+
+	sqlcmd = ""
+	for i in range(0,len(sql)):
+		if (i > 0 and i < len(sql)-2):
+			comma = ","
+		else:
+			comma = ""
+		sqlcmd = "{}\n{}{}".format(sqlcmd,sql[i],comma)
+		
+	if (keyword_create != "APPEND"):
+		print(sqlcmd)
+		ok = execSQL(hdbc,sqlcmd,quiet=False)
+		if (ok == False):
+			return NoDF, None
+
+	if (flag_withdata == True or keyword_create == "APPEND"):
+		invalidateResults(f"INSERT INTO {table}")
+		
+		autocommit = ibm_db.autocommit(hdbc)
+		ibm_db.autocommit(hdbc,False)
+
+		row_count = 0
+		insert_sql = ""
+		rows, cols = dfValue.shape
+		for row in range(0,rows):
+ 
+			insert_row = ""
+			for col in range(0, cols):
+				
+				value = dfValue.iloc[row][col]
+				value = str(value)
+				
+				if (value.upper() in ("NAN","<NA>","NAT")):
+					value = "NULL"
+				else:
+					addquotes_flag = False
+					if (datatypes[col] == "CLOB" or "VARCHAR" in datatypes[col]):
+						addquotes_flag = True
+					elif (datatypes[col] in ("TIME","DATE","TIMESTAMP")):
+						addquotes_flag = True
+					elif (datatypes[col] in ("INTEGER","INT","SMALLINT","BIGINT","DECFLOAT","FLOAT","BINARY","REAL")):
+						addquotes_flag = False
+					else:
+						addquotes_flag = True
+						
+					if (addquotes_flag == True):
+						value = addquotes(value,True)
+					  
+				if (insert_row == ""):
+					insert_row = f"{value}"
+				else:
+					insert_row = f"{insert_row},{value}"
+					  
+			if (insert_sql == ""):
+				insert_sql = f"INSERT INTO {table} VALUES ({insert_row})"
+			else:
+				insert_sql = f"{insert_sql},({insert_row})"
+					  
+			row_count += 1
+			if (row_count % 1000 == 0 or row_count == limit):
 				try:
-					iVar = int(vvar)
+					result = ibm_db.exec_immediate(hdbc, insert_sql)                 # Run it 
 				except:
-					return(script)
-				items = ""
-				sVar = str(iVar)
-				while sVar in _vars:
-					if (items == ""):
-						items = _vars[sVar]
+					db2_error(False)
+					return NoDF, None
+
+				ibm_db.commit(hdbc)
+
+				print(f"\r{row_count} of {rows} rows inserted.",end="")
+					
+				insert_sql = ""
+				
+			if (row_count == limit):
+				break
+					  
+		if (insert_sql != ""):
+			try:
+				result = ibm_db.exec_immediate(hdbc, insert_sql)                 # Run it                            
+			except:
+				db2_error(False)       
+				return NoDF, None
+
+			ibm_db.commit(hdbc)
+
+		ibm_db.autocommit(hdbc,autocommit)
+
+		print("\nInsert completed.")
+					  
+	return NoDF, None
+
+def sqlParser(sqlin,local_ns,pushdown=True):
+	   
+	sql_cmd = ""
+	encoded_sql = sqlin
+	
+	firstCommand = "(?:^\s*)([a-zA-Z]+)(?:\s+.*|$)"
+	
+	findFirst = re.match(firstCommand,sqlin)
+	
+	if (findFirst == None): # We did not find a match so we just return the empty string
+		return sql_cmd, encoded_sql
+	
+	cmd = findFirst.group(1)
+	sql_cmd = cmd.upper()
+
+	#
+	# Scan the input string looking for variables in the format :var. If no : is found just return.
+	# Var must be alpha+number+_ to be valid
+	#
+	
+	if (':' not in sqlin): # A quick check to see if parameters are in here, but not fool-proof!         
+		return sql_cmd, encoded_sql    
+	
+	inVar = False 
+	inQuote = "" 
+	varName = ""
+	encoded_sql = ""
+	
+	STRING = 0
+	NUMBER = 1
+	LIST = 2
+	RAW = 3
+	PANDAS = 5
+	
+	for ch in sqlin:
+		if (inVar == True): # We are collecting the name of a variable
+			if (ch.upper() in "@_ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789[]"):
+				varName = varName + ch
+				continue
+			else:
+				if (varName == ""):
+					encode_sql = encoded_sql + ":"
+				elif (varName[0] in ('[',']')):
+					encoded_sql = encoded_sql + ":" + varName
+				else:
+					if (ch == '.'): # If the variable name is stopped by a period, assume no quotes are used
+						flag_quotes = False
+					else:
+						flag_quotes = True
+					varValue, varType = getContents(varName,flag_quotes,local_ns)
+					if (varType != PANDAS and varValue == None):                 
+						encoded_sql = encoded_sql + ":" + varName
+					else:
+						if (varType == STRING):
+							encoded_sql = encoded_sql + varValue
+						elif (varType == NUMBER):
+							encoded_sql = encoded_sql + str(varValue)
+						elif (varType == RAW):
+							encoded_sql = encoded_sql + varValue
+						elif (varType == PANDAS):
+							insertsql = ""
+							coltypes = varValue.dtypes
+							rows, cols = varValue.shape
+							for row in range(0,rows):
+								insertrow = ""
+								for col in range(0, cols):
+									value = varValue.iloc[row][col]
+									if (coltypes[col] == "object"):
+										value = str(value)
+										value = addquotes(value,True)
+									else:
+										strvalue = str(value)
+										if ("NAN" in strvalue.upper()):
+											value = "NULL"    
+									if (insertrow == ""):
+										insertrow = f"{value}"
+									else:
+										insertrow = f"{insertrow},{value}"
+								if (insertsql == ""):
+									insertsql = f"({insertrow})"
+								else:
+									insertsql = f"{insertsql},({insertrow})"  
+							encoded_sql = encoded_sql + insertsql
+						elif (varType == LIST):
+							encoded_sql = encoded_sql + encodeList(varValue,encoded_sql,pushdown)
+
+				encoded_sql = encoded_sql + ch
+				varName = ""
+				inVar = False  
+		elif (inQuote != ""):
+			encoded_sql = encoded_sql + ch
+			if (ch == inQuote): inQuote = ""
+		elif (ch in ("'",'"')):
+			encoded_sql = encoded_sql + ch
+			inQuote = ch
+		elif (ch == ":"): # This might be a variable
+			varName = ""
+			inVar = True
+		else:
+			encoded_sql = encoded_sql + ch
+	
+	if (inVar == True):
+		varValue, varType = getContents(varName,True,local_ns) # We assume the end of a line is quoted
+		if (varType != PANDAS and varValue == None):                 
+			encoded_sql = encoded_sql + ":" + varName  
+		else:
+			if (varType == STRING):
+				encoded_sql = encoded_sql + varValue
+			elif (varType == RAW):
+				encoded_sql = encoded_sql + varValue                
+			elif (varType == NUMBER):
+				encoded_sql = encoded_sql + str(varValue)
+			elif (varType == PANDAS):
+				insertsql = ""
+				coltypes = varValue.dtypes
+				rows, cols = varValue.shape
+				for row in range(0,rows):
+					insertrow = ""
+					for col in range(0, cols):
+						value = varValue.iloc[row][col]
+						if (coltypes[col] == "object"):
+							value = str(value)
+							value = addquotes(value,True)
+						else:
+							strvalue = str(value)
+							if ("NAN" in strvalue.upper()):
+								value = "NULL"    
+						if (insertrow == ""):
+							insertrow = f"{value}"
+						else:
+							insertrow = f"{insertrow},{value}"
+					if (insertsql == ""):
+						insertsql = f"({insertrow})"
+					else:
+						insertsql = f"{insertsql},({insertrow})"  
+				encoded_sql = encoded_sql + insertsql                
+			elif (varType == LIST):
+				encoded_sql = encoded_sql + encodeList(varValue,encoded_sql,pushdown)
+
+	return sql_cmd, encoded_sql
+
+def encodeList(varValue,prefix,pushdown=True):
+
+	#
+	# Convert a Python list into a set of SQL values. Large lists that are used in an IN predicate are
+	# loaded into a temporary table instead so that the SQL text does not contain every value (unless 
+	# pushdown is False because the SQL runs on another connection).
+	#
+
+	if (pushdown == True and re.search(r"\bIN\s*\(\s*$",prefix,flags=re.I) != None):
+		subselect = pushdownList(varValue)
+		if (subselect != None):
+			return subselect
+
+	encoded_sql = ""
+	start = True
+	for v in varValue:
+		if (start == False):
+			encoded_sql = encoded_sql + ","
+		if (isinstance(v,int) == True):         # Integer value 
+			encoded_sql = encoded_sql + str(v)
+		elif (isinstance(v,float) == True):
+			encoded_sql = encoded_sql + str(v)
+		else:
+			try:
+				if (v.find('0x') == 0):               # Just guessing this is a hex value at beginning
+					encoded_sql = encoded_sql + v
+				else:
+					encoded_sql = encoded_sql + addquotes(v,True)      # String
+			except:
+				encoded_sql = encoded_sql + addquotes(str(v),True)                                   
+		start = False
+
+	return encoded_sql
+
+def pushdownList(varValue):
+
+	#
+	# Load the list into a declared global temporary table and return a subselect against it. None is 
+	# returned when the list is below the INLIST threshold or the values can't be loaded, in which case 
+	# the caller expands the values as literals.
+	#
+
+	global _hdbc, _connected, _settings, _inlists
+
+	threshold = _settings.get("inlist",1000)
+	if (threshold <= 0 or len(varValue) <= threshold): return None
+	if (_connected == False or _hdbc == None): return None
+
+	# Determine a column type that matches the way the literals would have been compared
+
+	numbers = True
+	strings = True
+	decimal = False
+	maxlength = 1
+	for v in varValue:
+		if (isinstance(v,bool) == True):
+			return None
+		elif (isinstance(v,int) == True):
+			if (v < -9223372036854775808 or v > 9223372036854775807): return None
+			strings = False
+		elif (isinstance(v,float) == True):
+			if (v != v or abs(v) == float("inf")): return None
+			strings = False
+			decimal = True
+		elif (isinstance(v,str) == True):
+			if (v.find('0x') == 0): return None                    # Hex values are left as literals
+			numbers = False
+			maxlength = max(maxlength,len(v.encode("utf-8")))
+		else:
+			return None
+
+	if (numbers == True):
+		if (decimal == True):
+			coltype = "DECFLOAT(34)"
+			values = tuple(str(v) for v in varValue)
+		else:
+			coltype = "BIGINT"
+			values = tuple(varValue)
+	elif (strings == True and maxlength <= 32672):
+		coltype = f"VARCHAR({maxlength})"
+		values = tuple(varValue)
+	else:
+		return None
+
+	key = (coltype, values)
+	if (key in _inlists):                                      # Same list already loaded in this session
+		return f"SELECT V FROM {_inlists[key]}"
+
+	number = max([int(name[len("SESSION.DB2MAGIC_INLIST"):]) for name in _inlists.values()] + [0]) + 1
+	table = f"SESSION.DB2MAGIC_INLIST{number}"
+
+	if (loadList(table,key) == False):
+		return None                                              # No user temporary tablespace, etc...
+
+	_inlists[key] = table
+
+	return f"SELECT V FROM {table}"
+
+def loadList(table,key):
+
+	# Declare the temporary table of an IN list on the notebook connection and insert the values
+
+	coltype, values = key
+
+	try:
+		ddl = (f"DECLARE GLOBAL TEMPORARY TABLE {table} (V {coltype}) "
+			   "ON COMMIT PRESERVE ROWS NOT LOGGED ON ROLLBACK PRESERVE ROWS WITH REPLACE")
+		ibm_db.exec_immediate(_hdbc, ddl)
+		stmt = ibm_db.prepare(_hdbc, f"INSERT INTO {table} VALUES (?)")
+		ibm_db.execute_many(stmt, tuple((v,) for v in values))
+		ibm_db.free_stmt(stmt)
+	except Exception as err:
+		return False
+
+	return True
+
+def plotData(hdbi, sql):
+	
+	loadPlot()
+
+	try:
+		df = pandas.read_sql(sql,hdbi)
+		  
+	except Exception as err:
+		db2_error(False)
+		return
+				
+		
+	if df.empty:
+		errormsg("No results returned")
+		return
+	
+	col_count = len(df.columns)
+
+	if flag(["-pb","-bar"]):                                    # Plot 1 = bar chart
+	
+		if (col_count in (1,2,3)):
+			
+			if (col_count == 1):
+ 
+				df.index = df.index + 1
+				_ = df.plot(kind='bar');
+				_ = plt.plot();
+				
+			elif (col_count == 2):
+ 
+				xlabel = df.columns.values[0]
+				ylabel = df.columns.values[1]
+				df.plot(kind='bar',x=xlabel,y=ylabel);
+				_ = plt.plot();
+				
+			else:
+ 
+				values = df.columns.values[2]
+				columns = df.columns.values[0]
+				index = df.columns.values[1]
+				pivoted = pandas.pivot_table(df, values=values, columns=columns, index=index) 
+				_ = pivoted.plot.bar(); 
+			
+		else:
+			errormsg("Can't determine what columns to plot")
+			return
+					
+	elif flag(["-pp","-pie"]):                                  # Plot 2 = pie chart
+		
+		if (col_count in (1,2)):  
+				
+			if (col_count == 1):
+				df.index = df.index + 1
+				yname = df.columns.values[0]
+				_ = df.plot(kind='pie',y=yname);                
+			else:          
+				xlabel = df.columns.values[0]
+				xname = df[xlabel].tolist()
+				yname = df.columns.values[1]
+				_ = df.plot(kind='pie',y=yname,labels=xname);
+				
+			plt.show();
+			
+		else:
+			errormsg("Can't determine what columns to plot")
+			return
+					
+	elif flag(["-pl","-line"]):                                  # Plot 3 = line chart
+			
+		if (col_count in (1,2,3)): 
+			
+			if (col_count == 1):
+				df.index = df.index + 1  
+				_ = df.plot(kind='line');          
+			elif (col_count == 2):            
+				xlabel = df.columns.values[0]
+				ylabel = df.columns.values[1]
+				_ = df.plot(kind='line',x=xlabel,y=ylabel) ; 
+			else:         
+				values = df.columns.values[2]
+				columns = df.columns.values[0]
+				index = df.columns.values[1]
+				pivoted = pandas.pivot_table(df, values=values, columns=columns, index=index)
+				_ = pivoted.plot();
+				
+			plt.show();
+				
+		else:
+			errormsg("Can't determine what columns to plot")
+			return
+	else:
+		return
+
+def getContents(varName,flag_quotes,local_ns):
+	
+	#
+	# Get the contents of the variable name that is passed to the routine. Only simple
+	# variables are checked, i.e. arrays and lists are not parsed
+	#
+	
+	STRING = 0
+	NUMBER = 1
+	LIST = 2
+	RAW = 3
+	DICT = 4
+	PANDAS = 5
+	
+	try:
+		value = eval(varName,None,local_ns) # globals()[varName] # eval(varName)
+	except:
+		return(None,STRING)
+	
+	if (isinstance(value,dict) == True):          # Check to see if this is JSON dictionary
+		return(addquotes(value,flag_quotes),STRING)
+
+	elif(isinstance(value,list) == True or isinstance(value,tuple) == True):         # List - tricky 
+		return(value,LIST)
+	
+	elif (isinstance(value,pandas.DataFrame) == True): # Pandas dataframe
+		return(value,PANDAS)
+
+	elif (isinstance(value,int) == True):         # Integer value 
+		return(value,NUMBER)
+
+	elif (isinstance(value,float) == True):       # Float value
+		return(value,NUMBER)
+
+	else:
+		try:
+			# The pattern needs to be in the first position (0 in Python terms)
+			if (value.find('0x') == 0):               # Just guessing this is a hex value
+				return(value,RAW)
+			else:
+				return(addquotes(value,flag_quotes),STRING)                     # String
+		except:
+			return(addquotes(str(value),flag_quotes),RAW)
+
+def addquotes(inString,flag_quotes):
+	
+	if (isinstance(inString,dict) == True):          # Check to see if this is JSON dictionary
+		serialized = json.dumps(inString) 
+	else:
+		serialized = inString
+
+	# Replace single quotes with '' (two quotes) and wrap everything in single quotes
+	if (flag_quotes == False):
+		return(serialized)
+	else:
+		return("'"+serialized.replace("'","''")+"'")    # Convert single quotes to two single quotes
+	
+def checkOption(args_in, option, vFalse=False, vTrue=True):
+	
+	args_out = args_in.strip()
+	found = vFalse
+	
+	if (args_out != ""):
+		if (args_out.find(option) >= 0):
+			args_out = args_out.replace(option," ")
+			args_out = args_out.strip()
+			found = vTrue
+
+	return args_out, found
+
+def findProc(procname):
+	
+	global _hdbc, _hdbi, _connected
+	
+	# Split the procedure name into schema.procname if appropriate
+	upper_procname = procname.upper()
+	schema, proc = split_string(upper_procname,".") # Expect schema.procname
+	if (proc == None):
+		proc = schema
+
+	# Call ibm_db.procedures to see if the procedure does exist (the answer is kept in the catalog cache)
+	schema = "%"
+
+	def procedureResults():
+		stmt = ibm_db.procedures(_hdbc, None, schema, proc) 
+		if (stmt == False): return None
+		result = ibm_db.fetch_tuple(stmt)
+		if (result == False): return None
+		return result[5]
+
+	try:
+		resultsets = catalogLookup(("PROCEDURE",proc),procedureResults)
+		if (resultsets == None):                    # Error executing the code
+			errormsg("Procedure " + procname + " not found in the system catalog.")
+			return None
+
+		if (resultsets >= 1): resultsets = 1
+		return resultsets
+			
+	except Exception as err:
+		errormsg("Procedure " + procname + " not found in the system catalog.")
+		return None
+
+def parseCallArgs(macro):
+	
+	quoteChar = ""
+	inQuote = False
+	inParm = False
+	ignore = False
+	name = ""
+	parms = []
+	parm = ''
+	
+	sqlin = macro.replace("\n","")
+	sqlin.lstrip()
+	
+	for ch in sqlin:
+		if (inParm == False):
+			# We hit a blank in the name, so ignore everything after the procedure name until a ( is found
+			if (ch == " "): 
+				ignore == True
+			elif (ch ==  "("): # Now we have parameters to send to the stored procedure
+				inParm = True
+			else:
+				if (ignore == False): name = name + ch # The name of the procedure (and no blanks)
+		else:
+			if (inQuote == True):
+				if (ch == quoteChar):
+					inQuote = False  
+				else:
+					parm = parm + ch
+			elif (ch in ("\"","\'","[")): # Do we have a quote
+				if (ch == "["):
+					quoteChar = "]"
+				else:
+					quoteChar = ch
+				inQuote = True
+			elif (ch == ")"):
+				if (parm != ""):
+					parms.append(parm)
+				parm = ""
+				break
+			elif (ch == ","):
+				if (parm != ""):
+					parms.append(parm)                  
+				else:
+					parms.append("null")
+					
+				parm = ""
+
+			else:
+				parm = parm + ch
+				
+	if (inParm == True):
+		if (parm != ""):
+			parms.append(parm)    
+					   
+	return(name,parms)
+
+def getColumns(stmt):
+	   
+	columns = []
+	types = []
+	colcount = 0
+	try:
+		colname = ibm_db.field_name(stmt,colcount)
+		coltype = ibm_db.field_type(stmt,colcount)
+		precision = ibm_db.field_precision(stmt,colcount)
+		while (colname != False):
+			if (coltype == "real"):
+				if (precision == 7):
+					coltype = "real"
+				elif (precision == 15):
+					coltype = "float"
+				elif (precision == 16):
+					coltype = "decfloat16"
+				elif (precision == 34):
+					coltype = "decfloat34"
+				else:
+					coltype = "real"
+			elif (coltype == "int"):
+				if (precision == 1):
+					coltype = "boolean"
+				elif (precision == 5):
+					coltype = "smallint"
+				elif (precision == 10):
+					coltype = "int"
+				else:
+					coltype = "int"
+			columns.append(colname)
+			types.append(coltype)
+			colcount += 1
+			colname = ibm_db.field_name(stmt,colcount)
+			coltype = ibm_db.field_type(stmt,colcount)  
+			precision = ibm_db.field_precision(stmt,colcount)     
+			
+		return columns,types   
+				
+	except Exception as err:
+		db2_error(False)
+		return None
+
+def parseCall(hdbc, inSQL, local_ns):
+	
+	global _hdbc, _hdbi, _connected, _environment
+	
+	# Check to see if we are connected first
+	if (_connected == False):                                      # Check if you are connected 
+		db2_doConnect()
+		if _connected == False: return None
+	 
+	remainder = inSQL.strip()
+	procName, procArgs = parseCallArgs(remainder[5:]) # Assume that CALL ... is the format
+
+	invalidateResults(catalog=False)                         # The procedure can change any table
+	
+	resultsets = findProc(procName)
+	if (resultsets == None): return None
+
+	# A single variable containing a list of argument tuples runs the procedure once for every tuple
+
+	if (len(procArgs) == 1 and procArgs[0][:1] == ":"):
+		try:
+			argsets = eval(procArgs[0][1:],None,local_ns)
+		except:
+			argsets = None
+		if (isinstance(argsets,list) and len(argsets) > 0 and all(isinstance(x,(list,tuple)) for x in argsets)):
+			return callMany(hdbc,procName,argsets,resultsets)
+	
+	argvalues = []
+ 
+	if (len(procArgs) > 0): # We have arguments to consider
+		for arg in procArgs:
+			varname = arg
+			if (len(varname) > 0):
+				if (varname[0] == ":"):
+					checkvar = varname[1:]
+					varvalue = getContents(checkvar,True,local_ns)
+					if (varvalue == None):
+						errormsg("Variable " + checkvar + " is not defined.")
+						return None
+					argvalues.append(varvalue)
+				else:
+					if (varname.upper() == "NULL"):
+						argvalues.append(None)
+					else:
+						argvalues.append(varname)
+			else:
+				argvalues.append(None)
+
+	
+	try:
+
+		setPrefetch(_hdbc,prefetchOn(),True)                   # callproc creates its own statement
+
+		if (len(procArgs) > 0):
+			argtuple = tuple(argvalues)
+			result = ibm_db.callproc(_hdbc,procName,argtuple)
+			stmt = result[0]
+		else:
+			result = ibm_db.callproc(_hdbc,procName)
+			stmt = result
+		
+		if (resultsets != 0 and stmt != None): 
+
+			columns, types = getColumns(stmt)
+			if (columns == None): return None
+			
+			rows = []
+			for rowlist in fetchRows(stmt,fetchSize()):
+				row = []
+				colcount = 0
+				for col in rowlist:
+					try:
+						if (types[colcount] in ["int","bigint"]):
+							row.append(int(col))
+						elif (types[colcount] in ["decimal","real"]):
+							row.append(float(col))
+						elif (types[colcount] in ["date","time","timestamp"]):
+							row.append(str(col))
+						else:
+							row.append(col)
+					except:
+						row.append(col)
+					colcount += 1
+				rows.append(row)
+			
+			if flag(["-r","-array"]):
+				rows.insert(0,columns)
+				if len(procArgs) > 0:
+					allresults = []
+					allresults.append(rows)
+					for x in result[1:]:
+						allresults.append(x)
+					return allresults # rows,returned_results
+				else:
+					return rows
+			else:
+				df = pandas.DataFrame.from_records(rows,columns=columns)
+				if flag("-grid") or _settings.get('display',"PANDAS") == 'GRID':
+					if (loadGrid() == False):
+						with pandas.option_context('display.max_rows', None, 'display.max_columns', None):  
+							pdisplay(df)
+					else:
+						try:
+							pdisplay(qgrid.show_grid(df))
+						except:
+							errormsg("Grid cannot be used to display data with duplicate column names. Use option -a or %sql OPTION DISPLAY PANDAS instead.")
+							
+					return                             
+				else:
+					if flag(["-a","-all"]) or _settings.get("maxrows",10) == -1 : # All of the rows
+						with pandas.option_context('display.max_rows', 100, 'display.max_columns', None): 
+							pdisplay(df)
+					else:
+						return df
+			
+		else:
+			if len(procArgs) > 0:
+				allresults = []
+				for x in result[1:]:
+					allresults.append(x)
+				return allresults # rows,returned_results
+			else:
+				return None
+			
+	except Exception as err:
+		db2_error(False)
+		return None
+
+	finally:
+		setPrefetch(_hdbc,_settings.get("prefetch","OFF") == "ON",True)
+
+def callMany(hdbc, procName, argsets, resultsets):
+
+	#
+	# Fan out CALL proc(:argsets) over the parallel workers. The argument tuples are split into chunks and 
+	# each worker runs the calls in its chunk on its own connection. The results are returned as one 
+	# dataframe with the call number, the parameter values after the call (which includes the output 
+	# parameters), the rows of the result set (if any) and the error message of calls that failed.
+	#
+
+	thread_count = threadCount()
+	if (thread_count in (0,1)):
+		errormsg("The THREADS option is currently set to 0 or 1 which disables parallelism.")
+		return None
+
+	if (loadParallel() == False):
+		errormsg("Parallelism is not availble on this system.")
+		return None
+
+	parmnames = []
+	try:
+		schema, proc = split_string(procName.upper(),".")
+		if (proc == None): schema, proc = procedureSchema(hdbc,schema), schema
+		stmt = ibm_db.procedure_columns(hdbc, None, schema, proc, None)
+		row = ibm_db.fetch_assoc(stmt)
+		while (row):
+			if (row["COLUMN_TYPE"] in (1,2,4)):            # IN, INOUT, OUT parameters
+				parmnames.append(row["COLUMN_NAME"])
+			row = ibm_db.fetch_assoc(stmt)
+	except:
+		parmnames = []
+
+	pool, m  = getPool(thread_count)
+	if (pool == None):
+		return None
+
+	q = m.Queue()
+
+	chunksize = max(1, min(100, len(argsets) // (thread_count * 4)))
+	calls = list(enumerate(argsets))
+	chunks = [calls[i:i+chunksize] for i in range(0,len(calls),chunksize)]
+
+	arrow = False if _settings.get("parallel","PROCESSES") == "THREADS" else loadArrow()
+
+	start_time = time.time()
+
+	try:
+		control = startSlices(hdbc,pool,q,process_call,(procName,parmnames,resultsets,q,arrow),chunks,thread_count)
+	except Exception as err:
+		print(repr(err))
+		return None
+
+	try:
+		timeout = float(flagValue("-timeout",0))
+	except:
+		timeout = 0
+
+	ok, output = gatherSlices(control,time.time() + timeout if timeout > 0 else None)
+	if (ok == False): return None
+
+	try:
+		df = assembleSlices(output)
+	except Exception as err:
+		errormsg("Unable to combine the procedure results: " + repr(err))
+		return None
+
+	elapsed = time.time() - start_time
+	failed = df.loc[df["ERROR"].notna(),"CALL"].nunique() if "ERROR" in df.columns else 0
+	rate = int(len(argsets) / elapsed) if elapsed > 0 else 0
+
+	if (flag(["-q","-quiet"]) == False):
+		print(f"{len(argsets):,} calls to {procName} completed in {elapsed:.2f} seconds ({rate:,} calls/sec), {failed:,} failed")
+		
+	return displayResults(df)
+
+def procedureSchema(hdbc,proc):
+
+	#
+	# The schema that an unqualified CALL of proc resolves to: the first schema in CURRENT PATH that has a 
+	# procedure with that name, or CURRENT SCHEMA if the catalog doesn't say. None if neither can be read.
+	#
+
+	path = catalogCached(hdbc,"VALUES CURRENT PATH")
+	schemas = catalogCached(hdbc,"SELECT DISTINCT ROUTINESCHEMA FROM SYSCAT.ROUTINES WHERE ROUTINENAME = ? AND ROUTINETYPE = 'P'",[proc])
+
+	if (path not in (None,[]) and schemas not in (None,[])):
+		found = [row[0].strip() for row in schemas]
+		for schema in re.findall(r'"((?:[^"]|"")*)"',path[0][0]):
+			if (schema.replace('""','"') in found):
+				return schema.replace('""','"')
+
+	rows = catalogCached(hdbc,"VALUES CURRENT SCHEMA")
+	if (rows in (None,[])):
+		return None
+
+	return rows[0][0].strip()
+
+def process_call(procName, chunk, parmnames, resultsets, q, arrow=False):
+
+	#
+	# Worker for callMany. Runs the procedure for each (call number, arguments) in the chunk and returns
+	# one dataframe with a row per call (or per result set row). A failing call is recorded in the ERROR
+	# column and does not stop the rest of the chunk.
+	#
+
+	import pandas as pd
+
+	if (q.empty() == False): return None
+
+	hdbc, hdbi, errmsg = worker_connect()
+	if (hdbc == None):
+		q.put(errmsg)
+		return None
+
+	records = []
+
+	for callno, args in chunk:
+
+		if (q.empty() == False): return None
+
+		record = {"CALL": callno}
+		rows = []
+
+		try:
+			result = ibm_db.callproc(hdbc,procName,tuple(args))
+			if (result == None or result == False):
+				raise Exception("callproc failed")
+			stmt = result[0]
+			for idx, value in enumerate(result[1:]):
+				name = parmnames[idx] if idx < len(parmnames) else f"PARM{idx+1}"
+				record[name] = value
+			if (resultsets != 0 and stmt != None):
+				columns = []
+				colname = ibm_db.field_name(stmt,len(columns))
+				while (colname != False):
+					columns.append(colname)
+					colname = ibm_db.field_name(stmt,len(columns))
+				row = ibm_db.fetch_tuple(stmt)
+				while (row):
+					rows.append(dict(zip(columns,row)))
+					row = ibm_db.fetch_tuple(stmt)
+				ibm_db.free_stmt(stmt)
+			error = None
+		except Exception as err:
+			try:
+				errmsg = ibm_db.stmt_errormsg()
+				if (errmsg in (None,"")): errmsg = ibm_db.conn_errormsg(hdbc)
+				errmsg = errmsg.replace('\r',' ')
+				errmsg = errmsg[errmsg.rfind("]")+1:].strip()
+			except:
+				errmsg = ""
+			error = errmsg if errmsg != "" else repr(err)
+
+		if (len(rows) == 0):
+			records.append({**record, "ERROR": error})
+		else:
+			for row in rows:
+				records.append({**record, **row, "ERROR": error})
+
+	df = pd.DataFrame.from_records(records)
+
+	if (arrow == True):
+		return slice_to_arrow(df)
+	else:
+		return df
+
+#
+# Prepared statements. PREPARE returns a statement id (S1, S2, ...) that EXECUTE uses to find the handle.
+# The handles are kept in a least recently used cache of at most STATEMENTS entries, found by id or by the 
+# connection and SQL text (white space outside of quotes doesn't matter), so preparing the same SQL again
+# reuses the handle. A handle is freed when it is evicted. COMMIT and ROLLBACK discard the statements of 
+# the connection unless OPTION HOLD ON is set (or COMMIT HOLD is used), in which case they survive a COMMIT.
+# The statements that %sql runs are kept in the same cache (see prepareStatement). DDL frees those, since
+# it can change the tables they use.
+#
+
+_dmltypes = ("SELECT","WITH","VALUES","INSERT","UPDATE","DELETE","MERGE")
+
+def normalizeSQL(sql):
+
+	parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""",sql)
+	return "".join(part if idx % 2 == 1 else " ".join(part.split()) for idx, part in enumerate(parts)).strip()
+
+def cacheStatement(hdbc,sql,stmt,auto=False):
+
+	# Add a prepared statement to the cache and return its id. auto is True for statements %sql prepared itself.
+
+	global _stmtNext
+
+	_stmtNext = _stmtNext + 1
+	stmtID = f"S{_stmtNext}"
+	key = (hdbc,normalizeSQL(sql))
+
+	if (key in _stmtText):
+		dropStatement(_stmtText[key])
+
+	_statements[stmtID] = {"stmt": stmt, "key": key, "auto": auto}
+	_stmtText[key] = stmtID
+
+	trimStatements()
+
+	return stmtID
+
+def trimStatements():
+
+	# Free the least recently used statements. Statements from PREPARE are kept as long as there are others.
+
+	while (len(_statements) > max(1,_settings.get("statements",64))):
+		auto = [stmtID for stmtID, entry in _statements.items() if entry["auto"] == True]
+		dropStatement(auto[0] if len(auto) > 0 else next(iter(_statements)))
+		_stmtStats["evictions"] += 1
+
+	return
+
+def findStatement(stmtID):
+
+	# Return the handle for a statement id (and make it the most recently used) or None
+
+	entry = _statements.pop(stmtID,None)
+	if (entry == None):
+		return None
+
+	_statements[stmtID] = entry
+
+	return entry["stmt"]
+
+def lookupStatement(hdbc,sql,auto=False):
+
+	# Return the id of the statement already prepared for this SQL on the connection or None
+
+	stmtID = _stmtText.get((hdbc,normalizeSQL(sql)))
+	if (stmtID == None):
+		_stmtStats["misses"] += 1
+		return None
+
+	_stmtStats["hits"] += 1
+	findStatement(stmtID)
+	if (auto == False):
+		_statements[stmtID]["auto"] = False                    # PREPARE of a statement %sql already cached
+
+	return stmtID
+
+def dropStatement(stmtID):
+
+	entry = _statements.pop(stmtID,None)
+	if (entry == None): return
+
+	_stmtText.pop(entry["key"],None)
+
+	try:
+		ibm_db.free_stmt(entry["stmt"])
+	except:
+		pass
+
+	return
+
+def clearStatements(hdbc=None,auto=False):
+
+	# Free the statements prepared on a connection (or all of them). With auto=True only the ones %sql prepared.
+
+	for stmtID, entry in list(_statements.items()):
+		if ((hdbc == None or entry["key"][0] is hdbc) and (auto == False or entry["auto"] == True)):
+			dropStatement(stmtID)
+
+	return
+
+def releaseStatement(stmt):
+
+	# Free a statement handle, removing it from the cache if it is there
+
+	for stmtID, entry in list(_statements.items()):
+		if (entry["stmt"] is stmt):
+			dropStatement(stmtID)
+			return
+
+	try:
+		ibm_db.free_stmt(stmt)
+	except:
+		pass
+
+	return
+
+def statementStats():
+
+	hits = _stmtStats["hits"]
+	misses = _stmtStats["misses"]
+	ratio = 100 * hits / (hits + misses) if hits + misses > 0 else 0
+
+	return f"{len(_statements)} cached, {hits} hits, {misses} misses ({ratio:.0f}% hit ratio), {_stmtStats['evictions']} evicted"
+
+#
+# Result cache. With OPTION CACHE ON (or -cache n on the command) the DataFrame returned by a read-only query 
+# is kept for CACHETTL (or n) seconds and returned again when the same SQL is run against the same database.
+# Host variables are substituted into the SQL before it gets here, so different values are different entries.
+# The cache holds at most CACHESIZE megabytes; the least recently used results are discarded first. An 
+# INSERT, UPDATE, DELETE or MERGE discards the results of queries that mention the table, and any other 
+# statement (DDL, CALL, ROLLBACK) discards all of the results for the database. Changes made by other
+# sessions are only seen when the result expires.
+#
+
+def connectionKey():
+
+	return (_settings.get("hostname",""),str(_settings.get("port","")),_settings.get("database","").upper(),_settings.get("uid","").upper())
+
+def resultTTL():
+
+	# Seconds the result of the current statement can be reused for (0 = don't use the cache)
+
+	value = flagValue("-cache")
+	if (value != None):
+		if (value.upper() == "DISK"):
+			return _settings.get("diskttl",86400)
+		try:
+			return max(0,float(value))
+		except:
+			return 0
+	elif (flag("-cache") and _settings.get("cache","OFF") != "DISK"):
+		return _settings.get("cachettl",300)
+
+	if (_settings.get("cache","OFF") == "ON"):
+		return _settings.get("cachettl",300)
+	elif (_settings.get("cache","OFF") == "DISK"):
+		return _settings.get("diskttl",86400)
+
+	return 0
+
+def diskTier():
+
+	# True when the result of the current statement is cached on disk (pyarrow is needed for the files)
+
+	value = flagValue("-cache")
+	if (value != None):
+		disk = value.upper() == "DISK"
+	else:
+		disk = _settings.get("cache","OFF") == "DISK"
+
+	return disk and loadArrow()
+
+def resultSQL(sql):
+
+	#
+	# The text a result is cached under. The SESSION.DB2MAGIC_INLISTn tables of pushed down IN lists are 
+	# numbered from 1 in every session (and again after a reconnect), so each reference is replaced by a 
+	# digest of the values in the list. None is returned if the list isn't known, and the result isn't cached.
+	#
+
+	import hashlib
+
+	tables = {table.upper(): key for key, table in _inlists.items()}
+	missing = []
+
+	def listDigest(match):
+		key = tables.get(match.group(0).upper())
+		if (key == None):
+			missing.append(match.group(0))
+			return match.group(0)
+		return "DB2MAGIC_LIST_" + hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+	text = re.sub(r'\bSESSION\s*\.\s*DB2MAGIC_INLIST\d+\b',listDigest,normalizeSQL(sql),flags=re.I)
+
+	return None if len(missing) > 0 else text
+
+def cachedResult(sql):
+
+	# Return a copy of the cached result of a query or None
+
+	text = resultSQL(sql)
+	if (text == None):
+		_resultStats["misses"] += 1
+		return None
+
+	key = (connectionKey(),text)
+
+	with _resultLock:
+		entry = _results.pop(key,None)
+		if (entry == None or entry["expires"] < time.time()):
+			_resultStats["misses"] += 1
+			return None
+
+		_results[key] = entry                                  # Most recently used
+		_resultStats["hits"] += 1
+		df = entry["df"]
+
+	return df.copy()
+
+def cacheResult(sql,df,ttl):
+
+	# Keep a copy of a query result for ttl seconds
+
+	size = int(df.memory_usage(index=True,deep=True).sum())
+	if (size > _settings.get("cachesize",256) * 1024 * 1024):      # Larger than the whole cache
+		return
+
+	text = resultSQL(sql)
+	if (text == None):
+		return
+
+	key = (connectionKey(),text)
+	entry = {"df": df.copy(), "size": size, "expires": time.time() + ttl}
+
+	with _resultLock:
+		_results.pop(key,None)
+		_results[key] = entry
+
+	trimResults()
+
+	return
+
+def trimResults():
+
+	# Discard expired results and then the least recently used ones until the cache fits in CACHESIZE
+
+	limit = _settings.get("cachesize",256) * 1024 * 1024
+	now = time.time()
+
+	with _resultLock:
+		for key, entry in list(_results.items()):
+			if (entry["expires"] < now):
+				del _results[key]
+		size = sum(entry["size"] for entry in _results.values())
+		while (size > limit and len(_results) > 0):
+			key = next(iter(_results))
+			size = size - _results.pop(key)["size"]
+			_resultStats["evictions"] += 1
+
+	return
+
+def modifiedTable(sql):
+
+	# The unqualified name of the table changed by an INSERT, UPDATE, DELETE, MERGE or TRUNCATE (or None)
+
+	name = r'(?:"[^"]+"|[A-Za-z_][\w$#@]*)'
+	pattern = r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|MERGE\s+INTO|TRUNCATE(?:\s+TABLE)?)\s+(' + name + r')(?:\s*\.\s*(' + name + r'))?'
+
+	match = re.match(pattern,sql,flags=re.I)
+	if (match == None):
+		return None
+
+	table = match.group(2) if match.group(2) != None else match.group(1)
+
+	return table.strip('"')
+
+def invalidateResults(sql=None,catalog=True):
+
+	# Discard the cached results a statement may have changed. Without a statement every result for the database goes.
+	# Anything other than DML (or a CALL, catalog=False) may also have changed the catalog.
+
+	if (catalog == True and (sql == None or sqlKeyword(sql) not in _dmltypes)):
+		clearCatalog()
+
+	table = modifiedTable(sql) if sql != None else None
+	key = connectionKey()
+	changed = lambda rsql: table == None or re.search(r'(?<![\w$#@])' + re.escape(table) + r'(?![\w$#@])',rsql,flags=re.I) != None
+
+	if (len(_results) > 0):
+		with _resultLock:
+			for rkey in list(_results.keys()):
+				if (rkey[0] == key and changed(rkey[1])):
+					del _results[rkey]
+					_resultStats["invalidations"] += 1
+
+	invalidateDisk(lambda entry: tuple(entry["connection"]) == key and changed(entry["sql"]))
+
+	return
+
+def clearResults(disk=False):
+
+	with _resultLock:
+		_results.clear()
+
+	if (disk == True):
+		invalidateDisk(lambda entry: True)
+
+	return
+
+def resultStats():
+
+	hits = _resultStats["hits"]
+	misses = _resultStats["misses"]
+	ratio = 100 * hits / (hits + misses) if hits + misses > 0 else 0
+	size = sum(entry["size"] for entry in list(_results.values())) / (1024 * 1024)
+
+	return f"{len(_results)} cached, {size:.1f} MB, {hits} hits, {misses} misses ({ratio:.0f}% hit ratio), {_resultStats['evictions']} evicted, {_resultStats['invalidations']} invalidated"
+
+#
+# Disk tier of the result cache. OPTION CACHE DISK (or -cache disk) writes the result of a query to an Arrow
+# IPC (Feather version 2) file, compressed with zstd, in the CACHEDIR directory so that it survives a restart
+# of the kernel. index.json in the directory lists the files by a fingerprint of the database and SQL, with 
+# the time they expire (DISKTTL) and were last used. Files are memory mapped when they are read back. The 
+# least recently used files are removed when the directory holds more than DISKSIZE megabytes. The index is
+# read again for every lookup so that notebooks sharing the directory see each other's results, and it is 
+# only read and rewritten while holding a lock on index.lock in the directory, so kernels take turns.
+#
+
+def diskFingerprint(sql):
+
+	# None when the SQL refers to an IN list that is no longer known (see resultSQL)
+
+	import hashlib
+
+	text = resultSQL(sql)
+	if (text == None):
+		return None
+
+	key = json.dumps([list(connectionKey()),text])
+
+	return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+class DiskLock:
+
+	# _diskLock for the threads of this kernel plus a file lock for the other kernels using the directory
+
+	def __enter__(self):
+
+		import os
+
+		_diskLock.acquire()
+		self.handle = None
+
+		folder = _settings.get("cachedir","db2cache")
+		if (os.path.isdir(folder) == False):
+			return self
+
+		try:
+			self.handle = open(os.path.join(folder,"index.lock"),"a+")
+			if (os.name == "nt"):
+				import msvcrt
+				self.handle.seek(0)
+				msvcrt.locking(self.handle.fileno(),msvcrt.LK_LOCK,1)
+			else:
+				import fcntl
+				fcntl.flock(self.handle.fileno(),fcntl.LOCK_EX)
+		except:
+			if (self.handle != None):                            # No file locking, the kernel's own lock still applies
+				self.handle.close()
+			self.handle = None
+
+		return self
+
+	def __exit__(self,*args):
+
+		import os
+
+		try:
+			if (self.handle != None):
+				if (os.name == "nt"):
+					import msvcrt
+					self.handle.seek(0)
+					msvcrt.locking(self.handle.fileno(),msvcrt.LK_UNLCK,1)
+				self.handle.close()                              # Closing also releases flock
+		finally:
+			self.handle = None
+			_diskLock.release()
+
+		return False
+
+def diskIndex():
+
+	# The index of the disk cache ({} if there isn't one)
+
+	import os
+
+	fname = os.path.join(_settings.get("cachedir","db2cache"),"index.json")
+	if (os.path.exists(fname) == False):
+		return {}
+
+	return readJSON(fname) or {}
+
+def saveDiskIndex(index):
+
+	import os
+
+	writeJSON(os.path.join(_settings.get("cachedir","db2cache"),"index.json"),index)
+
+	return
+
+def diskResult(sql):
+
+	# Return the result cached on disk for a query or None
+
+	import os
+
+	fingerprint = diskFingerprint(sql)
+	if (fingerprint == None):
+		_resultStats["misses"] += 1
+		return None
+
+	with DiskLock():
+		index = diskIndex()
+		entry = index.get(fingerprint)
+		if (entry == None or entry["expires"] < time.time()):
+			_resultStats["misses"] += 1
+			return None
+
+		try:
+			source = pa.memory_map(os.path.join(_settings.get("cachedir","db2cache"),entry["file"]),"r")
+			table = pa.ipc.open_file(source).read_all()
+		except Exception as err:
+			index.pop(fingerprint,None)                     # The file is gone or damaged
+			saveDiskIndex(index)
+			_resultStats["misses"] += 1
+			return None
+
+		entry["used"] = time.time()
+		saveDiskIndex(index)
+
+	_resultStats["hits"] += 1
+
+	return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def diskStore(sql,df,ttl):
+
+	# Write a query result to the disk cache. Problems writing the file only mean the result isn't cached.
+
+	import os
+	import tempfile
+
+	folder = _settings.get("cachedir","db2cache")
+	fingerprint = diskFingerprint(sql)
+	if (fingerprint == None):
+		return
+
+	fname = fingerprint + ".arrow"
+	tempname = None
+
+	try:
+		os.makedirs(folder,exist_ok=True)
+		table = pa.Table.from_pandas(df, preserve_index=False)
+		codec = "zstd" if pa.Codec.is_available("zstd") else None
+		handle, tempname = tempfile.mkstemp(dir=folder,prefix=".db2magic",suffix=".tmp")
+		os.close(handle)
+		with pa.OSFile(tempname,"wb") as sink:
+			with pa.ipc.new_file(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression=codec)) as writer:
+				writer.write_table(table)
+		os.replace(tempname,os.path.join(folder,fname))
+		tempname = None
+
+		with DiskLock():
+			index = diskIndex()
+			index[fingerprint] = {"file": fname, "connection": list(connectionKey()), "sql": resultSQL(sql), 
+								  "size": os.path.getsize(os.path.join(folder,fname)), "rows": len(df),
+								  "expires": time.time() + ttl, "used": time.time()}
+			saveDiskIndex(index)
+
+	except Exception as err:
+		errormsg("The result could not be written to the disk cache: " + repr(err))
+		if (tempname != None):
+			try:
+				os.remove(tempname)
+			except:
+				pass
+		return
+
+	trimDisk()
+
+	return
+
+def trimDisk():
+
+	# Remove expired files and then the least recently used ones until the directory fits in DISKSIZE
+
+	limit = _settings.get("disksize",10240) * 1024 * 1024
+	now = time.time()
+
+	with DiskLock():
+		index = diskIndex()
+		if (len(index) == 0): return
+
+		keep = {fingerprint: entry for fingerprint, entry in index.items() if entry["expires"] >= now}
+		size = sum(entry["size"] for entry in keep.values())
+		for fingerprint, entry in sorted(keep.items(),key=lambda item: item[1]["used"]):
+			if (size <= limit): break
+			size = size - entry["size"]
+			del keep[fingerprint]
+			_resultStats["evictions"] += 1
+
+		if (len(keep) < len(index)):
+			removeDisk(index,keep)
+
+	return
+
+def invalidateDisk(test):
+
+	# Remove the files of the disk cache whose index entries pass the test
+
+	with DiskLock():
+		index = diskIndex()
+		if (len(index) == 0): return
+
+		keep = {fingerprint: entry for fingerprint, entry in index.items() if test(entry) == False}
+		if (len(keep) < len(index)):
+			_resultStats["invalidations"] += len(index) - len(keep)
+			removeDisk(index,keep)
+
+	return
+
+def removeDisk(index,keep):
+
+	# Save the index with only the entries in keep and delete the files of the others
+
+	import os
+
+	saveDiskIndex(keep)
+
+	for fingerprint, entry in index.items():
+		if (fingerprint not in keep):
+			try:
+				os.remove(os.path.join(_settings.get("cachedir","db2cache"),entry["file"]))
+			except:
+				pass                                            # Still mapped (Windows) or already gone
+
+	return
+
+def diskStats():
+
+	index = diskIndex()
+	size = sum(entry["size"] for entry in index.values()) / (1024 * 1024)
+
+	return f"{len(index)} cached, {size:.1f} MB"
+
+#
+# Catalog cache. Procedures (with the number of result sets they return), the columns of tables and the 
+# other catalog queries used by CALL, APPEND, parallel queries and the LIST and DESCRIBE macros are read 
+# from Db2 the first time they are needed and kept for the session. The entries for a database are 
+# discarded when DDL (or anything other than DML) is run from the notebook, on ROLLBACK, and with 
+# OPTION CATALOG REFRESH. Catalog queries that fail are not kept.
+#
+
+def catalogLookup(name,loader):
+
+	# Return the cached value for name or call loader to get it
+
+	key = (connectionKey(),) + tuple(name)
+	caching = _settings.get("catalog","ON") == "ON"
+
+	if (caching == True and key in _catalog):
+		_catalogStats["hits"] += 1
+		return _catalog[key]
+
+	_catalogStats["misses"] += 1
+	value = loader()
+	if (caching == True and value is not None):
+		_catalog[key] = value
+
+	return value
+
+def catalogCached(hdbc,sql,parms=None):
+
+	# catalogRows for queries against the catalog
+
+	return catalogLookup(("SQL",normalizeSQL(sql),tuple(parms or ())),lambda: catalogRows(hdbc,sql,parms))
+
+def catalogResult(sql):
+
+	# The DataFrame kept for a catalog query run by a macro (-catalog) or None
+
+	df = _catalog.get((connectionKey(),"QUERY",normalizeSQL(sql)))
+	if (df is None):
+		_catalogStats["misses"] += 1
+		return None
+
+	_catalogStats["hits"] += 1
+
+	return df.copy()
+
+def catalogStore(sql,df):
+
+	if (_settings.get("catalog","ON") == "ON"):
+		_catalog[(connectionKey(),"QUERY",normalizeSQL(sql))] = df.copy()
+
+	return
+
+def clearCatalog(everything=False):
+
+	# Discard the catalog information of the current database (or of every database)
+
+	key = connectionKey()
+	for ckey in list(_catalog.keys()):
+		if (everything == True or ckey[0] == key):
+			_catalog.pop(ckey,None)
+
+	return
+
+def catalogStats():
+
+	hits = _catalogStats["hits"]
+	misses = _catalogStats["misses"]
+	ratio = 100 * hits / (hits + misses) if hits + misses > 0 else 0
+
+	return f"{len(_catalog)} cached, {hits} hits, {misses} misses ({ratio:.0f}% hit ratio)"
+
+def tableColumns(hdbc,table):
+
+	# The columns of a table as (COLNAME, TYPENAME, LENGTH, SCALE, NULLS) rows in column order. The name can be
+	# qualified with a schema. An empty list means the table doesn't exist and None that the catalog can't be read.
+
+	name = r'(?:"[^"]+"|[^".\s]+)'
+	match = re.fullmatch(r'\s*(' + name + r')(?:\s*\.\s*(' + name + r'))?\s*',table)
+	if (match == None):
+		return None
+
+	ident = lambda x: x[1:-1] if x[:1] == '"' else x.upper()
+	if (match.group(2) == None):
+		tabschema = None
+		tabname = ident(match.group(1))
+	else:
+		tabschema = ident(match.group(1))
+		tabname = ident(match.group(2))
+
+	sql = ("SELECT COLNAME, TYPENAME, LENGTH, SCALE, NULLS FROM SYSCAT.COLUMNS "
+		   "WHERE TABSCHEMA = COALESCE(CAST(? AS VARCHAR(128)), CURRENT SCHEMA) AND TABNAME = ? ORDER BY COLNO")
+
+	return catalogCached(hdbc,sql,[tabschema,tabname])
+
+def checkAppend(hdbc,table,dfValue):
+
+	#
+	# Compare a dataframe with the columns of the table it will be appended to, so that a mismatch is reported 
+	# before any rows are inserted (the rows are committed in blocks of 1000). Returns False if there is a problem.
+	#
+
+	import datetime
+
+	columns = tableColumns(hdbc,table)
+	if (columns in (None,[])):                              # Let Db2 report any problem (temporary tables and
+		return True                                         # aliases have no rows in SYSCAT.COLUMNS)
+
+	if (len(columns) != len(dfValue.columns)):
+		errormsg(f"The dataframe has {len(dfValue.columns)} columns but table {table} has {len(columns)}.")
+		return False
+
+	numeric = ("SMALLINT","INTEGER","BIGINT","DECIMAL","DECFLOAT","REAL","DOUBLE","FLOAT","NUMERIC")
+	character = ("CHARACTER","VARCHAR","CHAR","GRAPHIC","VARGRAPHIC","LONG VARCHAR")
+	temporal = ("DATE","TIME","TIMESTAMP")
+
+	ok = True
+	for idx, (colname, typename, length, scale, nulls) in enumerate(columns):
+		series = dfValue.iloc[:,idx]
+		values = series.dropna()
+		typename = typename.strip().upper()
+
+		if (nulls == "N" and len(values) < len(series)):
+			errormsg(f"Column {dfValue.columns[idx]} has missing values but {colname} is NOT NULL.")
+			ok = False
+			continue
+
+		if (len(values) == 0): continue
+
+		if (pandas.api.types.is_bool_dtype(series) or pandas.api.types.is_numeric_dtype(series)):
+			kind = "NUMBER"
+		elif (pandas.api.types.is_datetime64_any_dtype(series)):
+			kind = "DATETIME"
+		elif (isinstance(values.iloc[0],(datetime.date,datetime.time))):
+			kind = "DATETIME"
+		elif (isinstance(values.iloc[0],str)):
+			kind = "STRING"
+		else:
+			continue
+
+		if (kind == "NUMBER" and typename in temporal) or (kind == "DATETIME" and typename in numeric):
+			errormsg(f"Column {dfValue.columns[idx]} ({series.dtype}) can't be inserted into {colname} ({typename}).")
+			ok = False
+		elif (kind == "STRING" and typename in numeric):
+			if (pandas.to_numeric(values,errors="coerce").isna().any()):
+				errormsg(f"Column {dfValue.columns[idx]} has values that are not numbers but {colname} is {typename}.")
+				ok = False
+		elif (kind == "STRING" and typename in character):
+			longest = values.astype(str).str.len().max()
+			if (longest > length):
+				errormsg(f"Column {dfValue.columns[idx]} has values of up to {longest} characters but {colname} is {typename}({length}).")
+				ok = False
+
+	return ok
+
+def parsePExec(hdbc, inSQL, local_ns=None):
+	 
+	import ibm_db    
+	global sqlcode
+
+	if (local_ns == None): local_ns = {}
+	
+	cParms = inSQL.split()
+	parmCount = len(cParms)
+	if (parmCount == 0): return(None)                          # Nothing to do but this shouldn't happen
+	
+	keyword = cParms[0].upper()                                  # Upper case the keyword
+	
+	if (keyword == "PREPARE"):                                   # Prepare the following SQL
+		uSQL = inSQL.upper()
+		found = uSQL.find("PREPARE")
+		sql = inSQL[found+7:].strip()
+
+		try:
+			pattern = "\?\*[0-9]+"
+			findparm = re.search(pattern,sql)
+			while findparm != None:
+				found = findparm.group(0)
+				count = int(found[2:])
+				markers = ('?,' * count)[:-1]
+				sql = sql.replace(found,markers)
+				findparm = re.search(pattern,sql)
+			
+			stmtID = lookupStatement(hdbc,sql)              # Same SQL already prepared on this connection
+			if (stmtID != None):
+				return(stmtID)
+
+			stmt = ibm_db.prepare(hdbc,sql) # Check error code here
+			if (stmt == False): 
+				db2_error(False)
+				return(False)
+			
+			return(cacheStatement(hdbc,sql,stmt))           # Return the statement id to the caller
+		
+		except Exception as err:
+			print(err)
+			db2_error(False)
+			return(False)
+
+	if (keyword == "EXECUTE"):                                  # Execute the prepare statement
+		if (parmCount < 2): return(False)                    # No stmtID available
+		
+		stmtID = cParms[1].strip().strip("'")           # :stmt is substituted as a quoted string
+		stmt = findStatement(stmtID)
+		if (stmt == None):
+			errormsg("Prepared statement not found or invalid.")
+			return(False)
+
+		if (isReadOnly(_statements[stmtID]["key"][1]) == False):
+			invalidateResults(_statements[stmtID]["key"][1])
+
+		try:
+			ibm_db.free_result(stmt)                        # Close the cursor of the previous EXECUTE
+		except:
+			pass
+
+		try:        
+
+			if (parmCount == 2):                           # Only the statement handle available
+				result = ibm_db.execute(stmt)               # Run it
+			elif (parmCount == 3):                          # Not quite enough arguments
+				errormsg("Missing or invalid USING clause on EXECUTE statement.")
+				sqlcode = -99999
+				return(False)
+			else:
+				using = cParms[2].upper()
+				if (using != "USING"):                     # Bad syntax again
+					errormsg("Missing USING clause on EXECUTE statement.")
+					sqlcode = -99999
+					return(False)
+				
+				uSQL = inSQL.upper()
+				found = uSQL.find("USING")
+				parmString = inSQL[found+5:].strip()
+				parmset = splitargs(parmString)
+ 
+				if (len(parmset) == 0):
+					errormsg("Missing parameters after the USING clause.")
+					sqlcode = -99999
+					return(False)
+
+				if (len(parmset) == 1 and parmset[0][1] == False and parmset[0][2] == False):
+					batch = findVariable(parmset[0][0].split("@")[0],local_ns)
+					if (isBatch(batch) == True):                # A list of parameter tuples or a DataFrame
+						return(executeBatch(stmt,batch))
+					
+				parm_count = 0
+				parms = []
+				parms.append(None)
+				
+				CONSTANT = 0
+				VARIABLE = 1
+				const = [0]
+				const_cnt = 0
+				
+				for v in parmset:
+					
+					parm_count = parm_count + 1
+					parms.append(None)
+					
+					if (v[1] == True or v[2] == True): # v[1] true if string, v[2] true if num
+						
+						parm_type = CONSTANT                        
+						const_cnt = const_cnt + 1
+						if (v[2] == True):
+							if (isinstance(v[0],int) == True):         # Integer value 
+								sql_type = ibm_db.SQL_INTEGER
+							elif (isinstance(v[0],float) == True):       # Float value
+								sql_type = ibm_db.SQL_DOUBLE
+							else:
+								sql_type = ibm_db.SQL_INTEGER
+						else:
+							sql_type = ibm_db.SQL_CHAR
+						
+						const.append(v[0])
+
+						
 					else:
-						items = items + concat + _vars[sVar]
-					iVar = iVar + 1
-					sVar = str(iVar)
-			else:
-				items = _vars[vvar]
-		else:
-			if (allvars == True):
-				items = ""
-			else:
-				items = "null"                
-				 
-		result = result + items
+					
+						parm_type = VARIABLE
+					
+						# See if the variable has a type associated with it varname@type
+					
+						varset = v[0].split("@")
+						parm_name = varset[0]
+						
+						parm_datatype = "char"
+
+						# Does the variable exist? (in the caller's scope, then the notebook's)
+						if (parm_name not in local_ns and parm_name not in globals()):
+							errormsg("SQL Execute parameter " + parm_name + " not found")
+							sqlcode = -99999
+							return(False)       
+						
+						parms[parm_count] = findVariable(parm_name,local_ns)
+		
+						if (len(varset) > 1):                # Type provided
+							parm_datatype = varset[1]
+
+						if (parm_datatype == "dec" or parm_datatype == "decimal"):
+							sql_type = ibm_db.SQL_DOUBLE
+						elif (parm_datatype == "bin" or parm_datatype == "binary"):
+							sql_type = ibm_db.SQL_BINARY
+						elif (parm_datatype == "int" or parm_datatype == "integer"):
+							sql_type = ibm_db.SQL_INTEGER
+						else:
+							sql_type = ibm_db.SQL_CHAR
+							parms[parm_count] = addquotes(parms[parm_count],False)
+					
+					try:
+						if (parm_type == VARIABLE):
+							result = ibm_db.bind_param(stmt, parm_count, parms[parm_count], ibm_db.SQL_PARAM_INPUT, sql_type)                           
+							# result = ibm_db.bind_param(stmt, parm_count, globals()[parm_name], ibm_db.SQL_PARAM_INPUT, sql_type)
+						else:
+							result = ibm_db.bind_param(stmt, parm_count, const[const_cnt], ibm_db.SQL_PARAM_INPUT, sql_type)
+							
+					except Exception as e:
+						print(repr(e))
+						result = False
+						
+					if (result == False):
+						errormsg("SQL Bind on variable " + parm_name + " failed.")
+						sqlcode = -99999
+						return(False) 
+					
+				result = ibm_db.execute(stmt) # ,tuple(parms))
 				
-	if (remainder != ""):
-		result = result + remainder
+			if (result == False): 
+				errormsg("SQL Execute failed.")      
+				return(False)
+			
+			if (ibm_db.num_fields(stmt) == 0): return(True) # Command successfully completed
+						  
+			return(fetchResults(stmt))
+						
+		except Exception as err:
+			db2_error(False)
+			return(False)
 		
-	return(result)
+		return(False)
+  
+	return(False)     
+
+#
+# Batched EXECUTE. When the only USING value is a linked variable that holds a DataFrame or a list of tuples,
+# the prepared statement is run once for every row with ibm_db.execute_many, which sends all of the rows
+# in one chained request instead of one round trip per row. Rows that fail don't stop the others. A 
+# DataFrame with the status of each row (0 or the SQLCODE and the message) is returned, and the total
+# number of rows changed is in its attrs["rowcount"].
+#
+
+def findVariable(name,local_ns):
+
+	# The value of a linked variable from the caller's scope or the notebook (None if it doesn't exist)
+
+	if (name in local_ns):
+		return local_ns[name]
+
+	return globals().get(name)
+
+def isBatch(value):
+
+	if (isinstance(value,pandas.DataFrame) == True):
+		return True
+
+	if (isinstance(value,(list,tuple)) == True and len(value) > 0):
+		return all(isinstance(row,(list,tuple)) for row in value)
+
+	return False
+
+def executeBatch(stmt,batch):
+
+	global sqlcode, sqlerror, sqlelapsed
+
+	if (isinstance(batch,pandas.DataFrame) == True):
+		rows = tuple(batch.astype(object).where(batch.notna(),None).itertuples(index=False,name=None))
+	else:
+		rows = tuple(tuple(row) for row in batch)
+
+	errors = {}
+
+	start_time = time.time()
+	try:
+		rowcount = interruptible(ibm_db.execute_many,stmt,rows)
+	except Exception as err:
+		for row, message in re.findall(r"Error (\d+): (.*?)(?=Error \d+: |$)",str(err),flags=re.S):
+			errors[int(row)] = message.strip(" ,\n'\")")
+		if (len(errors) == 0):
+			db2_error(flag(["-q","-quiet"]))
+			return(False)
+		try:
+			rowcount = ibm_db.num_rows(stmt)
+		except:
+			rowcount = -1
+	sqlelapsed = time.time() - start_time
+
+	if (rowcount == None): rowcount = -1
+
+	status = []
+	for row in range(1,len(rows)+1):
+		message = errors.get(row)
+		code = 0
+		if (message != None):
+			found = re.search(r"SQLCODE=(-?\d+)",message)
+			code = int(found.group(1)) if found != None else -99999
+		status.append((row,code,message))
+
+	df = pandas.DataFrame(status,columns=["ROW","SQLCODE","ERROR"])
+	df.attrs["rowcount"] = rowcount
+
+	sqlcode = 0 if len(errors) == 0 else int(df.loc[df["SQLCODE"] != 0,"SQLCODE"].iloc[0])
+	sqlerror = "" if len(errors) == 0 else df.loc[df["SQLCODE"] != 0,"ERROR"].iloc[0]
+
+	if (flag(["-q","-quiet"]) == False):
+		rate = int(len(rows) / sqlelapsed) if sqlelapsed > 0 else 0
+		print(f"{len(rows):,} rows executed in {sqlelapsed:.2f} seconds ({rate:,} rows/sec), {rowcount:,} rows changed, {len(errors):,} failed")
+
+	return df
+
+def fetchResults(stmt):
+	 
+	global sqlcode
+	
+	rows = []
+	columns, types = getColumns(stmt)
+	
+	# By default we assume that the data will be an array
+	is_array = True
+	
+	# Check what type of data we want returned - array or json
+	if (flag(["-r","-array"]) == False):
+		# See if we want it in JSON format, if not it remains as an array
+		if (flag("-json") == True):
+			is_array = False
+	
+	# Set column names to lowercase for JSON records
+	if (is_array == False):
+		columns = [col.lower() for col in columns] # Convert to lowercase for each of access
+	
+	# First row of an array has the column names in it
+	if (is_array == True):
+		rows.append(columns)
+		
+	rowcount = 0
+	for result in fetchRows(stmt,fetchSize()):
+		
+		rowcount += 1
+		
+		if (is_array == True):
+			row = []
+		else:
+			row = {}
+			
+		colcount = 0
+		for col in result:
+			try:
+				if (types[colcount] in ["int","bigint"]):
+					if (is_array == True):
+						row.append(int(col))
+					else:
+						row[columns[colcount]] = int(col)
+				elif (types[colcount] in ["decimal","real"]):
+					if (is_array == True):
+						row.append(float(col))
+					else:
+						row[columns[colcount]] = float(col)
+				elif (types[colcount] in ["date","time","timestamp"]):
+					if (is_array == True):
+						row.append(str(col))
+					else:
+						row[columns[colcount]] = str(col)
+				else:
+					if (is_array == True):
+						row.append(col)
+					else:
+						row[columns[colcount]] = col
+						
+			except:
+				if (is_array == True):
+					row.append(col)
+				else:
+					row[columns[colcount]] = col
+					
+			colcount += 1
+		
+		rows.append(row)
+		
+	if (rowcount == 0): 
+		sqlcode = 100        
+	else:
+		sqlcode = 0
+		
+	return rows
+			
+
+def parseCommit(sql):
+	
+	global _hdbc, _hdbi, _connected
+
+	if (_connected == False): return                        # Nothing to do if we are not connected
+	
+	cParms = sql.split()
+	if (len(cParms) == 0): return                           # Nothing to do but this shouldn't happen
+	
+	keyword = cParms[0].upper()                             # Upper case the keyword
+	
+	if (keyword == "COMMIT"):                               # Commit the work that was done
+		try:
+			result = ibm_db.commit (_hdbc)                  # Commit the connection
+			if (len(cParms) > 1):
+				keyword = cParms[1].upper()
+				if (keyword == "HOLD"):
+					return
+			
+			if (_settings.get("hold","OFF") == "OFF"):      # Prepared statements are kept with OPTION HOLD ON
+				clearStatements(_hdbc)
+
+		except Exception as err:
+			db2_error(False)
+		
+		return
+		
+	if (keyword == "ROLLBACK"):                             # Rollback the work that was done
+		try:
+			result = ibm_db.rollback(_hdbc)                  # Rollback the connection
+			clearStatements(_hdbc)
+			invalidateResults()                             # Results may include the work rolled back
+			_inlists.clear()                                # Temporary tables may have been rolled back
+
+		except Exception as err:
+			db2_error(False)
+		
+		return
+	
+	if (keyword == "AUTOCOMMIT"):                           # Is autocommit on or off
+		if (len(cParms) > 1): 
+			op = cParms[1].upper()                          # Need ON or OFF value
+		else:
+			return
+		
+		try:
+			if (op == "OFF"):
+				ibm_db.autocommit(_hdbc, False)
+			elif (op == "ON"):
+				ibm_db.autocommit (_hdbc, True)
+			return    
+		
+		except Exception as err:
+			db2_error(False)
+			return 
+		
+	return
+
+# Flags that are followed by a value (-parallel col) 
+
+_valueflags = ["-parallel","-timeout","-querytimeout","-slicetimeout","-c","-fetchsize","-cache","-incremental","-into"]
+
+# Words that start a statement, so they are never taken as the value of -c or -into
+
+_sqlverbs = ["SELECT","WITH","VALUES","INSERT","UPDATE","DELETE","MERGE","CALL","CREATE","DROP","ALTER","DECLARE",
+			 "SET","COMMIT","ROLLBACK","CONNECT","GRANT","REVOKE","TRUNCATE","COMMENT","LOCK","RENAME","REFRESH",
+			 "USING","DESCRIBE","EXPLAIN","LIST","PREPARE","EXECUTE","OPTION","AUTOCOMMIT","DEFINE"]
 
-def splitargs(arguments):
-	
-	import types
-	
-	# String the string and remove the ( and ) characters if they at the beginning and end of the string
-	
-	results = []
-	
-	step1 = arguments.strip()
-	if (len(step1) == 0): return(results)       # Not much to do here - no args found
-	
-	if (step1[0] == '('):
-		if (step1[-1:] == ')'):
-			step2 = step1[1:-1]
-			step2 = step2.strip()
-		else:
-			step2 = step1
+def flagTakesValue(flag,token):
+
+	# -cache on its own means "use CACHETTL", so the next word is only its value when it is a number or DISK
+
+	if (flag == "-cache"):
+		return token.upper() == "DISK" or re.fullmatch(r'\d+(\.\d*)?|\.\d+',token) != None
+	elif (flag in ("-c","-into")):
+		return re.fullmatch(r'[A-Za-z_][\w$#@]*',token) != None and token.upper() not in _sqlverbs
 	else:
-		step2 = step1
-			
-	# Now we have a string without brackets. Start scanning for commas
-			
-	quoteCH = ""
+		return True
+
+def setFlags(inSQL,reset=False):
+
+	global _flags, _flagvalues
+
+	if (reset == True):
+		_flags = [] # Delete all of the current flag settings
+		_flagvalues = {}
+
 	pos = 0
-	arg = ""
-	args = []
-			
-	while pos < len(step2):
-		ch = step2[pos]
-		if (quoteCH == ""):                     # Are we in a quote?
-			if (ch in ('"',"'")):               # Check to see if we are starting a quote
-				quoteCH = ch
-				arg = arg + ch
-				pos += 1
-			elif (ch == ","):                   # Are we at the end of a parameter?
-				arg = arg.strip()
-				args.append(arg)
-				arg = ""
-				inarg = False 
-				pos += 1
-			else:                               # Continue collecting the string
-				arg = arg + ch
-				pos += 1
+	end = len(inSQL)-1
+	inFlag = False
+	inValue = False
+	ignore = False
+	outSQL = ""
+	flag = ""
+	value = ""
+
+	while (pos <= end):
+		ch = inSQL[pos]
+		if (ignore == True):   
+			outSQL = outSQL + ch
 		else:
-			if (ch == quoteCH):                 # Are we at the end of a quote?
-				arg = arg + ch                  # Add the quote to the string
-				pos += 1                        # Increment past the quote
-				quoteCH = ""                    # Stop quote checking (maybe!)
+			if (inFlag == True):
+				if (ch != " "):
+					flag = flag + ch
+				else:
+					_flags.append(flag)
+					inFlag = False
+					upcoming = inSQL[pos+1:].split(None,1)
+					if (flag in _valueflags and len(upcoming) > 0 and flagTakesValue(flag,upcoming[0])):
+						inValue = True
+						value = ""
+			elif (inValue == True):
+				if (ch != " "):
+					value = value + ch
+				elif (value != ""):
+					_flagvalues[flag] = value
+					inValue = False
 			else:
-				pos += 1
-				arg = arg + ch
+				if (ch == "-"):
+					flag = "-"
+					inFlag = True
+				elif (ch == ' '):
+					outSQL = outSQL + ch
+				else:
+					outSQL = outSQL + ch
+					ignore = True
+		pos += 1
 
-	if (quoteCH != ""):                         # So we didn't end our string
-		arg = arg.strip()
-		args.append(arg)
-	elif (arg != ""):                           # Something left over as an argument
-		arg = arg.strip()
-		args.append(arg)
-	else:
-		pass
+	if (inFlag == True):
+		_flags.append(flag)
+	elif (inValue == True and value != ""):
+		_flagvalues[flag] = value
+
+	return outSQL
+
+def flag(inflag):
 	
+	global _flags
+
+	if isinstance(inflag,list):
+		for x in inflag:
+			if (x in _flags):
+				return True
+		return False
+	else:
+		if (inflag in _flags):
+			return True
+		else:
+			return False
+
+def flagValue(inflag, default=None):
+
+	global _flagvalues
+
+	return _flagvalues.get(inflag, default)
+
+def execSQL(hdbc,sql,quiet=True):
+
+	success = True
+	if (isReadOnly(sql) == False):
+		invalidateResults(sql)
+	try:                                                  # See if we have an answer set
+		stmt = ibm_db.prepare(hdbc,sql)
+		result = ibm_db.execute(stmt)                 # Run it                            
+		if (result == False):                         # Error executing the code
+			db2_error(quiet)
+			success = False
+	except:
+		db2_error(quiet) 
+		success = False
+
+	return success	            
+
+def splitSQL(inputString, delimiter):
+	 
+	pos = 0
+	arg = ""
 	results = []
+	quoteCH = ""
 	
-	for arg in args:
-		result = []
-		if (len(arg) > 0):
-			if (arg[0] in ('"',"'")):
-				value = arg[1:-1]
-				isString = True
-				isNumber = False
+	inSQL = inputString.strip()
+	if (len(inSQL) == 0): return(results)       # Not much to do here - no args found
+			
+	while pos < len(inSQL):
+		ch = inSQL[pos]
+		pos += 1
+		if (ch in ('"',"'")):                   # Is this a quote characters?
+			arg = arg + ch                      # Keep appending the characters to the current arg
+			if (ch == quoteCH):                 # Is this quote character we are in
+				quoteCH = ""
+			elif (quoteCH == ""):               # Create the quote
+				quoteCH = ch
 			else:
-				isString = False 
-				isNumber = False 
-				try:
-					value = eval(arg)
-					if (type(value) == int):
-						isNumber = True
-					elif (isinstance(value,float) == True):
-						isNumber = True
-					else:
-						value = arg
-				except:
-					value = arg
-
+				None
+		elif (quoteCH != ""):                   # Still in a quote
+			arg = arg + ch
+		elif (ch == delimiter):                 # Is there a delimiter?
+			results.append(arg)
+			arg = ""
 		else:
-			value = ""
-			isString = False
-			isNumber = False
+			arg = arg + ch
 			
-		result = [value,isString,isNumber]
-		results.append(result)
+	if (arg != ""):
+		results.append(arg)
 		
-	return results
+	return(results)
 
-def createDF(hdbc,hdbi,sqlin,local_ns):
-	
-	import datetime
-	import ibm_db    
-	
-	global sqlcode, _settings, _parallel
-	
-	NoDF  = False
-	YesDF = True
-	
-	if (hdbc == None or hdbi == None):
-		errormsg("You need to connect to a database before issuing this command.")
-		return NoDF, None
-	
-	# Strip apart the command into tokens based on spaces
-	tokens = sqlin.split()
-	
-	token_count = len(tokens)
-	
-	if (token_count < 5): # Not enough parameters
-		errormsg("Insufficient arguments for USING command")
-		return NoDF, None
-		
-	keyword_command = tokens[0].upper()
-	dfName          = tokens[1]
-	keyword_create  = tokens[2].upper()
-	keyword_table   = tokens[3].upper()
-	table           = tokens[4]           
-	
-	if (dfName not in local_ns):
-		errormsg("The variable ({dfName}) does not exist in the local variable list.")
-		return NoDF, None    
+#
+# Parallel workers. Each worker in the pool keeps its own connection to Db2 which is reused for every
+# slice (and every cell) that the worker runs. The workers are either processes (multiprocessing) or threads
+# in the notebook (OPTION PARALLEL THREADS). Worker state is kept per thread, which is also per process 
+# since a pool process runs its slices on its main thread. The pool is only recreated when the connection,
+# the THREADS or the PARALLEL setting changes, and is closed by CONNECT RESET/CLOSE or when the kernel shuts down.
+#
+
+_worker = threading.local()
+_workerConnections = []                       # Connections opened by worker threads in this process
+_workerLock = threading.Lock()
+
+def init_worker(dsn,tag,registry=None):
+
+	_worker.dsn = dsn
+	_worker.tag = tag
+	_worker.registry = registry if registry != None else _workerConnections
+	_worker.hdbc = None
+	_worker.hdbi = None
+
+	return
+
+def workerTag():
+
+	# The application name given to every worker connection of this notebook so their SQL can be found and cancelled
+
+	import os
+
+	return f"db2magic{os.getpid()}"
+
+def worker_connect(reconnect=False):
+
+	import ibm_db_dbi
+
+	if (getattr(_worker,"hdbc",None) != None and reconnect == False):
+		try:
+			if (ibm_db.active(_worker.hdbc) == True):
+				return _worker.hdbc, _worker.hdbi, ""
+		except:
+			pass
+
+	worker_disconnect()
+
+	try:
+		_worker.hdbc = ibm_db.connect(_worker.dsn, "", "")
+	except Exception as err:
+		try:
+			errmsg = ibm_db.conn_errormsg().replace('\r',' ')
+			errmsg = errmsg[errmsg.rfind("]")+1:].strip()
+		except:
+			errmsg = "Error attempting to retrieve error message"
+		_worker.hdbc = None
+		return None, None, errmsg
+
+	with _workerLock:
+		_worker.registry.append(_worker.hdbc)
+
+	try:
+		ibm_db.set_option(_worker.hdbc,{ibm_db.SQL_ATTR_INFO_APPLNAME: _worker.tag},1)
+	except:
+		pass
+
+	try:
+		_worker.hdbi = ibm_db_dbi.Connection(_worker.hdbc)
+	except Exception as err:
+		worker_disconnect()
+		return None, None, "Connection error when connecting through DBI adapter."
+
+	return _worker.hdbc, _worker.hdbi, ""
+
+def worker_disconnect():
+
+	hdbc = getattr(_worker,"hdbc",None)
+
+	if (hdbc != None):
+		try:
+			ibm_db.close(hdbc)
+		except:
+			pass
+		with _workerLock:
+			if (hdbc in _worker.registry): _worker.registry.remove(hdbc)
+
+	_worker.hdbc = None
+	_worker.hdbi = None
+
+	return
+
+def threadCount():
+
+	# The number of workers in the pool. THREADS AUTO starts the maximum and limits how many are busy.
+
+	threads = _settings.get("threads",0)
+	if (threads == "AUTO"):
+		return _settings.get("maxthreads",32)
+	else:
+		return threads
+
+def getPool(thread_count):
+
+	#
+	# Return the pool of workers and the object used to create queues that the workers can see. Processes
+	# need a Manager for their queues, threads can share a regular queue.
+	#
+
+	global _pool, _poolKey, _manager, _settings
+
+	backend = _settings.get("parallel","PROCESSES")
+
+	key = (buildDSN(_settings), thread_count, backend)
+
+	if (_pool != None and _poolKey == key):
+		return _pool, _manager
+
+	closePool()
 
 	try:
-		dfValue = eval(dfName,None,local_ns) # globals()[varName] # eval(varName)
-	except:
-		errormsg("The variable ({dfName}) does not contain a value.")
-		return NoDF, None     
-   
-	if (keyword_create in ("SELECT","WITH")):
-		
-		if (_parallel == False):
-			errormsg("Parallelism is not availble on this system.")
-			return NoDF, None
- 
-		thread_count = _settings.get("threads",0)
-		if (thread_count in (0,1)):
-			errormsg("The THREADS option is currently set to 0 or 1 which disables parallelism.")
-			return NoDF, None      
-		
-		ok, df = dfSQL(hdbc,hdbi,sqlin,dfName,dfValue,thread_count)
-		
-		if (ok == False):
-			return NoDF, None
+		if (backend == "THREADS"):
+			import concurrent.futures
+			import queue
+			_pool = concurrent.futures.ThreadPoolExecutor(max_workers=thread_count, thread_name_prefix="db2magic", 
+														  initializer=init_worker, initargs=(key[0],workerTag(),))
+			_manager = queue
 		else:
-			return YesDF, df
-				
-	if (isinstance(dfValue,pandas.DataFrame) == False): # Not a Pandas dataframe
-		errormsg("The variable ({dfName}) is not a Pandas dataframe.")
-		return NoDF, None
-	
-	if (keyword_create not in ("CREATE","REPLACE","APPEND") or keyword_table != "TABLE"):
-		errormsg("Incorrect syntax: %sql using <df> create table <name> [options]")
-		return NoDF, None
-	
-	if (token_count % 2 != 1):
-		errormsg("Insufficient arguments for USING command.")
-		return NoDF, None
-		
-	flag_withdata = False
-	flag_asis     = False
-	flag_float    = False
-	flag_integer  = False
-	limit         = -1
-		
-	for token_idx in range(5,token_count,2):
+			_pool = mp.Pool(processes=thread_count, initializer=init_worker, initargs=(key[0],workerTag(),))
+			_manager = mp.Manager()
+		_poolKey = key
+	except Exception as err:
+		errormsg("Unable to start the parallel workers: " + repr(err))
+		closePool()
+		return None, None
 
-		option_key = tokens[token_idx].upper()
-		option_val = tokens[token_idx+1].upper()
-		if (option_key == "WITH" and option_val == "DATA"):
-			flag_withdata = True
-		elif (option_key == "COLUMNS" and option_val == "ASIS"):
-			flag_asis = True
-		elif (option_key == "KEEP" and option_val == "FLOAT64"):
-			flag_float = True
-		elif (option_key == "KEEP" and option_val == "INT64"):
-			flag_integer = True
-		elif (option_key == "LIMIT"):
-			if (option_val.isnumeric() == False):
-				errormsg("The LIMIT must be a valid number from -1 (unlimited) to the maximun number of rows to insert")
-				return NoDF, None
-			limit = int(option_val)
-		else:
-			errormsg("Invalid options. Must be either WITH DATA | COLUMNS ASIS | KEEP FLOAT64 | KEEP FLOAT INT64")
-			return NoDF, None   
+	return _pool, _manager
 
-	if (keyword_create == "REPLACE"):
-		sql = f"DROP TABLE {table}"
-		ok = execSQL(hdbc,sql,quiet=True)   
+def closePool():
 
-	sql = [] 
-	columns = dict(dfValue.dtypes)
-	sql.append(f'CREATE TABLE {table} (')
-	datatypes = []
-	comma = ""
-	for column in columns:
-		datatype = str(columns[column])
-		datatype = datatype.upper()
+	global _pool, _poolKey, _manager
 
-		if (datatype == "OBJECT"):
-			datapoint = dfValue[column][0]
-			if (isinstance(datapoint,datetime.datetime)):
-				type = "TIMESTAMP"
-			elif (isinstance(datapoint,datetime.time)):
-				type = "TIME"
-			elif (isinstance(datapoint,datetime.date)):
-				type = "DATE"
-			elif (isinstance(datapoint,float)):
-				if (flag_float == True):
-					type = "FLOAT"
-				else:
-					type = "DECFLOAT"
-			elif (isinstance(datapoint,int)):
-				if (flag_integer == True):
-					type = "BIGINT"
-				else:
-					type = "INTEGER"
-			elif (isinstance(datapoint,str)):
-				maxlength = dfValue[column].apply(str).apply(len).max()
-				type = f"VARCHAR({maxlength})"
-			else:
-				type = "CLOB"
-		elif (datatype == "INT64"):
-			type = "BIGINT"
-		elif (datatype == "INT32"):
-			type = "INT"
-		elif (datatype == "INT16"):
-			type = "SMALLINT"
-		elif (datatype == "FLOAT64"):
-			if (flag_float == True):
-				type = "FLOAT"
+	if (_pool != None):
+		try:
+			if (_poolKey != None and _poolKey[2] == "THREADS"):
+				_pool.shutdown(wait=True)
 			else:
-				type = "DECFLOAT"
-		elif (datatype == "FLOAT32"):
-			if (flag_float == True):
-				type = "REAL"
+				_pool.terminate()
+				_pool.join()
+		except:
+			pass
+
+	with _workerLock:                            # Connections left behind by worker threads
+		for hdbc in _workerConnections:
+			try:
+				ibm_db.close(hdbc)
+			except:
+				pass
+		_workerConnections.clear()
+
+	if (_manager != None and hasattr(_manager,"shutdown")):
+		try:
+			_manager.shutdown()
+		except:
+			pass
+
+	_pool = None
+	_poolKey = None
+	_manager = None
+
+	return
+
+def process_slice(dfName, dfValue, pd_dtypes, sql, q, s, arrow=False, raw=False, timeout=0, prefetch=False, fetchsize=0):
+	
+	import numpy as np    
+	import pandas as pd
+
+	if (q.empty() == False): return None
+
+	if (raw == True):
+		pass
+	elif (isinstance(dfValue,list) == True or isinstance(dfValue,tuple) == True):
+		encoded_sql = ""
+		start = True
+		for v in dfValue:
+			if (start == False):
+				encoded_sql = encoded_sql + ","
+			if (isinstance(v,str) == True):
+				encoded_sql = encoded_sql + addquotes(v,True)
 			else:
-				type = "DECFLOAT"
-		elif ("DATETIME64" in datatype):
-			type = "TIMESTAMP"
-		elif (datatype == "BOOLEAN"):
-			type = "BINARY"
-		elif (datatype == "STRING"):
-			maxlength = dfValue[column].apply(str).apply(len).max()
-			type = f"VARCHAR({maxlength})"
-		else:
-			type = "CLOB"
-			
-		datatypes.append(type)    
+				encoded_sql = encoded_sql + str(v)
+			start = False
 
-		if (flag_asis == False):
-			if (isinstance(column,str) == False):
-				column = str(column)
-			identifier = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
-			column_name = column.strip().upper()
-			new_name = ""
-			for ch in column_name:
-				if (ch not in identifier):
-					new_name = new_name + "_"
-				else:
-					new_name = new_name + ch
-					
-			new_name = new_name.lstrip('_').rstrip('_')
-			
-			if (new_name == "" or new_name[0] not in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"):
-				new_name = f'"{column}"'
-		else:
-			new_name = f'"{column}"'
-		
-		sql.append(f"    {new_name} {type}")
-	sql.append(")")
+		dfValue = encoded_sql
+	elif (isinstance(dfValue,str) == True):
+		dfValue = addquotes(dfValue,True)
+	else:
+		dfValue = str(dfValue)
 
-	sqlcmd = ""
-	for i in range(0,len(sql)):
-		if (i > 0 and i < len(sql)-2):
-			comma = ","
-		else:
-			comma = ""
-		sqlcmd = "{}\n{}{}".format(sqlcmd,sql[i],comma)
-		
-	if (keyword_create != "APPEND"):
-		print(sqlcmd)
-		ok = execSQL(hdbc,sqlcmd,quiet=False)
-		if (ok == False):
-			return NoDF, None
+	if (q.empty() == False): return None
 
-	if (flag_withdata == True or keyword_create == "APPEND"):
+	# Reuse the connection this worker already has open (or open one if this is the first slice)
+
+	hdbc, hdbi, errmsg = worker_connect()
+	if (hdbc == None):
+		q.put(errmsg)
+		return None
+
+	if (q.empty() == False): return None
+
+	# The Db2 query timeout (0 = no limit) is set on the connection so it applies to the slice's statement
+
+	try:
+		ibm_db.set_option(hdbc,{ibm_db.SQL_ATTR_QUERY_TIMEOUT: timeout},1)
+	except:
+		pass
 		
-		autocommit = ibm_db.autocommit(hdbc)
-		ibm_db.autocommit(hdbc,False)
+	protoSQL = sql.replace(f":{dfName}",dfValue)
+
+	s.put(protoSQL)
+
+	if (q.empty() == False): return None	
+
+	for attempt in (1,2):
+		try:
+			stmt = prepareRead(hdbc,protoSQL)
+			setPrefetch(stmt,prefetch)
+			if (ibm_db.execute(stmt) == False):
+				raise Exception("Execute failed")
+			df = fetchFrame(stmt,pd_dtypes,fetchsize)
+			ibm_db.free_stmt(stmt)
+			break
+		except:
+			try:
+				errmsg = ibm_db.stmt_errormsg().replace('\r',' ')
+				errmsg = errmsg[errmsg.rfind("]")+1:].strip()		
+			except:
+				errmsg = "Error attempting to retrieve statement error message."
+
+			# A dropped connection is reopened and the slice is tried one more time
+
+			try:
+				alive = ibm_db.active(hdbc)
+			except:
+				alive = False
+
+			if (alive == False and attempt == 1):
+				hdbc, hdbi, connmsg = worker_connect(reconnect=True)
+				if (hdbc != None): continue
+
+			q.put(errmsg)
+			return None
+
+	if (q.empty() == False): return None
+
+	if (arrow == True):
+		return slice_to_arrow(df)
+			  
+	return df
+
+def slice_to_arrow(df):
+
+	#
+	# Write the slice as an Arrow IPC stream into a memory-mapped file (in /dev/shm when available) and 
+	# return only the name of the file. The notebook maps the file directly instead of unpickling a copy 
+	# of the rows. The dataframe is returned unchanged if the file can't be written.
+	#
+
+	import os
+	import tempfile
+
+	fname = None
+
+	try:
+		import pyarrow as pa
+
+		table = pa.Table.from_pandas(df, preserve_index=False)
+
+		tempdir = "/dev/shm" if os.access("/dev/shm",os.W_OK) else None
+		handle, fname = tempfile.mkstemp(prefix=getattr(_worker,"tag","db2magic") + "_", suffix=".arrow", dir=tempdir)
+		os.close(handle)
+
+		with pa.OSFile(fname,"wb") as sink:
+			with pa.ipc.new_stream(sink, table.schema) as writer:
+				writer.write_table(table)
+
+	except Exception as err:
+		if (fname != None):
+			discard_arrow([("ARROW",fname)])
+		return df
+
+	return ("ARROW", fname, table.num_rows)
+
+def slice_from_arrow(result):
+
+	# Map an Arrow stream written by slice_to_arrow. The file is removed right away, but the pages stay
+	# available until Arrow releases the last buffer that refers to them.
+
+	import os
+
+	source = pa.memory_map(result[1],"r")
+	table = pa.ipc.open_stream(source).read_all()
+
+	try:
+		os.unlink(result[1])
+	except:
+		atexit.register(discard_arrow,[result])            # Windows can't remove a mapped file
 
-		row_count = 0
-		insert_sql = ""
-		rows, cols = dfValue.shape
-		for row in range(0,rows):
- 
-			insert_row = ""
-			for col in range(0, cols):
-				
-				value = dfValue.iloc[row][col]
-				value = str(value)
-				
-				if (value.upper() in ("NAN","<NA>","NAT")):
-					value = "NULL"
-				else:
-					addquotes_flag = False
-					if (datatypes[col] == "CLOB" or "VARCHAR" in datatypes[col]):
-						addquotes_flag = True
-					elif (datatypes[col] in ("TIME","DATE","TIMESTAMP")):
-						addquotes_flag = True
-					elif (datatypes[col] in ("INTEGER","INT","SMALLINT","BIGINT","DECFLOAT","FLOAT","BINARY","REAL")):
-						addquotes_flag = False
-					else:
-						addquotes_flag = True
-						
-					if (addquotes_flag == True):
-						value = addquotes(value,True)
-					  
-				if (insert_row == ""):
-					insert_row = f"{value}"
-				else:
-					insert_row = f"{insert_row},{value}"
-					  
-			if (insert_sql == ""):
-				insert_sql = f"INSERT INTO {table} VALUES ({insert_row})"
-			else:
-				insert_sql = f"{insert_sql},({insert_row})"
-					  
-			row_count += 1
-			if (row_count % 1000 == 0 or row_count == limit):
-				try:
-					result = ibm_db.exec_immediate(hdbc, insert_sql)                 # Run it 
-				except:
-					db2_error(False)
-					return NoDF, None
+	return table
 
-				ibm_db.commit(hdbc)
+def discard_arrow(output):
 
-				print(f"\r{row_count} of {rows} rows inserted.",end="")
-					
-				insert_sql = ""
-				
-			if (row_count == limit):
-				break
-					  
-		if (insert_sql != ""):
+	# Remove the files of slices that will not be used (another slice failed)
+
+	import os
+
+	for result in output:
+		if (isinstance(result,tuple) == True):
 			try:
-				result = ibm_db.exec_immediate(hdbc, insert_sql)                 # Run it                            
+				os.unlink(result[1])
 			except:
-				db2_error(False)       
-				return NoDF, None
+				pass
 
-			ibm_db.commit(hdbc)
+	return
 
-		ibm_db.autocommit(hdbc,autocommit)
+def assembleSlices(output):
 
-		print("\nInsert completed.")
-					  
-	return NoDF, None
+	#
+	# Combine the slice results in their original order. Arrow slices are concatenated as one table 
+	# (which only references the mapped files) and converted to a dataframe once, releasing each column
+	# as it is converted.
+	#
 
-def sqlParser(sqlin,local_ns):
-	   
-	sql_cmd = ""
-	encoded_sql = sqlin
-	
-	firstCommand = "(?:^\s*)([a-zA-Z]+)(?:\s+.*|$)"
+	if (all(isinstance(x,pandas.DataFrame) for x in output) == True):
+		finaldf = pandas.concat(output)
+		finaldf.reset_index(drop=True, inplace=True)
+		return finaldf
+
+	tables = []
+
+	try:
+		for result in output:
+			if (isinstance(result,pandas.DataFrame) == True):
+				tables.append(pa.Table.from_pandas(result, preserve_index=False))
+			else:
+				tables.append(slice_from_arrow(result))
+	except Exception as err:
+		discard_arrow(output)
+		raise
+
+	try:
+		combined = pa.concat_tables(tables, promote_options="permissive")
+	except TypeError:                                         # pyarrow before 14.0
+		combined = pa.concat_tables(tables, promote=True)
+	del tables
+
+	finaldf = combined.to_pandas(split_blocks=True, self_destruct=True)
+	del combined
+
+	return finaldf
+
+def dfSQL(hdbc,hdbi,sqlin,dfName,dfValue,thread_count):
 	
-	findFirst = re.match(firstCommand,sqlin)
+	import shlex
+
+	NoDF  = False
+	YesDF = True
+
+	sqlin = " ".join(shlex.split(sqlin)) 
+
+	if (hdbc == None or hdbi == None or sqlin in (None, "")):
+		return NoDF,None
 	
-	if (findFirst == None): # We did not find a match so we just return the empty string
-		return sql_cmd, encoded_sql
+	uSQLin = sqlin.upper()
+	  
+	select_location = uSQLin.find("SELECT")
+	with_location   = uSQLin.find("WITH")
+
+	if (select_location == -1):
+		errormsg("SQL statement does not contain a SELECT statement.")
+		return NoDF, None          
+	  
+	if (with_location != -1 and (with_location < select_location)):
+		keyword_location = with_location
+	else:
+		keyword_location = select_location
+		
+	sql = sqlin[keyword_location:]
+
+	keyword_location = sql.find(f":{dfName}")
+	   
+	if (keyword_location == -1):
+		errormsg(f"The parallelism value ({dfName}) was not found in the SQL statement")
+		return NoDF, None
 	
-	cmd = findFirst.group(1)
-	sql_cmd = cmd.upper()
+	if (isinstance(dfValue,list) == False):
+		errormsg(f"The variable {dfName} is not an array or a list of values.")
+		return NoDF, None
+
+	return runSlices(hdbc,sql,dfName,dfValue,thread_count,stream=flag("-stream"))
+
+def runSlices(hdbc,sql,dfName,slices,thread_count,raw=False,stream=False,combine=True):
 
 	#
-	# Scan the input string looking for variables in the format :var. If no : is found just return.
-	# Var must be alpha+number+_ to be valid
+	# Run the SQL once for every slice value using the pool of parallel workers. When raw is True the slice
+	# values are SQL text (range predicates) that are substituted without quoting. Results are collected in
+	# the order the slices finish. With stream=True a generator is returned that produces each slice as a
+	# dataframe as soon as it is available, instead of one combined dataframe. The first failing slice, 
+	# an interrupt, or the -timeout limit cancels the slices that are still running. With combine=False a list
+	# with one dataframe per slice is returned (the slices are different statements).
 	#
-	
-	if (':' not in sqlin): # A quick check to see if parameters are in here, but not fool-proof!         
-		return sql_cmd, encoded_sql    
-	
-	inVar = False 
-	inQuote = "" 
-	varName = ""
-	encoded_sql = ""
-	
-	STRING = 0
-	NUMBER = 1
-	LIST = 2
-	RAW = 3
-	PANDAS = 5
-	
-	for ch in sqlin:
-		if (inVar == True): # We are collecting the name of a variable
-			if (ch.upper() in "@_ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789[]"):
-				varName = varName + ch
-				continue
-			else:
-				if (varName == ""):
-					encode_sql = encoded_sql + ":"
-				elif (varName[0] in ('[',']')):
-					encoded_sql = encoded_sql + ":" + varName
-				else:
-					if (ch == '.'): # If the variable name is stopped by a period, assume no quotes are used
-						flag_quotes = False
-					else:
-						flag_quotes = True
-					varValue, varType = getContents(varName,flag_quotes,local_ns)
-					if (varType != PANDAS and varValue == None):                 
-						encoded_sql = encoded_sql + ":" + varName
-					else:
-						if (varType == STRING):
-							encoded_sql = encoded_sql + varValue
-						elif (varType == NUMBER):
-							encoded_sql = encoded_sql + str(varValue)
-						elif (varType == RAW):
-							encoded_sql = encoded_sql + varValue
-						elif (varType == PANDAS):
-							insertsql = ""
-							coltypes = varValue.dtypes
-							rows, cols = varValue.shape
-							for row in range(0,rows):
-								insertrow = ""
-								for col in range(0, cols):
-									value = varValue.iloc[row][col]
-									if (coltypes[col] == "object"):
-										value = str(value)
-										value = addquotes(value,True)
-									else:
-										strvalue = str(value)
-										if ("NAN" in strvalue.upper()):
-											value = "NULL"    
-									if (insertrow == ""):
-										insertrow = f"{value}"
-									else:
-										insertrow = f"{insertrow},{value}"
-								if (insertsql == ""):
-									insertsql = f"({insertrow})"
-								else:
-									insertsql = f"{insertsql},({insertrow})"  
-							encoded_sql = encoded_sql + insertsql
-						elif (varType == LIST):
-							start = True
-							for v in varValue:
-								if (start == False):
-									encoded_sql = encoded_sql + ","
-								if (isinstance(v,int) == True):         # Integer value 
-									encoded_sql = encoded_sql + str(v)
-								elif (isinstance(v,float) == True):
-									encoded_sql = encoded_sql + str(v)
-								else:
-									flag_quotes = True
-									try:
-										if (v.find('0x') == 0):               # Just guessing this is a hex value at beginning
-											encoded_sql = encoded_sql + v
-										else:
-											encoded_sql = encoded_sql + addquotes(v,flag_quotes)      # String
-									except:
-										encoded_sql = encoded_sql + addquotes(str(v),flag_quotes)                                   
-								start = False
 
-				encoded_sql = encoded_sql + ch
-				varName = ""
-				inVar = False  
-		elif (inQuote != ""):
-			encoded_sql = encoded_sql + ch
-			if (ch == inQuote): inQuote = ""
-		elif (ch in ("'",'"')):
-			encoded_sql = encoded_sql + ch
-			inQuote = ch
-		elif (ch == ":"): # This might be a variable
-			varName = ""
-			inVar = True
-		else:
-			encoded_sql = encoded_sql + ch
+	global sqlcode
+
+	NoDF  = False
+	YesDF = True
+
+	dfValue = slices
+
+	#	Create a prototype statement to make sure the SQL will run
 	
-	if (inVar == True):
-		varValue, varType = getContents(varName,True,local_ns) # We assume the end of a line is quoted
-		if (varType != PANDAS and varValue == None):                 
-			encoded_sql = encoded_sql + ":" + varName  
-		else:
-			if (varType == STRING):
-				encoded_sql = encoded_sql + varValue
-			elif (varType == RAW):
-				encoded_sql = encoded_sql + varValue                
-			elif (varType == NUMBER):
-				encoded_sql = encoded_sql + str(varValue)
-			elif (varType == PANDAS):
-				insertsql = ""
-				coltypes = varValue.dtypes
-				rows, cols = varValue.shape
-				for row in range(0,rows):
-					insertrow = ""
-					for col in range(0, cols):
-						value = varValue.iloc[row][col]
-						if (coltypes[col] == "object"):
-							value = str(value)
-							value = addquotes(value,True)
-						else:
-							strvalue = str(value)
-							if ("NAN" in strvalue.upper()):
-								value = "NULL"    
-						if (insertrow == ""):
-							insertrow = f"{value}"
-						else:
-							insertrow = f"{insertrow},{value}"
-					if (insertsql == ""):
-						insertsql = f"({insertrow})"
-					else:
-						insertsql = f"{insertsql},({insertrow})"  
-				encoded_sql = encoded_sql + insertsql                
-			elif (varType == LIST):
-				flag_quotes = True
-				start = True
-				for v in varValue:
-					if (start == False):
-						encoded_sql = encoded_sql + ","
-					if (isinstance(v,int) == True):         # Integer value 
-						encoded_sql = encoded_sql + str(v)
-					elif (isinstance(v,float) == True):
-						encoded_sql = encoded_sql + str(v)
-					else:
-						try:
-							if (v.find('0x') == 0):               # Just guessing this is a hex value
-								encoded_sql = encoded_sql + v
-							else:
-								encoded_sql = encoded_sql + addquotes(v,flag_quotes)              # String
-						except:
-							encoded_sql = encoded_sql + addquotes(str(v),flag_quotes)                                 
-					start = False
+	protoValue = dfValue[0]
 
-	return sql_cmd, encoded_sql
+	if (raw == True):
+		pass
+	elif (isinstance(protoValue,list) == True or isinstance(protoValue,tuple) == True):
+		if (len(protoValue) == 0):
+			errormsg(f"The variable {dfName} contains array values that are empty.")
+			return NoDF, None				
+		protoValue = protoValue[0]
 
-def plotData(hdbi, sql):
+	if (raw == True):
+		pass
+	elif (isinstance(protoValue,str) == True):
+		protoValue = addquotes(protoValue,True)
+	else:
+		protoValue = str(protoValue)
+		   
+	protoSQL = sql.replace(f":{dfName}",protoValue)
 	
 	try:
-		df = pandas.read_sql(sql,hdbi)
-		  
+		stmt = ibm_db.prepare(hdbc,protoSQL)
+
+		if (ibm_db.num_fields(stmt) == 0):                
+			errormsg("The SQL statement does not return an answer set.")
+			return NoDF, None
+  
 	except Exception as err:
 		db2_error(False)
-		return
-				
-		
-	if df.empty:
-		errormsg("No results returned")
-		return
+		return NoDF, None
+
+	#	Determine the datatypes for a Pandas dataframe if it is supported
+
+	# The same types as a serial query (fetchFrame converts the values in the slices the same way too)
+
+	pd_dtypes = pandasTypes(stmt) if combine == True else None
 	
-	col_count = len(df.columns)
+	try:
+		timeout = float(flagValue("-timeout",0))
+		slicetimeout = int(flagValue("-slicetimeout",statementTimeout()))
+	except:
+		errormsg("The -timeout and -slicetimeout values must be a number of seconds.")
+		return NoDF, None
 
-	if flag(["-pb","-bar"]):                                    # Plot 1 = bar chart
+	pool, m  = getPool(thread_count)
+	if (pool == None):
+		return NoDF, None
+
+	q		 = m.Queue()	
+	tracesql = m.Queue()
 	
-		if (col_count in (1,2,3)):
-			
-			if (col_count == 1):
- 
-				df.index = df.index + 1
-				_ = df.plot(kind='bar');
-				_ = plt.plot();
-				
-			elif (col_count == 2):
- 
-				xlabel = df.columns.values[0]
-				ylabel = df.columns.values[1]
-				df.plot(kind='bar',x=xlabel,y=ylabel);
-				_ = plt.plot();
-				
+	threads = (_settings.get("parallel","PROCESSES") == "THREADS")
+
+	if (threads == True):
+		arrow = False                               # Threads share the dataframes directly
+	else:
+		arrow = loadArrow()
+
+	try:
+		control = startSlices(hdbc,pool,q,process_slice,(dfName,pd_dtypes,sql,q,tracesql,arrow,raw,slicetimeout,prefetchOn(),fetchSize()),dfValue,thread_count)
+	except Exception as err:
+		print(repr(err))
+		return NoDF, None        
+
+	deadline = time.time() + timeout if timeout > 0 else None
+
+	if (stream == True):
+		slices = streamSlices(sliceResults(control,flag(["-q","-quiet"]),deadline),q,tracesql)
+		weakref.finalize(slices,abandonSlices,control)      # Also run at exit if the generator is still around
+		return YesDF, slices
+
+	ok, output = gatherSlices(control,deadline)
+
+	traceSlices(tracesql)
+
+	if (ok == False):
+		return NoDF, None      
+
+	try:
+		if (combine == False):
+			return YesDF, [assembleSlices([x]) for x in output]
+		finaldf = assembleSlices(output)
+	except Exception as err:
+		errormsg("Unable to combine the parallel results: " + repr(err))
+		return NoDF, None
+	
+	if (len(finaldf) == 0):
+		sqlcode = 100
+		errormsg("No rows found")
+		return NoDF, None    
+
+	return YesDF, finaldf
+
+def startSlices(hdbc,pool,q,worker,args,slices,thread_count):
+
+	#
+	# Start running worker(args[0], slice, args[1:]...) for every slice and return the control block that 
+	# the dispatcher, the completion callbacks and sliceResults share. q is the error queue of the workers.
+	#
+
+	import queue
+
+	auto = (_settings.get("threads",0) == "AUTO")
+
+	control = {
+		"hdbc"      : hdbc,
+		"pool"      : pool,
+		"threads"   : (_settings.get("parallel","PROCESSES") == "THREADS"),
+		"q"         : q,
+		"worker"    : worker,
+		"args"      : args,
+		"slices"    : slices,
+		"completed" : queue.Queue(),                # (slice number, result, exception) as each slice finishes
+		"lock"      : threading.RLock(),            # Callbacks can run inside dispatchSlices
+		"next"      : 0,
+		"running"   : 0,
+		"delivered" : 0,                            # Results handed to the reader by sliceResults
+		"stopped"   : False,
+		"auto"      : auto,
+		"ceiling"   : thread_count,
+		"limit"     : min(2,thread_count) if auto else thread_count,
+		"peak"      : 0,
+		"started"   : {},
+		"round"     : [],
+		"roundstart": time.time(),
+		"best"      : 0,
+		"settle"    : 0,
+		"bestlatency" : 0
+	}
+
+	dispatchSlices(control)
+
+	return control
+
+def gatherSlices(control,deadline=None):
+
+	#
+	# Wait for all of the slices and return them in slice order. The first failure, an interrupt or the
+	# deadline cancels the rest, and (False, None) is returned after the error has been displayed.
+	#
+
+	q = control["q"]
+	output = [None] * len(control["slices"])
+
+	results = sliceResults(control,flag(["-q","-quiet"]),deadline)
+
+	badresults = False
+	reported = False
+
+	try:
+		for index, df, err in results:
+			if (err != None):
+				print(repr(err))
+				badresults = True
+			elif (isinstance(df,pandas.DataFrame) == True):
+				output[index] = df
+			elif (isinstance(df,tuple) == True and df[0] == "ARROW"):
+				output[index] = df
 			else:
- 
-				values = df.columns.values[2]
-				columns = df.columns.values[0]
-				index = df.columns.values[1]
-				pivoted = pandas.pivot_table(df, values=values, columns=columns, index=index) 
-				_ = pivoted.plot.bar(); 
-			
-		else:
-			errormsg("Can't determine what columns to plot")
-			return
-					
-	elif flag(["-pp","-pie"]):                                  # Plot 2 = pie chart
-		
-		if (col_count in (1,2)):  
-				
-			if (col_count == 1):
-				df.index = df.index + 1
-				yname = df.columns.values[0]
-				_ = df.plot(kind='pie',y=yname);                
-			else:          
-				xlabel = df.columns.values[0]
-				xname = df[xlabel].tolist()
-				yname = df.columns.values[1]
-				_ = df.plot(kind='pie',y=yname,labels=xname);
-				
-			plt.show();
-			
-		else:
-			errormsg("Can't determine what columns to plot")
-			return
-					
-	elif flag(["-pl","-line"]):                                  # Plot 3 = line chart
-			
-		if (col_count in (1,2,3)): 
-			
-			if (col_count == 1):
-				df.index = df.index + 1  
-				_ = df.plot(kind='line');          
-			elif (col_count == 2):            
-				xlabel = df.columns.values[0]
-				ylabel = df.columns.values[1]
-				_ = df.plot(kind='line',x=xlabel,y=ylabel) ; 
-			else:         
-				values = df.columns.values[2]
-				columns = df.columns.values[0]
-				index = df.columns.values[1]
-				pivoted = pandas.pivot_table(df, values=values, columns=columns, index=index)
-				_ = pivoted.plot();
-				
-			plt.show();
-				
-		else:
-			errormsg("Can't determine what columns to plot")
-			return
+				badresults = True
+			if (badresults == True): 
+				break                                       # Stop the other slices right away
+	except KeyboardInterrupt:
+		errormsg("The parallel query was interrupted and the remaining slices were cancelled.")
+		badresults = reported = True
+	except TimeoutError:
+		errormsg(f"The parallel query did not finish within {flagValue('-timeout')} seconds and was cancelled.")
+		badresults = reported = True
+	finally:
+		results.close()
+
+	if (badresults == True):
+		discard_arrow(output)
+		if (q.empty() == False and reported == False):
+			errormsg(q.get())
+		return False, None      
+
+	return True, output
+
+def dispatchSlices(control):
+
+	#
+	# Start slices until the number running reaches the concurrency limit. Called once to start the query and
+	# again each time a slice finishes. For a fixed THREADS value the limit is the size of the pool.
+	#
+
+	with control["lock"]:
+		while (control["stopped"] == False and control["running"] < control["limit"] and control["next"] < len(control["slices"])):
+			index = control["next"]
+			control["next"] = index + 1
+			control["running"] = control["running"] + 1
+			control["peak"] = max(control["peak"],control["running"])
+			control["started"][index] = time.time()
+			args = (control["args"][0],control["slices"][index]) + control["args"][1:]
+			try:
+				if (control["threads"] == True):
+					future = control["pool"].submit(control["worker"],*args)
+					future.add_done_callback(lambda f, i=index: sliceDone(control,i,None,f.exception()) if f.exception() != None else sliceDone(control,i,f.result(),None))
+				else:
+					control["pool"].apply_async(control["worker"], args=args,
+								 callback=lambda r, i=index: sliceDone(control,i,r,None),
+								 error_callback=lambda e, i=index: sliceDone(control,i,None,e))
+			except Exception as err:
+				if (index == 0): raise
+				control["completed"].put((index,None,err))      # Pool was stopped by a cancel
+
+	return
+
+def sliceDone(control,index,result,err):
+
+	# Completion callback for a slice (runs on a pool thread, not the notebook's thread). Once the query has 
+	# been cancelled nothing reads the results any more, so the Arrow file of a slice that finishes late is 
+	# removed here.
+
+	with control["lock"]:                           # cancelSlices sets stopped under the same lock
+		control["running"] = control["running"] - 1
+		stopped = control["stopped"]
+		if (stopped == False):
+			if (control["auto"] == True):
+				adjustConcurrency(control,index,result)
+			control["completed"].put((index,result,err))
+
+	if (stopped == True):
+		discard_arrow([result])
+		return
+
+	dispatchSlices(control)
+
+	return
+
+def adjustConcurrency(control,index,result):
+
+	#
+	# THREADS AUTO uses additive increase, multiplicative decrease (AIMD). After each round of slices (one
+	# round is as many slices as the current limit) the throughput and average slice latency are compared to
+	# the best seen so far. The limit grows by one while the server keeps up, and is halved when throughput 
+	# drops or latency doubles, which means that the extra slices are only waiting on each other.
+	#
+
+	if (isinstance(result,pandas.DataFrame) == True):
+		rows = len(result)
+	elif (isinstance(result,tuple) == True and result[0] == "ARROW"):
+		rows = result[2]
 	else:
+		rows = 0
+
+	latency = time.time() - control["started"].pop(index,time.time())
+
+	if (control["settle"] > 0):                          # Slices started before the last change are ignored
+		control["settle"] = control["settle"] - 1
+		if (control["settle"] == 0): control["roundstart"] = time.time()
 		return
 
-def getContents(varName,flag_quotes,local_ns):
-	
+	control["round"].append((latency, rows))
+
+	if (len(control["round"]) < max(control["limit"],4)):
+		return
+
+	elapsed = max(time.time() - control["roundstart"],0.001)
+	rows = sum(x[1] for x in control["round"])
+	throughput = (rows if rows > 0 else len(control["round"])) / elapsed
+	latency = sum(x[0] for x in control["round"]) / len(control["round"])
+
+	if (control["best"] == 0):
+		control["best"] = throughput
+		control["bestlatency"] = latency
+		control["limit"] = control["limit"] + 1
+	elif (throughput < control["best"] * 0.5 or latency > control["bestlatency"] * 2):
+		control["limit"] = max(2,control["limit"] // 2)
+		control["settle"] = control["running"]
+		control["best"] = throughput                             # Measure again from the lower limit
+	else:
+		control["best"] = max(control["best"],throughput)
+		control["bestlatency"] = min(control["bestlatency"],latency)
+		control["limit"] = control["limit"] + 1
+
+	control["limit"] = min(control["limit"],control["ceiling"])
+	control["round"] = []
+	control["roundstart"] = time.time()
+
+	return
+
+def sliceResults(control,quiet=False,deadline=None):
+
 	#
-	# Get the contents of the variable name that is passed to the routine. Only simple
-	# variables are checked, i.e. arrays and lists are not parsed
+	# Generator that returns (slice number, result, exception) for each slice in the order they finish and
+	# keeps a progress line with the number of slices done, rows received and rows/sec. TimeoutError is 
+	# raised when the deadline passes. If the generator is closed early the remaining slices are cancelled.
 	#
-	
-	STRING = 0
-	NUMBER = 1
-	LIST = 2
-	RAW = 3
-	DICT = 4
-	PANDAS = 5
-	
+
+	import queue
+
+	completed = control["completed"]
+	count = len(control["slices"])
+	start = time.time()
+	done = 0
+	rows = 0
+
 	try:
-		value = eval(varName,None,local_ns) # globals()[varName] # eval(varName)
+		while (done < count):
+			try:
+				index, result, err = completed.get(timeout=0.25)   # Short waits so interrupts are handled quickly
+			except queue.Empty:
+				if (deadline != None and time.time() > deadline):
+					raise TimeoutError("Parallel query timeout")
+				continue
+			done = done + 1
+			if (isinstance(result,pandas.DataFrame) == True):
+				rows = rows + len(result)
+			elif (isinstance(result,tuple) == True and result[0] == "ARROW"):
+				rows = rows + result[2]
+			if (quiet == False):
+				showProgress(done,count,rows,time.time()-start)
+			control["delivered"] = done
+			yield index, result, err
+	finally:
+		if (quiet == False and done > 0):
+			print("")
+		if (done < count):
+			cancelSlices(control)
+		elif (control["auto"] == True and quiet == False):
+			print(f"THREADS AUTO: {control['limit']} slices in flight at the end of the query (peak {control['peak']}, maximum {control['ceiling']})")
+
+def cancelSlices(control):
+
+	#
+	# Stop a parallel query. Slices that haven't started see the message in the error queue and return
+	# immediately, and statements that are running are cancelled on the server. Worker processes are 
+	# terminated (and restarted by the next query) since the slice they are running can't be interrupted
+	# any other way, and the Arrow files they left behind are removed. Worker threads are left to finish
+	# the statement they are running, and their results are ignored.
+	#
+
+	import glob
+	import os
+	import tempfile
+
+	with control["lock"]:
+		control["stopped"] = True
+
+	try:
+		control["q"].put("The parallel query was cancelled.")
 	except:
-		return(None,STRING)
-	
-	if (isinstance(value,dict) == True):          # Check to see if this is JSON dictionary
-		return(addquotes(value,flag_quotes),STRING)
+		pass
 
-	elif(isinstance(value,list) == True or isinstance(value,tuple) == True):         # List - tricky 
-		return(value,LIST)
-	
-	elif (isinstance(value,pandas.DataFrame) == True): # Pandas dataframe
-		return(value,PANDAS)
+	cancelActivities(control["hdbc"],workerTag())
 
-	elif (isinstance(value,int) == True):         # Integer value 
-		return(value,NUMBER)
+	if (control["threads"] == True):
+		return
 
-	elif (isinstance(value,float) == True):       # Float value
-		return(value,NUMBER)
+	global _pool, _poolKey
 
-	else:
+	if (_pool != None):                                  # The manager is kept so the queues can still be read
 		try:
-			# The pattern needs to be in the first position (0 in Python terms)
-			if (value.find('0x') == 0):               # Just guessing this is a hex value
-				return(value,RAW)
-			else:
-				return(addquotes(value,flag_quotes),STRING)                     # String
+			_pool.terminate()
+			_pool.join()
 		except:
-			return(addquotes(str(value),flag_quotes),RAW)
-
-def addquotes(inString,flag_quotes):
-	
-	if (isinstance(inString,dict) == True):          # Check to see if this is JSON dictionary
-		serialized = json.dumps(inString) 
-	else:
-		serialized = inString
+			pass
+		_pool = None
+		_poolKey = None
 
-	# Replace single quotes with '' (two quotes) and wrap everything in single quotes
-	if (flag_quotes == False):
-		return(serialized)
-	else:
-		return("'"+serialized.replace("'","''")+"'")    # Convert single quotes to two single quotes
-	
-def checkOption(args_in, option, vFalse=False, vTrue=True):
-	
-	args_out = args_in.strip()
-	found = vFalse
-	
-	if (args_out != ""):
-		if (args_out.find(option) >= 0):
-			args_out = args_out.replace(option," ")
-			args_out = args_out.strip()
-			found = vTrue
+	for fname in glob.glob(os.path.join("/dev/shm" if os.access("/dev/shm",os.W_OK) else tempfile.gettempdir(),workerTag()+"_*.arrow")):
+		discard_arrow([("ARROW",fname)])
 
-	return args_out, found
+	return
 
-def findProc(procname):
-	
-	global _hdbc, _hdbi, _connected
-	
-	# Split the procedure name into schema.procname if appropriate
-	upper_procname = procname.upper()
-	schema, proc = split_string(upper_procname,".") # Expect schema.procname
-	if (proc == None):
-		proc = schema
+def cancelActivities(hdbc,applname):
 
-	# Call ibm_db.procedures to see if the procedure does exist
-	schema = "%"
+	#
+	# Cancel the SQL that connections with this application name are running, using WLM_CANCEL_ACTIVITY from
+	# the notebook's own connection. This requires the WLMADM or DBADM authority, so failures are ignored.
+	# Returns the number of activities that were cancelled.
+	#
 
-	try:
-		stmt = ibm_db.procedures(_hdbc, None, schema, proc) 
-		if (stmt == False):                         # Error executing the code
-			errormsg("Procedure " + procname + " not found in the system catalog.")
-			return None
+	sql = ("SELECT A.APPLICATION_HANDLE, A.UOW_ID, A.ACTIVITY_ID "
+		   "FROM TABLE(MON_GET_CONNECTION(NULL,-2)) C, TABLE(MON_GET_ACTIVITY(C.APPLICATION_HANDLE,-2)) A "
+		   "WHERE C.CLIENT_APPLNAME = ?")
 
-		result = ibm_db.fetch_tuple(stmt)
-		resultsets = result[5]
-		if (resultsets >= 1): resultsets = 1
-		return resultsets
-			
-	except Exception as err:
-		errormsg("Procedure " + procname + " not found in the system catalog.")
-		return None
+	if (hdbc == None): return 0
 
-def parseCallArgs(macro):
-	
-	quoteChar = ""
-	inQuote = False
-	inParm = False
-	ignore = False
-	name = ""
-	parms = []
-	parm = ''
-	
-	sqlin = macro.replace("\n","")
-	sqlin.lstrip()
-	
-	for ch in sqlin:
-		if (inParm == False):
-			# We hit a blank in the name, so ignore everything after the procedure name until a ( is found
-			if (ch == " "): 
-				ignore == True
-			elif (ch ==  "("): # Now we have parameters to send to the stored procedure
-				inParm = True
-			else:
-				if (ignore == False): name = name + ch # The name of the procedure (and no blanks)
-		else:
-			if (inQuote == True):
-				if (ch == quoteChar):
-					inQuote = False  
-				else:
-					parm = parm + ch
-			elif (ch in ("\"","\'","[")): # Do we have a quote
-				if (ch == "["):
-					quoteChar = "]"
-				else:
-					quoteChar = ch
-				inQuote = True
-			elif (ch == ")"):
-				if (parm != ""):
-					parms.append(parm)
-				parm = ""
-				break
-			elif (ch == ","):
-				if (parm != ""):
-					parms.append(parm)                  
-				else:
-					parms.append("null")
-					
-				parm = ""
+	activities = catalogRows(hdbc,sql,[applname])
+	if (activities == None): return 0
 
-			else:
-				parm = parm + ch
-				
-	if (inParm == True):
-		if (parm != ""):
-			parms.append(parm)    
-					   
-	return(name,parms)
+	cancelled = 0
+	for activity in activities:
+		try:
+			stmt = ibm_db.prepare(hdbc,"CALL SYSPROC.WLM_CANCEL_ACTIVITY(?,?,?)")
+			if (ibm_db.execute(stmt,tuple(activity)) == True):
+				cancelled = cancelled + 1
+			ibm_db.free_stmt(stmt)
+		except:
+			pass
 
-def getColumns(stmt):
-	   
-	columns = []
-	types = []
-	colcount = 0
-	try:
-		colname = ibm_db.field_name(stmt,colcount)
-		coltype = ibm_db.field_type(stmt,colcount)
-		precision = ibm_db.field_precision(stmt,colcount)
-		while (colname != False):
-			if (coltype == "real"):
-				if (precision == 7):
-					coltype = "real"
-				elif (precision == 15):
-					coltype = "float"
-				elif (precision == 16):
-					coltype = "decfloat16"
-				elif (precision == 34):
-					coltype = "decfloat34"
-				else:
-					coltype = "real"
-			elif (coltype == "int"):
-				if (precision == 1):
-					coltype = "boolean"
-				elif (precision == 5):
-					coltype = "smallint"
-				elif (precision == 10):
-					coltype = "int"
-				else:
-					coltype = "int"
-			columns.append(colname)
-			types.append(coltype)
-			colcount += 1
-			colname = ibm_db.field_name(stmt,colcount)
-			coltype = ibm_db.field_type(stmt,colcount)  
-			precision = ibm_db.field_precision(stmt,colcount)     
-			
-		return columns,types   
-				
-	except Exception as err:
-		db2_error(False)
-		return None
+	return cancelled
 
-def parseCall(hdbc, inSQL, local_ns):
-	
-	global _hdbc, _hdbi, _connected, _environment
-	
-	# Check to see if we are connected first
-	if (_connected == False):                                      # Check if you are connected 
-		db2_doConnect()
-		if _connected == False: return None
-	 
-	remainder = inSQL.strip()
-	procName, procArgs = parseCallArgs(remainder[5:]) # Assume that CALL ... is the format
-	
-	resultsets = findProc(procName)
-	if (resultsets == None): return None
-	
-	argvalues = []
- 
-	if (len(procArgs) > 0): # We have arguments to consider
-		for arg in procArgs:
-			varname = arg
-			if (len(varname) > 0):
-				if (varname[0] == ":"):
-					checkvar = varname[1:]
-					varvalue = getContents(checkvar,True,local_ns)
-					if (varvalue == None):
-						errormsg("Variable " + checkvar + " is not defined.")
-						return None
-					argvalues.append(varvalue)
-				else:
-					if (varname.upper() == "NULL"):
-						argvalues.append(None)
-					else:
-						argvalues.append(varname)
-			else:
-				argvalues.append(None)
+def abandonSlices(control):
+
+	#
+	# Called when a -stream generator goes away. If it wasn't read to the end (or never started, in which case
+	# its own cleanup never runs) the slices that are left are cancelled, and the Arrow files of slices that 
+	# finished but were never handed out are removed (sliceDone removes the ones that finish after this).
+	#
+
+	import queue
 
-	
 	try:
+		if (control["stopped"] == False and control["delivered"] < len(control["slices"])):
+			cancelSlices(control)
+	except:
+		pass
 
-		if (len(procArgs) > 0):
-			argtuple = tuple(argvalues)
-			result = ibm_db.callproc(_hdbc,procName,argtuple)
-			stmt = result[0]
-		else:
-			result = ibm_db.callproc(_hdbc,procName)
-			stmt = result
-		
-		if (resultsets != 0 and stmt != None): 
+	while (True):
+		try:
+			index, result, err = control["completed"].get_nowait()
+		except queue.Empty:
+			break
+		discard_arrow([result])
 
-			columns, types = getColumns(stmt)
-			if (columns == None): return None
-			
-			rows = []
-			rowlist = ibm_db.fetch_tuple(stmt)
-			while ( rowlist ) :
-				row = []
-				colcount = 0
-				for col in rowlist:
-					try:
-						if (types[colcount] in ["int","bigint"]):
-							row.append(int(col))
-						elif (types[colcount] in ["decimal","real"]):
-							row.append(float(col))
-						elif (types[colcount] in ["date","time","timestamp"]):
-							row.append(str(col))
-						else:
-							row.append(col)
-					except:
-						row.append(col)
-					colcount += 1
-				rows.append(row)
-				rowlist = ibm_db.fetch_tuple(stmt)
-			
-			if flag(["-r","-array"]):
-				rows.insert(0,columns)
-				if len(procArgs) > 0:
-					allresults = []
-					allresults.append(rows)
-					for x in result[1:]:
-						allresults.append(x)
-					return allresults # rows,returned_results
-				else:
-					return rows
-			else:
-				df = pandas.DataFrame.from_records(rows,columns=columns)
-				if flag("-grid") or _settings.get('display',"PANDAS") == 'GRID':
-					if (_environment['qgrid'] == False):
-						with pandas.option_context('display.max_rows', None, 'display.max_columns', None):  
-							pdisplay(df)
-					else:
-						try:
-							pdisplay(qgrid.show_grid(df))
-						except:
-							errormsg("Grid cannot be used to display data with duplicate column names. Use option -a or %sql OPTION DISPLAY PANDAS instead.")
-							
-					return                             
-				else:
-					if flag(["-a","-all"]) or _settings.get("maxrows",10) == -1 : # All of the rows
-						with pandas.option_context('display.max_rows', 100, 'display.max_columns', None): 
-							pdisplay(df)
-					else:
-						return df
-			
-		else:
-			if len(procArgs) > 0:
-				allresults = []
-				for x in result[1:]:
-					allresults.append(x)
-				return allresults # rows,returned_results
-			else:
-				return None
-			
-	except Exception as err:
-		db2_error(False)
-		return None
+	return
 
-def parsePExec(hdbc, inSQL):
-	 
-	import ibm_db    
-	global _stmt, _stmtID, _stmtSQL, sqlcode
-	
-	cParms = inSQL.split()
-	parmCount = len(cParms)
-	if (parmCount == 0): return(None)                          # Nothing to do but this shouldn't happen
-	
-	keyword = cParms[0].upper()                                  # Upper case the keyword
-	
-	if (keyword == "PREPARE"):                                   # Prepare the following SQL
-		uSQL = inSQL.upper()
-		found = uSQL.find("PREPARE")
-		sql = inSQL[found+7:].strip()
+def showProgress(done,count,rows,elapsed):
+
+	# Overwrite the progress line for a parallel query
+
+	rate = int(rows / elapsed) if elapsed > 0 else 0
+	print(f"\rSlices {done}/{count} complete, {rows:,} rows, {rate:,} rows/sec   ", end="", flush=True)
+
+	return
 
-		try:
-			pattern = "\?\*[0-9]+"
-			findparm = re.search(pattern,sql)
-			while findparm != None:
-				found = findparm.group(0)
-				count = int(found[2:])
-				markers = ('?,' * count)[:-1]
-				sql = sql.replace(found,markers)
-				findparm = re.search(pattern,sql)
-			
-			stmt = ibm_db.prepare(hdbc,sql) # Check error code here
-			if (stmt == False): 
-				db2_error(False)
-				return(False)
-			
-			stmttext = str(stmt).strip()
-			stmtID = stmttext[33:48].strip()
-			
-			if (stmtID in _stmtID) == False:
-				_stmt.append(stmt)              # Prepare and return STMT to caller
-				_stmtID.append(stmtID)
-			else:
-				stmtIX = _stmtID.index(stmtID)
-				_stmt[stmtIX] = stmt
-				 
-			return(stmtID)
-		
-		except Exception as err:
-			print(err)
-			db2_error(False)
-			return(False)
+def traceSlices(tracesql):
 
-	if (keyword == "EXECUTE"):                                  # Execute the prepare statement
-		if (parmCount < 2): return(False)                    # No stmtID available
-		
-		stmtID = cParms[1].strip()
-		if (stmtID in _stmtID) == False:
-			errormsg("Prepared statement not found or invalid.")
-			return(False)
+	# Display the SQL that each slice ran when the -e flag is used
 
-		stmtIX = _stmtID.index(stmtID)
-		stmt = _stmt[stmtIX]
+	if flag(["-e","-echo"]): 
+		while (tracesql.empty() == False):
+			debug(tracesql.get(),False)
 
-		try:        
+	return
 
-			if (parmCount == 2):                           # Only the statement handle available
-				result = ibm_db.execute(stmt)               # Run it
-			elif (parmCount == 3):                          # Not quite enough arguments
-				errormsg("Missing or invalid USING clause on EXECUTE statement.")
-				sqlcode = -99999
-				return(False)
-			else:
-				using = cParms[2].upper()
-				if (using != "USING"):                     # Bad syntax again
-					errormsg("Missing USING clause on EXECUTE statement.")
-					sqlcode = -99999
-					return(False)
-				
-				uSQL = inSQL.upper()
-				found = uSQL.find("USING")
-				parmString = inSQL[found+5:].strip()
-				parmset = splitargs(parmString)
- 
-				if (len(parmset) == 0):
-					errormsg("Missing parameters after the USING clause.")
-					sqlcode = -99999
-					return(False)
-					
-				parm_count = 0
-				parms = []
-				parms.append(None)
-				
-				CONSTANT = 0
-				VARIABLE = 1
-				const = [0]
-				const_cnt = 0
-				
-				for v in parmset:
-					
-					parm_count = parm_count + 1
-					parms.append(None)
-					
-					if (v[1] == True or v[2] == True): # v[1] true if string, v[2] true if num
-						
-						parm_type = CONSTANT                        
-						const_cnt = const_cnt + 1
-						if (v[2] == True):
-							if (isinstance(v[0],int) == True):         # Integer value 
-								sql_type = ibm_db.SQL_INTEGER
-							elif (isinstance(v[0],float) == True):       # Float value
-								sql_type = ibm_db.SQL_DOUBLE
-							else:
-								sql_type = ibm_db.SQL_INTEGER
-						else:
-							sql_type = ibm_db.SQL_CHAR
-						
-						const.append(v[0])
+def streamSlices(results,q,tracesql):
 
-						
-					else:
-					
-						parm_type = VARIABLE
-					
-						# See if the variable has a type associated with it varname@type
-					
-						varset = v[0].split("@")
-						parm_name = varset[0]
-						
-						parm_datatype = "char"
+	#
+	# Generator that returns each slice as a dataframe as soon as it is complete. The order of the slices is
+	# the order they finished in. Stops with an error message if any slice fails.
+	#
 
-						# Does the variable exist?
-						if (parm_name not in globals()):
-							errormsg("SQL Execute parameter " + parm_name + " not found")
-							sqlcode = -99999
-							return(False)       
-						
-						parms[parm_count] = globals()[parm_name]
-		
-						if (len(varset) > 1):                # Type provided
-							parm_datatype = varset[1]
+	try:
+		for index, result, err in results:
+			if (err != None):
+				errormsg(repr(err))
+				return
+			if (isinstance(result,tuple) == True and result[0] == "ARROW"):
+				result = slice_from_arrow(result).to_pandas(split_blocks=True, self_destruct=True)
+			elif (isinstance(result,pandas.DataFrame) == False):
+				if (q.empty() == False):
+					errormsg(q.get())
+				return
+			yield result
+	except TimeoutError:
+		errormsg("The parallel query did not finish within the -timeout limit and was cancelled.")
+	finally:
+		results.close()
+		traceSlices(tracesql)
 
-						if (parm_datatype == "dec" or parm_datatype == "decimal"):
-							sql_type = ibm_db.SQL_DOUBLE
-						elif (parm_datatype == "bin" or parm_datatype == "binary"):
-							sql_type = ibm_db.SQL_BINARY
-						elif (parm_datatype == "int" or parm_datatype == "integer"):
-							sql_type = ibm_db.SQL_INTEGER
-						else:
-							sql_type = ibm_db.SQL_CHAR
-							parms[parm_count] = addquotes(parms[parm_count],False)
-					
-					try:
-						if (parm_type == VARIABLE):
-							result = ibm_db.bind_param(stmt, parm_count, parms[parm_count], ibm_db.SQL_PARAM_INPUT, sql_type)                           
-							# result = ibm_db.bind_param(stmt, parm_count, globals()[parm_name], ibm_db.SQL_PARAM_INPUT, sql_type)
-						else:
-							result = ibm_db.bind_param(stmt, parm_count, const[const_cnt], ibm_db.SQL_PARAM_INPUT, sql_type)
-							
-					except Exception as e:
-						print(repr(e))
-						result = False
-						
-					if (result == False):
-						errormsg("SQL Bind on variable " + parm_name + " failed.")
-						sqlcode = -99999
-						return(False) 
-					
-				result = ibm_db.execute(stmt) # ,tuple(parms))
-				
-			if (result == False): 
-				errormsg("SQL Execute failed.")      
-				return(False)
-			
-			if (ibm_db.num_fields(stmt) == 0): return(True) # Command successfully completed
-						  
-			return(fetchResults(stmt))
-						
-		except Exception as err:
-			db2_error(False)
-			return(False)
-		
-		return(False)
-  
-	return(False)     
+def concurrentSQL(hdbc,sqlLines,local_ns):
+
+	#
+	# Run the statements of a cell with -concurrent. Consecutive read-only statements (SELECT, WITH, VALUES)
+	# don't depend on each other, so each group of them is run at the same time by the parallel workers. Any 
+	# other statement waits for the group before it and is run on the notebook's connection, so DDL and DML 
+	# still happen in cell order. A query that reads a SESSION table is run there too, since temporary tables
+	# are only seen by the notebook's connection (for the same reason IN lists aren't pushed down into them).
+	# The results are displayed in the order of the statements in the cell.
+	#
 
-def fetchResults(stmt):
-	 
 	global sqlcode
-	
-	rows = []
-	columns, types = getColumns(stmt)
-	
-	# By default we assume that the data will be an array
-	is_array = True
-	
-	# Check what type of data we want returned - array or json
-	if (flag(["-r","-array"]) == False):
-		# See if we want it in JSON format, if not it remains as an array
-		if (flag("-json") == True):
-			is_array = False
-	
-	# Set column names to lowercase for JSON records
-	if (is_array == False):
-		columns = [col.lower() for col in columns] # Convert to lowercase for each of access
-	
-	# First row of an array has the column names in it
-	if (is_array == True):
-		rows.append(columns)
-		
-	result = ibm_db.fetch_tuple(stmt)
-	rowcount = 0
-	while (result):
-		
-		rowcount += 1
-		
-		if (is_array == True):
-			row = []
-		else:
-			row = {}
-			
-		colcount = 0
-		for col in result:
+
+	thread_count = threadCount()
+	if (thread_count in (0,1)):
+		errormsg("The THREADS option is currently set to 0 or 1 which disables parallelism.")
+		return
+
+	if (loadParallel() == False):
+		errormsg("Parallelism is not availble on this system.")
+		return
+
+	try:
+		autocommit = ibm_db.autocommit(hdbc)
+	except:
+		autocommit = 1
+
+	if (autocommit == 0):                          # The workers wouldn't see (and could wait on) uncommitted changes
+		errormsg("-concurrent runs the queries on other connections and needs AUTOCOMMIT ON. Use AUTOCOMMIT ON (after a COMMIT or ROLLBACK) first.")
+		return
+
+	batch = []
+	results = []
+
+	for sqlin in sqlLines + [None]:
+
+		if (sqlin != None):
+			sqlin = checkMacro(sqlin)
+			sqlType, sql = sqlParser(sqlin,local_ns,pushdown=False)   # Temporary tables are only seen by the notebook's connection
+			if (sql.strip() == ""): continue
+			if flag(["-e","-echo"]): 
+				debug(sql,False)
+			if (sqlType in ("SELECT","WITH","VALUES") and re.search(r"\bSESSION\s*\.",sql,flags=re.I) == None):
+				batch.append(sql)
+				continue
+
+		if (len(batch) > 0):                               # Run the read-only statements found so far
+			ok, dfs = runSlices(hdbc,":DB2MAGIC_STATEMENT","DB2MAGIC_STATEMENT",batch,thread_count,raw=True,combine=False)
+			if (ok == False): break
+			results.extend(dfs)
+			batch = []
+
+		if (sqlin == None): continue
+
+		if (sqlType in ("SELECT","WITH","VALUES")):        # Reads a temporary table of the notebook's connection
 			try:
-				if (types[colcount] in ["int","bigint"]):
-					if (is_array == True):
-						row.append(int(col))
-					else:
-						row[columns[colcount]] = int(col)
-				elif (types[colcount] in ["decimal","real"]):
-					if (is_array == True):
-						row.append(float(col))
-					else:
-						row[columns[colcount]] = float(col)
-				elif (types[colcount] in ["date","time","timestamp"]):
-					if (is_array == True):
-						row.append(str(col))
-					else:
-						row[columns[colcount]] = str(col)
-				else:
-					if (is_array == True):
-						row.append(col)
-					else:
-						row[columns[colcount]] = col
-						
-			except:
-				if (is_array == True):
-					row.append(col)
-				else:
-					row[columns[colcount]] = col
-					
-			colcount += 1
-		
-		rows.append(row)
-		result = ibm_db.fetch_tuple(stmt)
-		
-	if (rowcount == 0): 
-		sqlcode = 100        
-	else:
-		sqlcode = 0
-		
-	return rows
-			
+				stmt = prepareStatement(sql,False)
+				results.append(readSQL(stmt,sql,pandasTypes(stmt)))
+				releaseStatement(stmt)
+			except Exception as err:
+				db2_error(flag(["-q","-quiet"]))
+				break
+		elif (execSQL(hdbc,sql,flag(["-q","-quiet"])) == False): 
+			break
+
+	for df in results:
+		if (len(df) == 0):
+			sqlcode = 100
+			if (flag(["-q","-quiet"]) == False): 
+				errormsg("No rows found")
+			continue
+		df = displayResults(df)
+		if (df is not None):
+			pdisplay(df)
+
+	return
+
+#
+# Background queries (-async). The statements of the cell are substituted right away, then run in order
+# on a connection of their own by a separate pool of threads, and an AsyncQuery handle is returned without
+# waiting. The handle reports the status, elapsed time and rows fetched so far, and can be waited on with
+# result() or await. Each query sets its own application name so cancel() only stops that query.
+#
 
-def parseCommit(sql):
-	
-	global _hdbc, _hdbi, _connected, _stmt, _stmtID, _stmtSQL
+_asyncPool = None
+_asyncKey = None
+_asyncCount = 0
+_asyncConnections = []                        # Connections opened by the background query threads
 
-	if (_connected == False): return                        # Nothing to do if we are not connected
-	
-	cParms = sql.split()
-	if (len(cParms) == 0): return                           # Nothing to do but this shouldn't happen
-	
-	keyword = cParms[0].upper()                             # Upper case the keyword
-	
-	if (keyword == "COMMIT"):                               # Commit the work that was done
-		try:
-			result = ibm_db.commit (_hdbc)                  # Commit the connection
-			if (len(cParms) > 1):
-				keyword = cParms[1].upper()
-				if (keyword == "HOLD"):
-					return
-			
-			del _stmt[:]
-			del _stmtID[:]
+class AsyncQuery:
+
+	def __init__(self,number,statements):
+		self.number = number
+		self.statements = statements
+		self.applname = f"{workerTag()}q{number}"
+		self.rows = 0
+		self.started = None
+		self.ended = None
+		self.cancelled = False
+		self.timeout = statementTimeout()
+		self.prefetch = prefetchOn()
+		self.future = None
+
+	@property
+	def status(self):
+		if (self.future == None or (self.started == None and self.future.done() == False)):
+			return "PENDING"
+		if (self.future.done() == False):
+			return "CANCELLING" if self.cancelled else "RUNNING"
+		if (self.cancelled == True):
+			return "CANCELLED"
+		return "FAILED" if self.future.exception() != None else "DONE"
+
+	@property
+	def elapsed(self):
+		if (self.started == None): return 0
+		return (self.ended if self.ended != None else time.time()) - self.started
+
+	def done(self):
+		return self.future.done()
+
+	def result(self,timeout=None):
+
+		# The DataFrame of the last statement (or its row count if it doesn't return rows)
+
+		return self.future.result(timeout)
+
+	def cancel(self):
+
+		# Stop the query. A query that is running is cancelled on the server with WLM_CANCEL_ACTIVITY.
+
+		if (self.future.done() == True):
+			return False
+		self.cancelled = True
+		if (self.future.cancel() == False):
+			cancelActivities(_hdbc,self.applname)
+		return True
+
+	def __await__(self):
+		import asyncio
+		return asyncio.wrap_future(self.future).__await__()
+
+	def __repr__(self):
+		return f"<Db2 query {self.number}: {self.status}, {self.rows:,} rows, {self.elapsed:.1f}s>"
+
+def asyncSQL(sqlLines,local_ns):
+
+	# Substitute the statements of the cell and start running them in the background
+
+	global _asyncPool, _asyncKey, _asyncCount
+
+	import concurrent.futures
+
+	statements = []
+	for sqlin in sqlLines:
+		sqlin = checkMacro(sqlin)
+		sqlType, sql = sqlParser(sqlin,local_ns,pushdown=False)   # Temporary tables are only seen by the notebook's connection
+		if (sql.strip() == ""): continue
+		if flag(["-e","-echo"]): 
+			debug(sql,False)
+		statements.append(sql)
+
+	if (len(statements) == 0): return None
+
+	dsn = buildDSN(_settings)
+	if (_asyncPool == None or _asyncKey != dsn):
+		if (_asyncPool != None):
+			_asyncPool.shutdown(wait=False)
+		_asyncPool = concurrent.futures.ThreadPoolExecutor(max_workers=max(4,threadCount()), thread_name_prefix="db2async",
+														   initializer=init_worker, initargs=(dsn,workerTag()+"async",_asyncConnections,))
+		_asyncKey = dsn
+
+	_asyncCount = _asyncCount + 1
+	query = AsyncQuery(_asyncCount,statements)
+	query.future = _asyncPool.submit(process_async,query)
+
+	return query
+
+def process_async(query):
+
+	import concurrent.futures
+
+	query.started = time.time()
+
+	try:
+		hdbc, hdbi, errmsg = worker_connect()
+		if (hdbc == None):
+			raise Exception(errmsg)
 
-		except Exception as err:
-			db2_error(False)
-		
-		return
-		
-	if (keyword == "ROLLBACK"):                             # Rollback the work that was done
 		try:
-			result = ibm_db.rollback(_hdbc)                  # Rollback the connection
-			del _stmt[:]
-			del _stmtID[:]            
+			ibm_db.set_option(hdbc,{ibm_db.SQL_ATTR_INFO_APPLNAME: query.applname},1)
+		except:
+			pass
+		try:
+			ibm_db.set_option(hdbc,{ibm_db.SQL_ATTR_QUERY_TIMEOUT: query.timeout},1)
+		except:
+			pass
 
-		except Exception as err:
-			db2_error(False)
-		
-		return
-	
-	if (keyword == "AUTOCOMMIT"):                           # Is autocommit on or off
-		if (len(cParms) > 1): 
-			op = cParms[1].upper()                          # Need ON or OFF value
-		else:
-			return
-		
+		result = None
+		for sql in query.statements:
+			if (query.cancelled == True): break
+			if (isReadOnly(sql) == True):
+				stmt = prepareRead(hdbc,sql)
+			else:
+				invalidateResults(sql)
+				stmt = ibm_db.prepare(hdbc,sql)
+			setPrefetch(stmt,query.prefetch)
+			ibm_db.execute(stmt)
+			if (ibm_db.num_fields(stmt) == 0):
+				result = ibm_db.num_rows(stmt)
+			else:
+				columns, types = getColumns(stmt)
+				rows = []
+				row = ibm_db.fetch_tuple(stmt)
+				while (row and query.cancelled == False):
+					rows.append(row)
+					query.rows = query.rows + 1
+					row = ibm_db.fetch_tuple(stmt)
+				rows = convertRows(rows,columnConverters(types))
+				result = pandas.DataFrame.from_records(rows,columns=columns,coerce_float=True)
+			ibm_db.free_stmt(stmt)
+
+	except Exception as err:
+		if (query.cancelled == False):
+			raise
+	finally:
+		query.ended = time.time()
 		try:
-			if (op == "OFF"):
-				ibm_db.autocommit(_hdbc, False)
-			elif (op == "ON"):
-				ibm_db.autocommit (_hdbc, True)
-			return    
-		
-		except Exception as err:
-			db2_error(False)
-			return 
-		
+			ibm_db.set_option(hdbc,{ibm_db.SQL_ATTR_INFO_APPLNAME: _worker.tag},1)
+		except:
+			pass
+		try:
+			ibm_db.set_option(hdbc,{ibm_db.SQL_ATTR_QUERY_TIMEOUT: 0},1)
+		except:
+			pass
+
+	if (query.cancelled == True):
+		raise concurrent.futures.CancelledError(f"Query {query.number} was cancelled.")
+
+	return result
+
+def closeAsync():
+
+	# Stop the background query threads and close their connections
+
+	global _asyncPool, _asyncKey
+
+	if (_asyncPool != None):
+		_asyncPool.shutdown(wait=False)
+
+	with _workerLock:
+		for hdbc in _asyncConnections:
+			try:
+				ibm_db.close(hdbc)
+			except:
+				pass
+		_asyncConnections.clear()
+
+	_asyncPool = None
+	_asyncKey = None
+
 	return
 
-def setFlags(inSQL,reset=False):
+def parallelSQL(hdbc,sql,column):
 
-	global _flags
+	#
+	# Run a SELECT in parallel without a user supplied slice list. Split points for the column are taken 
+	# from the distribution statistics (SYSCAT.COLDIST quantiles) or from MIN/MAX of the column, and the 
+	# first table in the FROM clause is replaced with a subselect that only returns one range. When column
+	# is None (-partitions) there is one slice per database partition or data partition of the table.
+	#
 
-	if (reset == True):
-		_flags = [] # Delete all of the current flag settings
+	NoDF  = False
 
-	pos = 0
-	end = len(inSQL)-1
-	inFlag = False
-	ignore = False
-	outSQL = ""
-	flag = ""
+	if (loadParallel() == False):
+		errormsg("Parallelism is not availble on this system.")
+		return NoDF, None
 
-	while (pos <= end):
-		ch = inSQL[pos]
-		if (ignore == True):   
-			outSQL = outSQL + ch
-		else:
-			if (inFlag == True):
-				if (ch != " "):
-					flag = flag + ch
-				else:
-					_flags.append(flag)
-					inFlag = False
-			else:
-				if (ch == "-"):
-					flag = "-"
-					inFlag = True
-				elif (ch == ' '):
-					outSQL = outSQL + ch
-				else:
-					outSQL = outSQL + ch
-					ignore = True
-		pos += 1
+	thread_count = threadCount()
+	if (thread_count in (0,1)):
+		errormsg("The THREADS option is currently set to 0 or 1 which disables parallelism.")
+		return NoDF, None      
 
-	if (inFlag == True):
-		_flags.append(flag)
+	table = findTable(sql)
+	if (table == None):
+		errormsg("Unable to find a table in the FROM clause to split into ranges.")
+		return NoDF, None
 
-	return outSQL
+	tabschema, tabname, start, end, alias = table
 
-def flag(inflag):
-	
-	global _flags
+	if (tabschema == None):
+		rows = catalogCached(hdbc,"VALUES CURRENT SCHEMA")
+		if (rows in (None,[])):
+			db2_error(False)
+			return NoDF, None
+		tabschema = rows[0][0].strip()
 
-	if isinstance(inflag,list):
-		for x in inflag:
-			if (x in _flags):
-				return True
-		return False
+	if (column == None):
+		slices = partitionPredicates(hdbc,tabschema,tabname)
+		if (slices == None):
+			errormsg(f"{tabschema}.{tabname} is not partitioned. Use -parallel column to split the query by ranges of a column.")
+			return NoDF, None
 	else:
-		if (inflag in _flags):
-			return True
+		colname = column.split(".")[-1]
+		if (colname[:1] == '"'):
+			colname = colname.strip('"')
 		else:
-			return False
+			colname = colname.upper()
 
-def execSQL(hdbc,sql,quiet=True):
+		bounds = rangeSplits(hdbc,tabschema,tabname,colname,thread_count*2)
+		if (bounds == None):
+			errormsg(f"Unable to determine split points for column {colname} in {tabschema}.{tabname}.")
+			return NoDF, None
 
-	success = True
-	try:                                                  # See if we have an answer set
+		slices = rangePredicates(f'"{colname}"',bounds)
+
+	rangeSQL = f"{sql[:start]}(SELECT * FROM {sql[start:end]} WHERE :DB2MAGIC_RANGE){alias}{sql[end:]}"
+
+	return runSlices(hdbc,rangeSQL,"DB2MAGIC_RANGE",slices,thread_count,raw=True,stream=flag("-stream"))
+
+def findTable(sql):
+
+	#
+	# Find the first base table in a FROM clause. Returns the schema (or None), table name, the position of the
+	# table reference in the SQL, and the correlation name that must be added when the user didn't supply one.
+	# Only a FROM of the outer query, of a common table expression or of a derived table in a FROM clause 
+	# counts, so EXTRACT(YEAR FROM ts), TRIM(BOTH FROM name), scalar subqueries and string literals are skipped.
+	#
+
+	name = r'(?:"[^"]+"|[A-Za-z_][\w$#@]*)'
+	pattern = re.compile(r'FROM\s+(' + name + r')(?:\s*\.\s*(' + name + r'))?',flags=re.I)
+	functions = ("TABLE","LATERAL","FINAL","NEW","OLD","UNNEST","XMLTABLE","JSON_TABLE")
+	keywords = ("WHERE","GROUP","ORDER","FETCH","JOIN","INNER","LEFT","RIGHT","FULL","CROSS","UNION",
+				"EXCEPT","INTERSECT","ON","HAVING","LIMIT","OFFSET","FOR","WITH","OPTIMIZE","NATURAL")
+
+	# Blank out string literals and quoted names so their contents are not mistaken for keywords or parentheses
+
+	masked = re.sub(r"'(?:[^']|'')*'|\"[^\"]*\"",lambda m: " " * len(m.group(0)),sql)
+
+	positions = []
+	stack = []                                      # True for each open parenthesis that holds a full select
+	for pos, char in enumerate(masked):
+		if (char == "("):
+			before = masked[max(0,pos-16):pos]
+			stack.append(re.search(r'\b(AS|FROM|JOIN)\s*$',before,flags=re.I) != None and (len(stack) == 0 or stack[-1] == True))
+		elif (char == ")"):
+			if (len(stack) > 0): stack.pop()
+		elif (char in "Ff" and (len(stack) == 0 or stack[-1] == True)):
+			if (re.match(r'FROM\b',masked[pos:pos+5],flags=re.I) != None and (pos == 0 or re.match(r'[\w$#@]',masked[pos-1]) == None)):
+				positions.append(pos)
+
+	for position in positions:
+		match = pattern.match(sql,position)
+		if (match == None): continue
+		if (match.group(1).upper() in functions): continue
+
+		if (match.group(2) == None):
+			schema = None
+			table = match.group(1)
+		else:
+			schema = match.group(1)
+			table = match.group(2)
+
+		ident = lambda x: x[1:-1] if x[:1] == '"' else x.upper()
+		if (schema != None): schema = ident(schema)
+
+		following = re.match(r'\s*(?:AS\s+)?(' + name + r')',sql[match.end():],flags=re.I)
+		if (following != None and following.group(1).upper() not in keywords):
+			alias = ""                                       # User supplied a correlation name
+		else:
+			alias = " AS " + (table if table[:1] == '"' else table.upper())
+
+		return schema, ident(table), match.start(1), match.end(), alias
+
+	return None
+
+def catalogRows(hdbc,sql,parms=None):
+
+	# Run a catalog query and return all rows as tuples (None if the query fails)
+
+	try:
 		stmt = ibm_db.prepare(hdbc,sql)
-		result = ibm_db.execute(stmt)                 # Run it                            
-		if (result == False):                         # Error executing the code
-			db2_error(quiet)
-			success = False
-	except:
-		db2_error(quiet) 
-		success = False
+		if (parms == None):
+			result = ibm_db.execute(stmt)
+		else:
+			result = ibm_db.execute(stmt,tuple(parms))
+		if (result == False): return None
+		rows = []
+		row = ibm_db.fetch_tuple(stmt)
+		while (row):
+			rows.append(row)
+			row = ibm_db.fetch_tuple(stmt)
+		ibm_db.free_stmt(stmt)
+		return rows
+	except Exception as err:
+		return None
 
-	return success	            
+def rangeSplits(hdbc,tabschema,tabname,colname,slices):
 
-def splitSQL(inputString, delimiter):
-	 
-	pos = 0
-	arg = ""
-	results = []
-	quoteCH = ""
-	
-	inSQL = inputString.strip()
-	if (len(inSQL) == 0): return(results)       # Not much to do here - no args found
-			
-	while pos < len(inSQL):
-		ch = inSQL[pos]
-		pos += 1
-		if (ch in ('"',"'")):                   # Is this a quote characters?
-			arg = arg + ch                      # Keep appending the characters to the current arg
-			if (ch == quoteCH):                 # Is this quote character we are in
-				quoteCH = ""
-			elif (quoteCH == ""):               # Create the quote
-				quoteCH = ch
-			else:
-				None
-		elif (quoteCH != ""):                   # Still in a quote
-			arg = arg + ch
-		elif (ch == delimiter):                 # Is there a delimiter?
-			results.append(arg)
-			arg = ""
+	#
+	# Return up to slices-1 boundary values as SQL literals. Quantiles from RUNSTATS are used first since 
+	# they produce slices with a similar number of rows. Otherwise the MIN/MAX range is divided evenly.
+	#
+
+	import datetime
+
+	sql = ("SELECT COLVALUE, VALCOUNT FROM SYSCAT.COLDIST "
+		   "WHERE TABSCHEMA = ? AND TABNAME = ? AND COLNAME = ? AND TYPE = 'Q' AND COLVALUE IS NOT NULL "
+		   "ORDER BY SEQNO")
+
+	quantiles = catalogCached(hdbc,sql,[tabschema,tabname,colname])
+
+	if (quantiles not in (None,[])):
+		total = quantiles[-1][1]
+		bounds = []
+		for i in range(1,slices):
+			target = total * i / slices
+			for colvalue, valcount in quantiles:
+				if (valcount >= target):
+					if (colvalue not in bounds): bounds.append(colvalue)
+					break
+		if (len(bounds) > 0):
+			return bounds
+
+	minmax = catalogRows(hdbc,f'SELECT MIN("{colname}"), MAX("{colname}") FROM "{tabschema}"."{tabname}"')
+	if (minmax in (None,[])): return None
+
+	low, high = minmax[0]
+	if (low == None or high == None): return []                   # Empty table (or all NULL)
+
+	bounds = []
+	for i in range(1,slices):
+		if (isinstance(low,datetime.datetime) == True):
+			literal = addquotes(str(low + (high - low) * i / slices),True)
+		elif (isinstance(low,datetime.date) == True):
+			days = (high.toordinal() - low.toordinal()) * i // slices
+			literal = addquotes(str(datetime.date.fromordinal(low.toordinal() + days)),True)
 		else:
-			arg = arg + ch
-			
-	if (arg != ""):
-		results.append(arg)
-		
-	return(results)
+			try:
+				if (isinstance(low,int) == True and isinstance(high,int) == True):
+					literal = str(low + (high - low) * i // slices)
+				else:
+					literal = str(float(low) + (float(high) - float(low)) * i / slices)
+			except:
+				return None                                         # Character columns need quantiles
+		if (literal not in bounds): bounds.append(literal)
 
-def process_slice(connection, dfName, dfValue, pd_dtypes, sql, q, s):
-	
-	import numpy as np    
-	import pandas as pd
+	return bounds
 
-	if (q.empty() == False): return None
+def partitionPredicates(hdbc,tabschema,tabname):
 
-	if (isinstance(dfValue,list) == True or isinstance(dfValue,tuple) == True):
-		encoded_sql = ""
-		start = True
-		for v in dfValue:
-			if (start == False):
-				encoded_sql = encoded_sql + ","
-			if (isinstance(v,str) == True):
-				encoded_sql = encoded_sql + addquotes(v,True)
-			else:
-				encoded_sql = encoded_sql + str(v)
-			start = False
+	#
+	# One predicate per partition of the table. A table in a multi-partition database partition group gets
+	# DBPARTITIONNUM predicates so each slice is only read by one database partition. A range partitioned 
+	# table gets the range of each data partition (so Db2 only scans that partition), or DATAPARTITIONNUM
+	# when the partitioning key has more than one column. Returns None if the table isn't partitioned.
+	#
 
-		dfValue = encoded_sql
-	elif (isinstance(dfValue,str) == True):
-		dfValue = addquotes(dfValue,True)
-	else:
-		dfValue = str(dfValue)
+	sql = ("SELECT D.DBPARTITIONNUM FROM SYSCAT.TABLES T, SYSCAT.TABLESPACES S, SYSCAT.DBPARTITIONGROUPDEF D "
+		   "WHERE T.TABSCHEMA = ? AND T.TABNAME = ? AND S.TBSPACE = T.TBSPACE AND D.DBPGNAME = S.DBPGNAME "
+		   "AND D.IN_USE = 'Y' ORDER BY D.DBPARTITIONNUM")
 
-	if (q.empty() == False): return None
+	members = catalogCached(hdbc,sql,[tabschema,tabname])
+
+	if (members != None and len(members) > 1):
+		sql = ("SELECT COLNAME FROM SYSCAT.COLUMNS WHERE TABSCHEMA = ? AND TABNAME = ? "
+			   "ORDER BY CASE WHEN PARTKEYSEQ > 0 THEN PARTKEYSEQ ELSE 1000 + COLNO END FETCH FIRST 1 ROW ONLY")
+		column = catalogCached(hdbc,sql,[tabschema,tabname])
+		if (column in (None,[])): return None
+		return [f'DBPARTITIONNUM("{column[0][0]}") = {member[0]}' for member in members]
+
+	sql = ("SELECT SEQNO, LOWINCLUSIVE, LOWVALUE, HIGHINCLUSIVE, HIGHVALUE FROM SYSCAT.DATAPARTITIONS "
+		   "WHERE TABSCHEMA = ? AND TABNAME = ? ORDER BY SEQNO")
+
+	partitions = catalogCached(hdbc,sql,[tabschema,tabname])
+	if (partitions == None or len(partitions) < 2): return None
+
+	sql = ("SELECT CAST(DATAPARTITIONEXPRESSION AS VARCHAR(256)), NULLSFIRST FROM SYSCAT.DATAPARTITIONEXPRESSION "
+		   "WHERE TABSCHEMA = ? AND TABNAME = ? ORDER BY DATAPARTITIONKEYSEQ")
+
+	keys = catalogCached(hdbc,sql,[tabschema,tabname])
+	if (keys in (None,[])): return None
+
+	column = keys[0][0].strip()
+	if (column[:1] != '"'): column = f'"{column}"'
+
+	if (len(keys) > 1):
+		return [f"DATAPARTITIONNUM({column}) = {partition[0]}" for partition in partitions]
+
+	predicates = []
+	for seqno, lowinclusive, lowvalue, highinclusive, highvalue in partitions:
+		predicate = []
+		if (lowvalue.strip() not in ("MINVALUE","")):
+			predicate.append(f"{column} {'>=' if lowinclusive == 'Y' else '>'} {lowvalue}")
+		if (highvalue.strip() not in ("MAXVALUE","")):
+			predicate.append(f"{column} {'<=' if highinclusive == 'Y' else '<'} {highvalue}")
+		predicate = " AND ".join(predicate) if len(predicate) > 0 else "1=1"
+		predicates.append(predicate)
+
+	if (keys[0][1] == 'Y'):                                    # NULLs are stored in the first or last partition
+		predicates[0] = f"({predicates[0]} OR {column} IS NULL)"
+	else:
+		predicates[-1] = f"({predicates[-1]} OR {column} IS NULL)"
 
-	dsn = (
-		   "DRIVER={{IBM DB2 ODBC DRIVER}};"
-		   "DATABASE={0};"
-		   "HOSTNAME={1};"
-		   "PORT={2};"
-		   "PROTOCOL=TCPIP;ConnectTimeout=15;"
-		   "UID={3};"
-		   "PWD={4};{5};{6}").format(_settings.get("database",""), 
-								 _settings.get("hostname",""), 
-								 _settings.get("port","50000"), 
-								 _settings.get("uid",""), 
-								 _settings.get("pwd",""),
-								 _settings.get("ssl",""),
-								 _settings.get("passthru",""))	
-	
-	# Get a database handle (hdbc) and a statement handle (hstmt) for subsequent access to Db2
+	return predicates
 
-	try:
-		hdbc  = ibm_db.connect(dsn, "", "")
-	except Exception as err:
-		try:
-			errmsg = ibm_db.conn_errormsg().replace('\r',' ')
-			errmsg = errmsg[errmsg.rfind("]")+1:].strip()
-		except:
-			errmsg = "Error attempting to retrieve error message"
-		q.put(errmsg)  
-		return None
-	
-	try:
-		hdbi = ibm_db_dbi.Connection(hdbc)
-	except Exception as err:
-		errmsg = "Connection error when connecting through DBI adapter."
-		q.put(errmsg)
-		return None
+def rangePredicates(column,bounds):
 
-	if (q.empty() == False): return None
-	
-	# if (isinstance(dfValue,str) == True):
-	# 	dfValue = addquotes(dfValue,True)
-	# else:
-	# 	dfValue = str(dfValue)
-		
-	protoSQL = sql.replace(f":{dfName}",dfValue)
+	# Turn the boundary values into predicates that cover every row exactly once (including NULLs)
 
-	s.put(protoSQL)
+	if (len(bounds) == 0):
+		return ["1=1"]
 
-	if (q.empty() == False): return None	
+	predicates = [f"({column} < {bounds[0]} OR {column} IS NULL)"]
+	for i in range(1,len(bounds)):
+		predicates.append(f"{column} >= {bounds[i-1]} AND {column} < {bounds[i]}")
+	predicates.append(f"{column} >= {bounds[-1]}")
 
-	try:
-		if (pd_dtypes != None):
-			df = pd.read_sql_query(protoSQL,hdbi,dtype=pd_dtypes)  
-		else:
-			df = pd.read_sql_query(protoSQL,hdbi)    
-	except:
-		try:
-			errmsg = ibm_db.stmt_errormsg().replace('\r',' ')
-			errmsg = errmsg[errmsg.rfind("]")+1:].strip()		
-			ibm_db.close(hdbc)
-		except:
-			errmsg = "Error attempting to retrieve statement error message."
-		q.put(errmsg)
-		return None
+	return predicates
 
-	if (q.empty() == False): return None
+#
+# Incremental refresh. -incremental col -into df runs the query the first time and saves the result in the
+# notebook variable df. After that, only the rows where col is greater than the largest value of col already 
+# in df are fetched, by replacing the first table in the FROM clause with a subselect that has the predicate
+# (as parallelSQL does for ranges), and they are appended to df.
+#
 
-	try:
-		ibm_db.close(hdbc)
-	except:
-		pass	
-			  
-	return df
+def incrementalSQL(sql,column,name,local_ns):
 
-def dfSQL(hdbc,hdbi,sqlin,dfName,dfValue,thread_count):
-	
-	import shlex
+	# Returns the updated dataframe (None if there was an error)
 
-	NoDF  = False
-	YesDF = True
+	import datetime
+	import decimal
 
-	sqlin = " ".join(shlex.split(sqlin)) 
+	global sqlcode
 
-	if (hdbc == None or hdbi == None or sqlin in (None, "")):
-		return NoDF,None
-	
-	uSQLin = sqlin.upper()
-	  
-	select_location = uSQLin.find("SELECT")
-	with_location   = uSQLin.find("WITH")
+	if (name == None):
+		errormsg("The -incremental option needs -into variable to hold the results.")
+		return None
 
-	if (select_location == -1):
-		errormsg("SQL statement does not contain a SELECT statement.")
-		return NoDF, None          
-	  
-	if (with_location != -1 and (with_location < select_location)):
-		keyword_location = with_location
-	else:
-		keyword_location = select_location
-		
-	sql = sqlin[keyword_location:]
+	colname = column.split(".")[-1]
+	colname = colname.strip('"') if colname[:1] == '"' else colname.upper()
 
-	keyword_location = sql.find(f":{dfName}")
-	   
-	if (keyword_location == -1):
-		errormsg(f"The parallelism value ({dfName}) was not found in the SQL statement")
-		return NoDF, None
-	
-	if (isinstance(dfValue,list) == False):
-		errormsg(f"The variable {dfName} is not an array or a list of values.")
-		return NoDF, None
+	existing = findVariable(name,local_ns)
+	if (existing is not None and isinstance(existing,pandas.DataFrame) == False):
+		errormsg(f"The variable {name} is not a Pandas dataframe.")
+		return None
 
-	#	Create a prototype statement to make sure the SQL will run
-	
-	protoValue = dfValue[0]
+	watermark = None
+	if (existing is not None):
+		dfcolumn = next((col for col in existing.columns if str(col) == colname),None)
+		if (dfcolumn is None):
+			dfcolumn = next((col for col in existing.columns if str(col).upper() == colname.upper()),None)
+		if (dfcolumn is None):
+			errormsg(f"The dataframe {name} has no {colname} column to find the rows already fetched.")
+			return None
+		values = existing[dfcolumn].dropna()
+		if (pandas.api.types.is_numeric_dtype(values) == False and pandas.api.types.is_datetime64_any_dtype(values) == False):
+			try:                                            # DECIMAL values kept as strings would compare as text
+				values = values.map(lambda v: decimal.Decimal(v) if isinstance(v,str) else v)
+			except (decimal.InvalidOperation, ValueError):
+				values = existing[dfcolumn].dropna()
+		watermark = values.max() if len(values) > 0 else None
+		if (watermark is not None and pandas.isna(watermark)): watermark = None
+
+	if (watermark is not None):
+		table = findTable(sql)
+		if (table == None):
+			errormsg("Unable to find a table in the FROM clause to add the watermark predicate to.")
+			return None
+		tabschema, tabname, start, end, alias = table
+
+		# The watermark must belong to the table that gets the predicate, not to a joined table
+
+		ident = lambda x: x[1:-1] if x[:1] == '"' else x.upper()
+		qualifier = column.split(".")[:-1]
+		if (len(qualifier) > 0):
+			names = [tabname]
+			following = re.match(r'\s*(?:AS\s+)?("[^"]+"|[A-Za-z_][\w$#@]*)',sql[end:],flags=re.I)
+			if (alias == "" and following != None): names.append(ident(following.group(1)))
+			if (ident(qualifier[-1].strip()) not in names):
+				errormsg(f"The -incremental column {column} does not belong to {tabname}, the first table in the FROM clause.")
+				return None
 
-	if (isinstance(protoValue,list) == True or isinstance(protoValue,tuple) == True):
-		if (len(protoValue) == 0):
-			errormsg(f"The variable {dfName} contains array values that are empty.")
-			return NoDF, None				
-		protoValue = protoValue[0]
+		tablename = f'"{tabname}"' if tabschema == None else f'"{tabschema}"."{tabname}"'
+		columns = tableColumns(_hdbc,tablename)
+		if (columns not in (None,[]) and colname not in [col[0].strip() for col in columns]):
+			errormsg(f"The -incremental column {colname} is not a column of {tabname}, the first table in the FROM clause.")
+			return None
 
-	if (isinstance(protoValue,str) == True):
-		protoValue = addquotes(protoValue,True)
+		predicate = f'"{colname}" > {sqlLiteral(watermark)}'
+		runSQL = f"{sql[:start]}(SELECT * FROM {sql[start:end]} WHERE {predicate}){alias}{sql[end:]}"
 	else:
-		protoValue = str(protoValue)
-		   
-	protoSQL = sql.replace(f":{dfName}",protoValue)
-	
-	try:
-		stmt = ibm_db.prepare(hdbc,protoSQL)
+		runSQL = sql
 
-		if (ibm_db.num_fields(stmt) == 0):                
-			errormsg("The SQL statement does not return an answer set.")
-			return NoDF, None
-  
+	if (runSQL != sql and flag(["-e","-echo"])): 
+		debug(runSQL,False)
+
+	try:
+		stmt = prepareStatement(runSQL,False)                  # The text changes with every refresh
+		df = readSQL(stmt,runSQL,pandasTypes(stmt))
+		releaseStatement(stmt)
 	except Exception as err:
 		db2_error(False)
-		return NoDF, None
-
-	#	Determine the datatypes for a Pandas dataframe if it is supported
+		return None
 
-	pd_dtypes = None
+	if (watermark is not None):
+		if (list(df.columns) != list(existing.columns)):
+			errormsg(f"The columns of the query no longer match the dataframe {name}. Remove the variable to fetch all of the rows again.")
+			return None
+		if (isinstance(watermark,(pandas.Timestamp,datetime.datetime)) == True and len(df) > 0):
+			try:                                            # TIMESTAMP(7..12) digits past the dataframe's precision
+				df = df[pandas.to_datetime(df[dfcolumn]) > watermark].reset_index(drop=True)
+			except Exception as err:
+				pass
+		added = len(df)
+		if (added > 0):
+			df = pandas.concat([existing,df],ignore_index=True)
+		else:
+			df = existing
+	else:
+		added = len(df)
 
-	if (_pandas_dtype == True):
-		pd_dtypes = None
-		columns, types = getColumns(stmt)
-		pd_dtypes={}
-		for idx, col in enumerate(columns):
-			try:
-				_dindex = _db2types.index(types[idx])
-			except:
-				_dindex = 0
+	ip.user_ns[name] = df
+	if (added == 0): sqlcode = 100
 
-			pd_dtypes[col] = _pdtypes[_dindex]
+	if (flag(["-q","-quiet"]) == False):
+		print(f"{added} rows added to {name} ({len(df)} rows).")
 
-		if len(pd_dtypes.keys()) == 0:
-			pd_dtypes = None
-	
-	pool 	 = mp.Pool(processes=thread_count)
-	m 		 = multiprocessing.Manager()
-	q		 = m.Queue()	
-	tracesql = m.Queue()
-	
-	try:
-		results = [pool.apply_async(process_slice, args=(_settings,dfName,x,pd_dtypes,sql,q,tracesql,)) for x in dfValue]
-	except Exception as err:
-		print(repr(err))
-		return NoDF, None        
+	return df
 
-	output=[]
+def sqlLiteral(value):
 
-	badresults = False
-	
-	for p in results:
-		try:
-			df = p.get()
-			if (isinstance(df,pandas.DataFrame) == True):
-				output.append(df)
-			else:
-				badresults = True
-		except Exception as err:
-			print(repr(err))
-			badresults = True 
+	# A Python, numpy or pandas value as an SQL literal
 
-	if flag(["-e","-echo"]): 
-		while (tracesql.empty() == False):
-			debug(tracesql.get(),False)
+	import datetime
+	import numbers
+
+	if (isinstance(value,pandas.Timestamp) == True and value.nanosecond != 0):
+		return f"TIMESTAMP('{value.strftime('%Y-%m-%d %H:%M:%S.%f')}{value.nanosecond:03d}')"
+	elif (isinstance(value,(pandas.Timestamp,datetime.datetime)) == True):
+		return f"TIMESTAMP('{value.strftime('%Y-%m-%d %H:%M:%S.%f')}')"
+	elif (isinstance(value,datetime.date) == True):
+		return f"DATE('{value.isoformat()}')"
+	elif (isinstance(value,datetime.time) == True):
+		return f"TIME('{value.strftime('%H:%M:%S')}')"
+	elif (isinstance(value,numbers.Number) == True and isinstance(value,bool) == False):
+		return str(value)
+	else:
+		return addquotes(str(value),True)
 
-	if (badresults == True):
-		if (q.empty() == False):
-			errormsg(q.get())
-		return NoDF, None      
+def displayResults(df):
 
-	finaldf = pandas.concat(output)
-	finaldf.reset_index(drop=True, inplace=True)
-	
-	if (len(finaldf) == 0):
-		sqlcode = 100
-		errormsg("No rows found")
-		return NoDF, None    
+	# Display a dataframe using the current DISPLAY settings. The dataframe is returned when it should become the cell output.
 
-	return YesDF, finaldf
+	if flag("-grid") or _settings.get('display',"PANDAS") == 'GRID':   # Check to see if we can display the results
+		if (loadGrid() == False):
+			with pandas.option_context('display.max_rows', None, 'display.max_columns', None):  
+				print(df.to_string())
+		else:
+			try:
+				pdisplay(qgrid.show_grid(df))
+			except:
+				errormsg("Grid cannot be used to display data with duplicate column names. Use option -a or %sql OPTION DISPLAY PANDAS instead.")
+		return None
+	else:
+		if flag(["-a","-all"]) or _settings.get("maxrows",10) == -1 : # All of the rows
+			pandas.options.display.max_rows = 100
+			pandas.options.display.max_columns = None
+		else:
+			pandas.options.display.max_rows = _settings.get("maxrows",10)
+			pandas.options.display.max_columns = None
+		return df
 
 @magics_class
 class DB2(Magics):
@@ -2602,6 +6209,35 @@ class DB2(Magics):
 	@needs_local_scope    
 	@line_cell_magic
 	def sql(self, line, cell=None, local_ns=None):
+
+		# -c name runs the statement on a named connection and then switches back to the current one
+
+		if (_settingsLoaded == False):
+			load_settings()
+
+		setFlags(line.replace("\n"," ").strip(),reset=True)
+		name = flagValue("-c")
+		if (flag("-c") and name == None):
+			errormsg("The -c option needs the name of a connection.")
+			return
+
+		if (name == None):
+			try:
+				return self.runsql(line, cell, local_ns)
+			finally:
+				restoreTimeout()
+
+		previous = switchConnection(name.upper())
+		if (previous == False): return
+
+		try:
+			return self.runsql(line, cell, local_ns)
+		finally:
+			restoreTimeout()
+			if (previous != None and previous in _connections):
+				switchConnection(previous)
+
+	def runsql(self, line, cell=None, local_ns=None):
 			
 		# Before we event get started, check to see if you have connected yet. Without a connection we 
 		# can't do anything. You may have a connection request in the code, so if that is true, we run those,
@@ -2624,6 +6260,8 @@ class DB2(Magics):
 		
 		# Macros gets expanded before anything is done
 		
+		loadPandas()
+
 		SQL1 = line.replace("\n"," ").strip()
 		SQL1 = setFlags(SQL1,reset=True)  
 		SQL1 = checkMacro(SQL1)                                   # Update the SQL if any macros are in there
@@ -2645,9 +6283,11 @@ class DB2(Magics):
 			return 
 		elif (sqlType == "USING"):                                # You want to use a dataframe to create a table?
 			pdReturn, df = createDF(_hdbc,_hdbi, SQL1,local_ns)
+			if (pdReturn == True and flag("-stream")):          # Generator of slices
+				return df
 			if (pdReturn == True):
 				if flag("-grid") or _settings.get('display',"PANDAS") == 'GRID':   # Check to see if we can display the results
-					if (_environment['qgrid'] == False):
+					if (loadGrid() == False):
 						with pandas.option_context('display.max_rows', 100, 'display.max_columns', None):  
 							print(df.to_string())
 					else:
@@ -2677,10 +6317,10 @@ class DB2(Magics):
 			parseCommit(remainder)
 			return
 		elif (sqlType == "PREPARE"):
-			pstmt = parsePExec(_hdbc, remainder)
+			pstmt = parsePExec(_hdbc, remainder, local_ns)
 			return(pstmt)
 		elif (sqlType == "EXECUTE"):
-			result = parsePExec(_hdbc, remainder)
+			result = parsePExec(_hdbc, remainder, local_ns)
 			return(result)    
 		elif (sqlType == "CALL"):
 			result = parseCall(_hdbc, remainder, local_ns)
@@ -2698,6 +6338,31 @@ class DB2(Magics):
 			if (db2_doConnect() == False):
 				errormsg('A CONNECT statement must be issued before issuing SQL statements.')
 				return      
+		elif (checkCurrent() == False):
+			return
+
+		try:
+			float(flagValue("-timeout",0))
+			float(flagValue("-querytimeout",0))
+		except:
+			errormsg("The -timeout and -querytimeout values must be a number of seconds.")
+			return
+
+		try:
+			if (str(flagValue("-cache",0)).upper() != "DISK"): float(flagValue("-cache",0))
+		except:
+			errormsg("The -cache value must be a number of seconds or DISK.")
+			return
+
+		if (flag("-into") and flagValue("-into") == None):
+			errormsg("The -into option needs the name of a variable.")
+			return
+
+		if (flagValue("-into") != None and flagValue("-incremental") == None):
+			errormsg("The -into option is used with -incremental col to name the variable that keeps the results.")
+			return
+
+		setTimeout(_hdbc)
 		
 		if _settings.get("maxrows",10) == -1:                                 # Set the return result size
 			pandas.reset_option('display.max_rows')
@@ -2715,25 +6380,73 @@ class DB2(Magics):
 					  
 		# For each line figure out if you run it as a command (db2) or select (sql)
 
+		if flag("-async"):                                       # Run in the background and return a handle
+			return asyncSQL(sqlLines,local_ns)
+
+		if flag("-concurrent"):                                  # Independent SELECTs are run at the same time
+			concurrentSQL(_hdbc,sqlLines,local_ns)
+			sqlelapsed = time.time() - start_time
+			return
+
+		slicing = (flagValue("-parallel") != None or flag("-partitions"))
+
 		for sqlin in sqlLines:          # Run each command
 			
 			sqlin = checkMacro(sqlin)                                 # Update based on any macros
 
-			sqlType, sql = sqlParser(sqlin,local_ns)                           # Parse the SQL  
+			sqlType, sql = sqlParser(sqlin,local_ns,pushdown=slicing == False)  # Parse the SQL (slices run on the workers' connections)
 			if (sql.strip() == ""): continue
 
 			if flag(["-e","-echo"]): 
 				debug(sql,False)
+
+			if ((flagValue("-parallel") != None or flag("-partitions")) and sqlType in ("SELECT","WITH")):
+				ok, df = parallelSQL(_hdbc,sql,flagValue("-parallel"))
+				sqlelapsed = time.time() - start_time
+				if (ok == False): return
+				if flag("-stream"): return df                       # Generator of slices
+				return displayResults(df)
 				
+			if (flagValue("-incremental") != None and sqlType in ("SELECT","WITH")):
+				df = incrementalSQL(sql,flagValue("-incremental"),flagValue("-into"),local_ns)
+				sqlelapsed = time.time() - start_time
+				if (df is None): return
+				return displayResults(df)
+
 			if flag(["-pb","-bar","-pp","-pie","-pl","-line"]): # We are plotting some results              
 				plotData(_hdbi, sql)                            # Plot the data and return
 				return                
 
+			if (sqlType not in _dmltypes):                        # DDL can change what cached statements return
+				clearStatements(_hdbc,True)
+
+			ttl = resultTTL() if isReadOnly(sql) and flag(["-r","-array","-j","-json"]) == False else 0
+			disk = diskTier() if ttl > 0 else False
+			catalog = flag("-catalog") and isReadOnly(sql) and _settings.get("catalog","ON") == "ON"
+			if (ttl > 0 or catalog == True):                      # Reuse the result of the same query
+				if (catalog == True):
+					df = catalogResult(sql)
+				else:
+					df = diskResult(sql) if disk else cachedResult(sql)
+				if (df is not None):
+					sqlelapsed = time.time() - start_time
+					if (len(df) == 0):
+						sqlcode = 100
+						if (flag(["-q","-quiet"]) == False): 
+							errormsg("No rows found")
+						continue
+					flag_output = True
+					df = displayResults(df)
+					if (df is None): continue
+					return df
+			elif (isReadOnly(sql) == False):
+				invalidateResults(sql)
+
 			try:                                                  # See if we have an answer set
-				stmt = ibm_db.prepare(_hdbc,sql)
+				stmt = prepareStatement(sql,sqlType in _dmltypes)
 				if (ibm_db.num_fields(stmt) == 0):                # No, so we just execute the code
 					start_time = time.time()
-					result = ibm_db.execute(stmt)                 # Run it                            
+					stmt, result = executeStatement(stmt,sql)     # Run it                            
 					sqlelapsed = time.time() - start_time
 					if (result == False):                         # Error executing the code
 						db2_error(flag(["-q","-quiet"])) 
@@ -2751,7 +6464,8 @@ class DB2(Magics):
 					resultSet = []
 					try:
 						start_time = time.time()                 
-						result = ibm_db.execute(stmt)             # Run it
+						setPrefetch(stmt,prefetchOn())
+						stmt, result = executeStatement(stmt,sql) # Run it
 						sqlelapsed = time.time() - start_time                            
 						if (result == False):                         # Error executing the code
 							db2_error(flag(["-q","-quiet"]))  
@@ -2771,7 +6485,7 @@ class DB2(Magics):
 							return(json_results)
 						
 						else:
-							return(fetchResults(stmt))
+							return(interruptible(fetchResults,stmt,handle=stmt))
 								
 					except Exception as err:
 						db2_error(flag(["-q","-quiet"]))
@@ -2781,30 +6495,19 @@ class DB2(Magics):
 
 					# New for pandas 1.3. We can coerce the PD datatypes to mimic those of Db2
 					
-					pd_dtypes = None
-					
-					if (_pandas_dtype == True):
-						pd_dtypes = None
-						columns, types = getColumns(stmt)
-						pd_dtypes={}
-						for idx, col in enumerate(columns):
-							try:
-								_dindex = _db2types.index(types[idx])
-							except:
-								_dindex = 0
+					pd_dtypes = pandasTypes(stmt)
 
-							pd_dtypes[col] = _pdtypes[_dindex]
-
-						if len(pd_dtypes.keys()) == 0:
-							pd_dtypes = None
 					try:
 						
 						start_time = time.time()    
-						if (_pandas_dtype == True):
-							df = pandas.read_sql_query(sql,_hdbi,dtype=pd_dtypes)  
-						else:
-							df = pandas.read_sql_query(sql,_hdbi)                        
+						df = readSQL(stmt,sql,pd_dtypes)                   
 						sqlelapsed = time.time() - start_time                                
+						if (catalog == True):
+							catalogStore(sql,df)
+						elif (ttl > 0 and disk == True):
+							diskStore(sql,df,ttl)
+						elif (ttl > 0):
+							cacheResult(sql,df,ttl)
 							
 					except Exception as err:
 						sqlelapsed = 0
@@ -2819,7 +6522,7 @@ class DB2(Magics):
 				
 					flag_output = True
 					if flag("-grid") or _settings.get('display',"PANDAS") == 'GRID':   # Check to see if we can display the results
-						if (_environment['qgrid'] == False):
+						if (loadGrid() == False):
 							with pandas.option_context('display.max_rows', None, 'display.max_columns', None):  
 								print(df.to_string())
 						else:
@@ -2848,7 +6551,7 @@ class DB2(Magics):
 # Register the Magic extension in Jupyter    
 ip = get_ipython()          
 ip.register_magics(DB2)
-load_settings()
+atexit.register(flush_settings)                  # Write any settings that are still waiting
 
 macro_list = '''
 #
@@ -2856,9 +6559,9 @@ macro_list = '''
 #
 var syntax Syntax: LIST TABLES [FOR ALL | FOR SCHEMA name]
 # 
-# Only LIST TABLES is supported by this macro
+# Only LIST TABLES is supported by this macro. The answer is kept in the catalog cache.
 #
-flags -a
+flags -a -catalog
 if {^1} <> 'TABLES'
 	exit {syntax}
 endif
@@ -2920,7 +6623,7 @@ endif
 #
 exit {syntax}
 '''
-DB2.sql(None, "define LIST", cell=macro_list, local_ns=locals())
+setMacro(macro_list,"define LIST")
 
 macro_describe = '''
 #
@@ -2935,10 +6638,24 @@ if {argc} < 2
    exit {syntax}
 endif
 
+#
+# DESCRIBE TABLE name reads SYSCAT.COLUMNS so the answer can be kept in the catalog cache
+#
+if {argc} == 2
+	if {^1} == 'TABLE'
+		flags -catalog
+		SELECT COLNAME, TYPESCHEMA, TYPENAME, LENGTH, SCALE, NULLS AS NULLABLE FROM SYSCAT.COLUMNS
+		   WHERE TABSCHEMA = CASE WHEN LOCATE('.','{^2}') > 0 THEN SUBSTR('{^2}',1,LOCATE('.','{^2}')-1) ELSE CURRENT SCHEMA END
+		   AND TABNAME = SUBSTR('{^2}',LOCATE('.','{^2}')+1)
+		   ORDER BY COLNO
+		return
+	endif
+endif
+
 CALL ADMIN_CMD('{*0}');
 '''
 
-DB2.sql(None,"define describe", cell=macro_describe, local_ns=locals())
+setMacro(macro_describe,"define describe")
 
 create_sample = """
 flags -d
@@ -3029,7 +6746,7 @@ IF FOUND = 0 THEN
 END IF;
 END"""
 
-DB2.sql(None,"define sampledata", cell=create_sample, local_ns=locals())
+setMacro(create_sample,"define sampledata")
 
 create_set = '''
 #
@@ -3054,7 +6771,108 @@ if {^1} == 'THREADS'
 	OPTION THREADS {2}
 	return
 endif
+
+# Upper limit on the number of threads
+if {^1} == 'MAXTHREADS'
+	OPTION MAXTHREADS {2}
+	return
+endif
+
+# Parallel workers are threads or processes
+if {^1} == 'PARALLEL'
+	OPTION PARALLEL {2}
+	return
+endif
 		
+# Number of named connections
+if {^1} == 'CONNECTIONS'
+	OPTION CONNECTIONS {2}
+	return
+endif
+
+if {^1} == 'RECONNECT'
+	OPTION RECONNECT {2}
+	return
+endif
+
+# Statement timeout in seconds
+if {^1} == 'TIMEOUT'
+	OPTION TIMEOUT {2}
+	return
+endif
+
+# Number of prepared statements kept
+if {^1} == 'STATEMENTS'
+	OPTION STATEMENTS {2}
+	return
+endif
+
+# Keep prepared statements after a COMMIT
+if {^1} == 'HOLD'
+	OPTION HOLD {2}
+	return
+endif
+
+# Rows read from a result set at a time
+if {^1} == 'FETCHSIZE'
+	OPTION FETCHSIZE {2}
+	return
+endif
+
+# Prefetch the next block of rows
+if {^1} == 'PREFETCH'
+	OPTION PREFETCH {2}
+	return
+endif
+
+# Reuse the results of identical queries
+if {^1} == 'CACHE'
+	OPTION CACHE {2}
+	return
+endif
+
+# Seconds a cached result is reused for
+if {^1} == 'CACHETTL'
+	OPTION CACHETTL {2}
+	return
+endif
+
+# Memory used for cached results
+if {^1} == 'CACHESIZE'
+	OPTION CACHESIZE {2}
+	return
+endif
+
+# Directory of the results cached on disk
+if {^1} == 'CACHEDIR'
+	OPTION CACHEDIR {2}
+	return
+endif
+
+# Seconds a result cached on disk is reused for
+if {^1} == 'DISKTTL'
+	OPTION DISKTTL {2}
+	return
+endif
+
+# Disk space used for cached results
+if {^1} == 'DISKSIZE'
+	OPTION DISKSIZE {2}
+	return
+endif
+
+# Catalog information cache
+if {^1} == 'CATALOG'
+	OPTION CATALOG {2}
+	return
+endif
+
+# Largest IN list expanded as literals
+if {^1} == 'INLIST'
+	OPTION INLIST {2}
+	return
+endif
+
 # Maximum number of rows displayed
 if {^1} == 'MAXROWS'
 	OPTION MAXROWS {2}
@@ -3071,6 +6889,11 @@ endif
 return
 '''
 
-DB2.sql(None,"define set", cell=create_set, local_ns=locals())
+setMacro(create_set,"define set")
    
+atexit.register(closePool)                      # Stop the parallel workers when the kernel shuts down
+atexit.register(closeAsync)
+
+_loadelapsed = time.time() - _loadstart
+
 success("Db2 Extensions Loaded.")